@@ -5,14 +5,40 @@ import threading
 import shutil
 import random
 import string
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory
+import collections
+import itertools
+import bisect
+import math
+import struct
+import sqlite3
+import zlib
+from array import array
+from datetime import datetime, timedelta
+import contextlib
+from contextlib import closing
+import contextvars
+import ipaddress
+import socket
+import ssl
+import asyncio
 import requests
-from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+import http.client
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError
+from urllib.parse import urlparse, urljoin, urlencode, parse_qs
 import concurrent.futures
+import multiprocessing
+import platform
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import logging
 from logging.handlers import RotatingFileHandler
 import sys
+import argparse
+import csv
 import webbrowser
 import traceback
 import signal
@@ -44,8 +70,22 @@ def resource_path(relative_path):
     
     return os.path.join(base_path, relative_path)
 
-# 初始化Flask应用
-app = Flask(__name__, static_folder='static', template_folder='templates')
+# 命令行模式（python chuanliu.py cli/bench ...）不导入 Flask，加快启动
+CLI_MODE = __name__ == '__main__' and sys.argv[1:2] in (['cli'], ['bench'])
+
+if CLI_MODE:
+    class HeadlessApp:
+        """命令行模式下代替 Flask 应用，路由装饰器原样返回视图函数"""
+        
+        def route(self, *args, **kwargs):
+            return lambda view: view
+    
+    app = HeadlessApp()
+else:
+    from flask import Flask, Response, render_template, request, jsonify, send_from_directory
+    
+    # 初始化Flask应用
+    app = Flask(__name__, static_folder='static', template_folder='templates')
 
 # 配置文件路径 - 修改为可写的位置
 if is_frozen():
@@ -63,6 +103,12 @@ TEMP_DIR = os.path.join(BASE_DIR, '下载临时')
 RESULT_DIR = os.path.join(BASE_DIR, '结果')
 LOG_DIR = os.path.join(BASE_DIR, '日志')
 
+# 定时测试配置
+SCHEDULE_FILE = os.path.join(BASE_DIR, 'schedule.json')
+
+# 历史结果数据库，放在结果目录中
+HISTORY_DB = os.path.join(RESULT_DIR, '测试历史.db')
+
 # 创建必要的目录
 for directory in [TEMP_DIR, RESULT_DIR, LOG_DIR]:
     os.makedirs(directory, exist_ok=True)
@@ -81,16 +127,287 @@ logger = logging.getLogger(__name__)
 
 # 全局变量
 download_sources = {}
-test_results = {}
-current_test_id = None
-is_testing = False
-stop_test = False
-download_threads = []
+sources_lock = threading.RLock()  # 下载源配置的读写锁，验证线程、测试线程和请求线程共用
+current_session = None  # 最近一次开始的测试的 TestSession
+test_sessions = collections.OrderedDict()  # 所有测试会话 {test_id: TestSession}，按创建顺序排列
 validation_in_progress = False
-current_speed_data = {}  # 存储实时速度数据
-active_downloads = {}  # 存储活跃的下载进程
-calculation_process = ""  # 计算过程描述
-last_update_time = None  # 最后更新时间
+active_downloads = {}  # 不属于任何测试的活跃下载（测试中的下载登记在 TestSession.downloads）
+download_context = threading.local()  # 当前线程正在登记连接的下载，见 tracked_connections
+validation_runs = []  # 正在进行的验证的状态，停止验证时通过它中断探测
+address_pin = contextvars.ContextVar('address_pin', default=None)  # 当前线程或协程新建连接的地址限制，见 address_pinned
+probe_cache = {}  # 下载源探测结果缓存 {url: (探测时间, 结果)}
+probe_cache_lock = threading.Lock()
+status_revisions = itertools.count(1)  # 状态版本号，任何结果变化都会递增
+event_subscribers = []  # 推送流的订阅者
+event_subscribers_lock = threading.Lock()
+history_db_lock = threading.Lock()  # 历史数据库写入锁
+history_db_ready = False  # 历史数据库表是否已创建
+test_start_lock = threading.Lock()  # 测试会话的创建、登记和清理
+metrics_lock = threading.Lock()  # /metrics 计数器锁
+scheduler_state = {  # 定时任务运行状态
+    'next_run': None,
+    'last_run': None,
+    'last_test_id': None,
+    'last_message': ''
+}
+scheduler_wakeup = threading.Event()  # 配置变更后唤醒定时任务线程重新计算
+
+# 接收缓冲区大小（字节）
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+MIN_BUFFER_SIZE = 256 * 1024
+MAX_BUFFER_SIZE = 4 * 1024 * 1024
+
+# 每个源的并行连接数上限
+MAX_CONNECTIONS = 64
+
+# 下载请求头
+DOWNLOAD_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': '*/*',
+    # 禁止压缩，测量的是实际传输的字节，也避免解压占用CPU
+    'Accept-Encoding': 'identity',
+    'Connection': 'keep-alive'
+}
+
+# 探测下载源使用的请求头
+PROBE_HEADERS = {
+    'User-Agent': DOWNLOAD_HEADERS['User-Agent'],
+    'Accept': '*/*',
+    'Accept-Encoding': 'identity'
+}
+
+# 服务器不支持分段下载时的状态
+RANGE_UNSUPPORTED_STATUS = "不支持分段下载"
+
+# 连接池大小：pool_connections 为缓存的主机数，pool_maxsize 为每个主机保留的连接数
+HTTP_POOL_CONNECTIONS = 32
+HTTP_POOL_MAXSIZE = 32
+
+# 停止测试或重置时等待测试线程结束的最长时间（秒）
+STOP_WAIT_SECONDS = 2
+
+# 下载源探测结果缓存时间（秒）
+PROBE_CACHE_TTL = 600
+
+# 多源调度模式
+SCHEDULE_MODES = ('serial', 'parallel', 'bounded')
+
+# 验证和下载引擎：thread 每个下载占用一个线程；asyncio 所有请求在一个事件循环线程中以协程运行
+ENGINES = {
+    'thread': '多线程',
+    'asyncio': '异步'
+}
+# 测试方向：download 从下载源下载；upload 向下载源配置的 upload_url 上传内存中生成的数据
+TEST_DIRECTIONS = {
+    'download': '下载',
+    'upload': '上传'
+}
+UPLOAD_METHODS = ('POST', 'PUT')
+
+# 延迟测量：单次采样的超时时间、空闲采样之间的间隔和负载采样的最小间隔（秒）
+LATENCY_PROBE_TIMEOUT = 2
+LATENCY_IDLE_INTERVAL = 0.05
+MIN_LATENCY_INTERVAL = 0.05
+
+# 连接使用的地址族（getaddrinfo 的 family 参数，0 表示不限）和按地址测量时每个源最多测量的地址数
+ADDRESS_FAMILIES = {
+    'any': 0,
+    'ipv4': socket.AF_INET,
+    'ipv6': socket.AF_INET6
+}
+MAX_ADDRESSES_PER_SOURCE = 8
+
+# 异步引擎：同时进行的请求总数上限、每个主机同时进行的请求上限、最多跟随的重定向次数
+ASYNC_MAX_CONNECTIONS = 256
+ASYNC_PER_HOST_CONNECTIONS = 8
+ASYNC_MAX_REDIRECTS = 10
+# 未指定引擎时，一次验证的源多于该数量就使用异步引擎
+ASYNC_VALIDATION_THRESHOLD = 50
+
+# 吞吐量时间序列：默认采样间隔（秒）和每个源最多保留的采样数（写满后覆盖最旧的）
+DEFAULT_SAMPLE_INTERVAL = 0.1
+MIN_SAMPLE_INTERVAL = 0.01
+SERIES_CAPACITY = 6000
+
+# 平均速度的估计方法
+SPEED_ESTIMATORS = {
+    'trimmed_mean': '去极值平均（超过2个源时去掉最高和最低值）',
+    'median': '中位数',
+    'mean': '算术平均',
+    'byte_weighted': '按下载字节加权平均'
+}
+
+# 95% 双侧 t 分布临界值，下标为自由度（1-30），更大的自由度使用正态近似 1.96
+T_CRITICAL_95 = (
+    None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042
+)
+
+# /metrics 直方图的桶上限：下载速度（Mbps）和连接阶段耗时（秒）
+THROUGHPUT_BUCKETS_MBPS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+PHASE_BUCKETS_SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# 历史查询每页最多返回的测试数
+HISTORY_MAX_PAGE_SIZE = 200
+
+# 测试会话的带宽模式：exclusive 的测试独占带宽，与其他测试排队依次进行；
+# shared 的测试可以与其他 shared 测试同时进行（测得的是分摊后的速度）
+BANDWIDTH_MODES = {
+    'exclusive': '独占带宽',
+    'shared': '共享带宽'
+}
+# 最多排队等待的测试数、可同时进行的 shared 测试数、保留的已结束测试会话数
+MAX_QUEUED_SESSIONS = 16
+MAX_SHARED_SESSIONS = 4
+FINISHED_SESSIONS_KEPT = 20
+
+# 推送流：每个客户端最多积压的事件数、两次推送的最小间隔和心跳间隔（秒）
+EVENT_QUEUE_SIZE = 256
+EVENT_PUSH_INTERVAL = 0.1
+EVENT_HEARTBEAT_INTERVAL = 15
+
+# 本地回环测速源的默认响应参数，可以在URL查询参数中逐个覆盖（如 /payload?size=1048576&chunked=1）
+ORIGIN_DEFAULTS = {
+    # 响应体字节数
+    'size': 256 * 1024 * 1024,
+    # 限速（字节/秒，每个连接单独计算），0 表示不限速
+    'rate': 0.0,
+    # 发送响应头前的附加延迟（毫秒）
+    'latency': 0.0,
+    # 抖动（毫秒）：响应头延迟和限速时每块数据的发送时间随机推迟 0 - jitter 毫秒
+    'jitter': 0.0,
+    # 限速时速度从 0 线性增加到 rate 所用的时间（毫秒），模拟TCP慢启动
+    'ramp': 0.0,
+    # 发送到第 stall_at 字节时停顿 stall 毫秒（0 表示不停顿）
+    'stall_at': 0,
+    'stall': 0.0,
+    # 发送到第 reset_at 字节时重置连接（RST），0 表示不重置
+    'reset_at': 0,
+    # 使用分块传输编码，不发送 Content-Length
+    'chunked': False,
+    # 支持 Range 请求，关闭时忽略 Range 请求头，总是返回完整内容
+    'ranges': True
+}
+# 回环源每次发送的最大字节数
+ORIGIN_BLOCK_SIZE = 256 * 1024
+
+# 基准测试用例：下载引擎、连接数和回环源的响应参数
+BENCH_CASES = {
+    'content_length': {'description': '单连接，Content-Length', 'engine': 'thread', 'connections': 1, 'origin': {}},
+    'chunked': {'description': '单连接，分块传输编码', 'engine': 'thread', 'connections': 1, 'origin': {'chunked': True}},
+    'multi': {'description': '4连接 Range 分段', 'engine': 'thread', 'connections': 4, 'origin': {}},
+    'asyncio': {'description': '异步引擎单连接', 'engine': 'asyncio', 'connections': 1, 'origin': {}},
+    'upload': {'description': '单连接上传，分块传输编码', 'engine': 'thread', 'connections': 1, 'origin': {}, 'direction': 'upload'}
+}
+BENCH_SOURCE_ID = 'loopback'
+
+# 定时计划自检用例：定时配置、计算起点（本地时间，fold=1 表示夏令时结束时重复一小时中的第二遍）和期望的下一次运行时间；
+# expected 为 None 表示配置无效应当报错，tz 为用例使用的时区（不支持切换时区的系统上跳过）
+CRON_CHECKS = [
+    {'description': '每15分钟', 'config': {'mode': 'cron', 'cron': '*/15 * * * *'}, 'after': '2026-01-01 10:07', 'expected': '2026-01-01 10:15'},
+    {'description': '正好在匹配时间时取下一次', 'config': {'mode': 'cron', 'cron': '*/15 * * * *'}, 'after': '2026-01-01 10:15', 'expected': '2026-01-01 10:30'},
+    {'description': '工作日，周五之后是周一', 'config': {'mode': 'cron', 'cron': '0 9 * * 1-5'}, 'after': '2026-01-02 09:00', 'expected': '2026-01-05 09:00'},
+    {'description': '列表和带步长的范围', 'config': {'mode': 'cron', 'cron': '5,35 8-18/5 * * *'}, 'after': '2026-01-01 08:40', 'expected': '2026-01-01 13:05'},
+    {'description': '跨月', 'config': {'mode': 'cron', 'cron': '30 2 1 * *'}, 'after': '2026-01-31 23:00', 'expected': '2026-02-01 02:30'},
+    {'description': '跨年', 'config': {'mode': 'cron', 'cron': '0 0 1 1 *'}, 'after': '2026-06-01 00:00', 'expected': '2027-01-01 00:00'},
+    {'description': '2月29日只在闰年', 'config': {'mode': 'cron', 'cron': '0 0 29 2 *'}, 'after': '2026-03-01 00:00', 'expected': '2028-02-29 00:00'},
+    {'description': '周日写作7', 'config': {'mode': 'cron', 'cron': '0 8 * * 7'}, 'after': '2026-01-01 00:00', 'expected': '2026-01-04 08:00'},
+    {'description': '日和周都受限时满足其一', 'config': {'mode': 'cron', 'cron': '0 12 13 * 5'}, 'after': '2026-02-01 00:00', 'expected': '2026-02-06 12:00'},
+    {'description': '日为 */n 时不算受限，须同时满足周', 'config': {'mode': 'cron', 'cron': '0 0 */2 * 1'}, 'after': '2026-01-01 00:00', 'expected': '2026-01-05 00:00'},
+    {'description': '分钟超出范围', 'config': {'mode': 'cron', 'cron': '60 * * * *'}, 'after': '2026-01-01 00:00', 'expected': None},
+    {'description': '段数不足', 'config': {'mode': 'cron', 'cron': '* * * *'}, 'after': '2026-01-01 00:00', 'expected': None},
+    {'description': '步长为0', 'config': {'mode': 'cron', 'cron': '*/0 * * * *'}, 'after': '2026-01-01 00:00', 'expected': None},
+    {'description': '范围颠倒', 'config': {'mode': 'cron', 'cron': '5-1 * * * *'}, 'after': '2026-01-01 00:00', 'expected': None},
+    {'description': '不存在的日期', 'config': {'mode': 'cron', 'cron': '0 0 31 2 *'}, 'after': '2026-01-01 00:00', 'expected': None},
+    {'description': '夏令时开始时跳过的时间', 'config': {'mode': 'cron', 'cron': '30 2 * * *'}, 'after': '2026-03-08 01:00', 'expected': '2026-03-08 03:30', 'tz': 'America/New_York'},
+    {'description': '夏令时结束时重复的一小时不再执行', 'config': {'mode': 'cron', 'cron': '30 1 * * *'}, 'after': '2026-11-01 01:10', 'fold': 1, 'expected': '2026-11-02 01:30', 'tz': 'America/New_York'},
+    {'description': '间隔模式', 'config': {'mode': 'interval', 'interval_minutes': 30}, 'after': '2026-01-01 10:07', 'expected': '2026-01-01 10:37'},
+    {'description': '间隔模式加随机延迟', 'config': {'mode': 'interval', 'interval_minutes': 30, 'jitter_seconds': 50}, 'after': '2026-01-01 10:07', 'expected': '2026-01-01 10:37'}
+]
+
+# 准确度测试场景：回环源的网络损伤参数和额外的测试选项；
+# stall_at / reset_at 在这里是占下载大小的比例，expect_failure 表示下载应当失败
+ACCURACY_PROFILES = {
+    'cap': {'description': '固定限速', 'origin': {}},
+    'latency_jitter': {'description': '200毫秒延迟，50毫秒抖动', 'origin': {'latency': 200, 'jitter': 50}},
+    'slow_start': {'description': '1秒线性爬升（慢启动）', 'origin': {'ramp': 1000}},
+    'slow_start_warmup': {'description': '1秒线性爬升，排除1秒预热', 'origin': {'ramp': 1000}, 'options': {'warmup_seconds': 1}},
+    'stall': {'description': '传输一半时停顿1秒', 'origin': {'stall': 1000, 'stall_at': 0.5}},
+    'reset': {'description': '传输一半时连接被重置', 'origin': {'reset_at': 0.5}, 'expect_failure': True}
+}
+
+# 测试选项默认值
+DEFAULT_TEST_OPTIONS = {
+    # 校验模式：将下载内容写入下载临时目录（会受磁盘写入速度影响），默认丢弃不落盘
+    "verify_payload": False,
+    # 接收缓冲区大小（字节），范围 256 KB - 4 MB
+    "buffer_size": DEFAULT_BUFFER_SIZE,
+    # 每个源的并行连接数，大于1时先单连接测试，再按Range分段多连接测试
+    "connections": 1,
+    # 多源调度模式: serial(逐个测试) / parallel(全部同时测试) / bounded(限制同时测试的源数量)
+    "schedule_mode": "serial",
+    # bounded 模式下同时测试的源数量
+    "max_workers": 4,
+    # 每个源的最长测试时间（秒），0 表示不限制（仍受159秒超时限制）
+    "max_duration": 0,
+    # 每个源的最大下载字节数，0 表示下载完整文件
+    "max_bytes": 0,
+    # 整个测试（所有源的全部测量，包括失败和停止的）的总传输字节上限，0 表示不限制；达到后所有测量结束
+    "byte_limit": 0,
+    # 每秒速度采样稳定后提前结束
+    "stable_stop": False,
+    # 稳定判定：最近 stable_samples 个采样的极差不超过均值的 stable_tolerance
+    "stable_tolerance": 0.05,
+    "stable_samples": 5,
+    # 计算速度时排除开头的TCP慢启动预热时间（秒）
+    "warmup_seconds": 0,
+    # 计时前先用HEAD请求建立连接，下载时复用已建立的连接，速度不含DNS/TCP/TLS握手时间
+    "warm_connection": False,
+    # 吞吐量时间序列的采样间隔（秒），记录每个源的速度曲线
+    "sample_interval": DEFAULT_SAMPLE_INTERVAL,
+    # 平均速度的估计方法，见 SPEED_ESTIMATORS
+    "estimator": "trimmed_mean",
+    # 与其他测试的带宽关系，见 BANDWIDTH_MODES
+    "bandwidth_mode": "exclusive",
+    # 下载引擎，见 ENGINES；源很多时 asyncio 不必为每个下载创建线程
+    "engine": "thread",
+    # 测试方向，见 TEST_DIRECTIONS；上传测试使用下载源配置中的 upload_url
+    "direction": "download",
+    # 上传的请求方法（POST / PUT）、上传字节数，以及是否使用分块传输编码（否则发送 Content-Length）
+    "upload_method": "POST",
+    "upload_bytes": 100 * 1024 * 1024,
+    "upload_chunked": True,
+    # 延迟测量：测试前测量每个源主机的空闲延迟，下载期间同时测量负载延迟（TCP连接耗时）
+    "latency_probe": True,
+    # 每个源的空闲延迟采样次数、下载期间负载延迟的采样间隔（秒）
+    "latency_samples": 10,
+    "latency_interval": 0.2,
+    # 连接使用的地址族，见 ADDRESS_FAMILIES；源主机只有另一族的地址时测试失败
+    "address_family": "any",
+    # 把源主机固定到指定IP：{源ID: IP地址}，用于测试某个CDN节点
+    "pin_addresses": {},
+    # 按地址测量：解析源主机的全部 A/AAAA 记录，每个地址单独测量一次，结果中按地址列出速度
+    "per_address": False
+}
+
+# 默认定时测试配置
+DEFAULT_SCHEDULE = {
+    "enabled": False,
+    # interval: 固定间隔 / cron: 5段cron表达式（分 时 日 月 周，周日为0），使用本地时间
+    "mode": "interval",
+    "interval_minutes": 60,
+    "cron": "0 * * * *",
+    # 在计划时间后随机延迟 0 - jitter_seconds 秒，避免多台机器同时测试
+    "jitter_seconds": 0,
+    # 测试的源ID，空列表表示所有已启用且可用的源
+    "sources": [],
+    # 测试选项，同 /api/test
+    "options": {},
+    # 每天最多下载的字节数（按历史记录统计当天所有测试），0 表示不限制
+    "daily_byte_limit": 0
+}
+schedule_config = dict(DEFAULT_SCHEDULE)  # 当前定时测试配置，启动时从 SCHEDULE_FILE 加载
 
 # 默认下载源配置（更新版）
 DEFAULT_SOURCES = {
@@ -168,6 +485,172 @@ DEFAULT_SOURCES = {
     }
 }
 
+@contextlib.contextmanager
+def address_pinned(pin):
+    """期间当前线程（或协程）新建的连接受 pin 限制，pin 为 None 时不限制
+
+    pin 为 {'host': 主机名, 'address': IP地址, 'family': 地址族}：连接 host 时直接使用 address；
+    连接其他主机（如重定向后的主机）或没有指定 address 时只使用 family 族的地址（0 表示不限）。
+    新线程不继承限制，需要用 contextvars.copy_context().run 启动；asyncio 任务创建时自动继承。
+    """
+    token = address_pin.set(pin)
+    try:
+        yield
+    finally:
+        address_pin.reset(token)
+
+def pinned_lookup(host, pin):
+    """按地址限制返回实际要解析的 (主机名或IP, 地址族)"""
+    if pin is None:
+        return host, 0
+    if pin['address'] and pin['host'] == host:
+        return pin['address'], 0
+    return host, pin['family']
+
+def source_address_pin(source_id, url, options):
+    """按测试选项 address_family 和 pin_addresses 生成一个源的地址限制，没有限制时返回 None"""
+    address = (options.get('pin_addresses') or {}).get(source_id)
+    if address:
+        ip = ipaddress.ip_address(address)
+        family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+        return {'host': urlparse(url).hostname, 'address': str(ip), 'family': family}
+    family = ADDRESS_FAMILIES[options.get('address_family') or 'any']
+    return {'host': None, 'address': None, 'family': family} if family else None
+
+def address_family_name(family):
+    return 'ipv6' if family == socket.AF_INET6 else 'ipv4'
+
+def distinct_addresses(addresses):
+    """getaddrinfo 结果中的 (地址族, IP)，保持解析器给出的顺序并去重，最多 MAX_ADDRESSES_PER_SOURCE 个"""
+    distinct = []
+    for family, _, _, _, address in addresses:
+        if (family, address[0]) not in distinct:
+            distinct.append((family, address[0]))
+    return distinct[:MAX_ADDRESSES_PER_SOURCE]
+
+class TimedConnectionMixin:
+    """记录建立连接各阶段的耗时（单调时钟）：DNS解析、TCP连接、TLS握手，以及实际连接的地址
+
+    新建连接时遵守当前的地址限制（见 address_pinned），pin 记录建立连接时的限制。
+    """
+    
+    phase_timings = None
+    pin = None
+    
+    def _new_conn(self):
+        pin = address_pin.get()
+        lookup_host, family = pinned_lookup(self._dns_host, pin)
+        dns_start = time.monotonic()
+        try:
+            addresses = socket.getaddrinfo(lookup_host, self.port, family, socket.SOCK_STREAM)
+        except socket.gaierror:
+            if pin is not None:
+                # 限制地址族时不能回退到不受限制的解析
+                raise
+            # 解析失败交给 urllib3 按原逻辑报错
+            return super()._new_conn()
+        connect_start = time.monotonic()
+        
+        # 逐个尝试解析到的地址，连接时不再重复解析
+        dns_host = self._dns_host
+        try:
+            for index, address in enumerate(addresses):
+                self._dns_host = address[4][0]
+                try:
+                    sock = super()._new_conn()
+                    break
+                except ConnectTimeoutError:
+                    if index == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = dns_host
+        track_socket(sock)
+        
+        self.pin = pin
+        self.phase_timings = {
+            'dns': connect_start - dns_start,
+            'connect': time.monotonic() - connect_start,
+            'tls': None,
+            'address': sock.getpeername()[0],
+            'established_at': time.monotonic()
+        }
+        return sock
+    
+    def connect(self):
+        connect_start = time.monotonic()
+        super().connect()
+        if self.phase_timings is not None and isinstance(self, HTTPSConnection):
+            tcp_time = self.phase_timings['dns'] + self.phase_timings['connect']
+            self.phase_timings['tls'] = max(0.0, time.monotonic() - connect_start - tcp_time)
+            self.phase_timings['established_at'] = time.monotonic()
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+class PinnedPoolMixin:
+    """从连接池取出连接时的处理
+
+    与当前的地址限制不同的连接被关闭，下次请求按当前限制重新建立连接；
+    复用的keep-alive连接不经过 _new_conn，在取出时登记到当前下载（见 track_socket），
+    等待响应头期间停止测试也能立即关闭。
+    """
+    
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        if conn is not None and conn.pin != address_pin.get():
+            conn.close()
+        elif conn is not None and conn.sock is not None:
+            track_socket(conn.sock)
+        return conn
+
+class TimedHTTPConnectionPool(PinnedPoolMixin, HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(PinnedPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """连接池使用可记录阶段耗时的连接"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+def get_phase_timings(response, request_start, headers_time):
+    """计算一次请求的阶段耗时(秒)：DNS解析、TCP连接、TLS握手、首字节
+
+    连接在本次请求开始前就已建立（复用keep-alive连接）时，握手相关阶段记为0。
+    首字节时间为从发出请求（含重定向）到收到响应头的时间减去建立连接的时间。
+    """
+    connection = getattr(response.raw, '_connection', None)
+    timings = getattr(connection, 'phase_timings', None)
+    phases = {'dns': 0.0, 'connect': 0.0, 'tls': None, 'reused': True, 'address': timings and timings['address']}
+    if timings and timings['established_at'] >= request_start:
+        phases.update(dns=timings['dns'], connect=timings['connect'], tls=timings['tls'], reused=False)
+    handshake_time = phases['dns'] + phases['connect'] + (phases['tls'] or 0)
+    phases['ttfb'] = max(0.0, headers_time - request_start - handshake_time)
+    return phases
+
+def create_http_session():
+    """创建共享的HTTP会话
+
+    验证、获取大小和下载共用同一个连接池，同一主机的请求复用keep-alive连接，
+    省去重复的DNS解析、TCP握手和TLS握手；urllib3连接池是线程安全的，可供验证线程池并发使用。
+    """
+    session = requests.Session()
+    adapter = TimedHTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+http_session = create_http_session()
+
 def load_config():
     """加载配置文件"""
     global download_sources
@@ -198,122 +681,123 @@ def load_config():
 def save_config():
     """保存配置文件"""
     try:
+        # 先在锁内序列化，避免写文件时下载源被其他线程修改
+        with sources_lock:
+            content = json.dumps(download_sources, ensure_ascii=False, indent=2)
         with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(download_sources, f, ensure_ascii=False, indent=2)
+            f.write(content)
         logger.info("配置文件保存成功")
         return True
     except Exception as e:
         logger.error(f"保存配置文件失败: {e}")
         return False
 
-def get_file_size_from_url(url, timeout=10):
-    """获取远程文件大小 - 改进版"""
+def probe_source(url, timeout=10, use_cache=True):
+    """探测下载源 - 一次请求同时获取可用性、最终URL、文件大小、是否支持Range和ETag
+
+    先发送HEAD请求（自动跟随重定向）；HEAD不被支持或没有返回大小时改用 Range: bytes=0-0
+    的GET请求，只读取1个字节。结果按URL缓存 PROBE_CACHE_TTL 秒，期间重复验证直接使用缓存。
+    """
+    if use_cache:
+        cached = get_cached_probe(url)
+        if cached:
+            return cached
+    
+    result = new_probe_result(url)
+    headers = dict(PROBE_HEADERS)
+    
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Encoding': 'gzip, deflate',
-            'Connection': 'keep-alive'
-        }
-        
-        # 先尝试HEAD请求
-        try:
-            response = requests.head(url, headers=headers, timeout=timeout, allow_redirects=True)
-            
-            # 处理重定向
-            if response.status_code in [301, 302, 303, 307, 308]:
-                redirect_url = response.headers.get('Location')
-                if redirect_url:
-                    if not redirect_url.startswith('http'):
-                        # 处理相对URL
-                        from urllib.parse import urljoin
-                        redirect_url = urljoin(url, redirect_url)
-                    url = redirect_url
-                    response = requests.head(redirect_url, headers=headers, timeout=timeout, allow_redirects=True)
-            
-            if response.status_code in [200, 206]:
-                # 尝试从Content-Length获取文件大小
-                content_length = response.headers.get('Content-Length')
-                if content_length:
-                    try:
-                        size_bytes = int(content_length)
-                        if size_bytes > 0:
-                            return format_file_size(size_bytes)
-                    except:
-                        pass
-                
-                # 尝试从Content-Range获取文件大小
-                content_range = response.headers.get('Content-Range')
-                if content_range and '/' in content_range:
-                    try:
-                        size_bytes = int(content_range.split('/')[-1])
-                        if size_bytes > 0:
-                            return format_file_size(size_bytes)
-                    except:
-                        pass
-        except:
-            pass
-        
-        # 如果HEAD失败，尝试带Range头的GET请求
-        try:
-            headers['Range'] = 'bytes=0-1'
-            response = requests.get(url, headers=headers, timeout=timeout, stream=True, allow_redirects=True)
-            
-            if response.status_code in [200, 206]:
-                content_length = response.headers.get('Content-Length')
-                if content_length:
-                    try:
-                        size_bytes = int(content_length)
-                        if size_bytes > 0:
-                            return format_file_size(size_bytes)
-                    except:
-                        pass
-                
-                # 尝试从Content-Range获取
-                content_range = response.headers.get('Content-Range')
-                if content_range and '/' in content_range:
-                    try:
-                        size_bytes = int(content_range.split('/')[-1])
-                        if size_bytes > 0:
-                            return format_file_size(size_bytes)
-                    except:
-                        pass
-        except:
-            pass
-        
-        # 最后尝试完整GET请求但只读取头部
-        try:
-            response = requests.get(url, headers=headers, timeout=timeout, stream=True, allow_redirects=True)
-            if response.status_code in [200, 206]:
-                content_length = response.headers.get('Content-Length')
-                if content_length:
-                    try:
-                        size_bytes = int(content_length)
-                        if size_bytes > 0:
-                            return format_file_size(size_bytes)
-                    except:
-                        pass
-                
-                # 如果还是没有，尝试读取一小部分数据来推断
-                chunk_size = 1024 * 1024  # 1MB
-                total_size = 0
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    total_size += len(chunk)
-                    if len(chunk) < chunk_size:  # 最后一个块
-                        break
-                if total_size > 0:
-                    return format_file_size(total_size)
-        except:
-            pass
-        
-        return "未知大小"
+        response = http_session.head(url, headers=headers, timeout=timeout, allow_redirects=True)
+        apply_probe_response(result, response)
         
+        if not result['valid'] or not result['size_bytes']:
+            # HEAD不被支持或没有返回大小，改用只取1个字节的GET请求
+            headers['Range'] = 'bytes=0-0'
+            response = http_session.get(url, headers=headers, timeout=timeout, stream=True, allow_redirects=True)
+            if response.status_code == 206:
+                response.content
+            else:
+                response.close()
+            if response.status_code in [200, 206] or not result['valid']:
+                apply_probe_response(result, response)
+    
     except requests.exceptions.Timeout:
-        logger.warning(f"获取文件大小超时: {url}")
-        return "超时"
+        logger.warning(f"探测下载源超时: {url}")
+        result['error'] = '超时'
     except Exception as e:
-        logger.error(f"获取文件大小失败 {url}: {e}")
-        return "未知大小"
+        logger.error(f"探测下载源失败 {url}: {e}")
+        result['error'] = str(e)
+    
+    store_probe(url, result)
+    return result
+
+def new_probe_result(url):
+    return {
+        'valid': False,
+        'final_url': url,
+        'size_bytes': None,
+        'accept_ranges': False,
+        'etag': None,
+        'status_code': None,
+        'error': None
+    }
+
+def get_cached_probe(url):
+    """PROBE_CACHE_TTL 内的探测结果，没有时返回 None"""
+    with probe_cache_lock:
+        cached = probe_cache.get(url)
+    if cached and time.time() - cached[0] < PROBE_CACHE_TTL:
+        return cached[1]
+    return None
+
+def store_probe(url, result):
+    """缓存探测结果，超时等网络异常不缓存，下次验证重新探测"""
+    if result['error'] is None:
+        with probe_cache_lock:
+            probe_cache[url] = (time.time(), result)
+
+def apply_probe_response(result, response):
+    """从HEAD或Range请求的响应中提取探测结果"""
+    result['status_code'] = response.status_code
+    result['final_url'] = response.url
+    result['valid'] = response.status_code in [200, 206]
+    if not result['valid']:
+        return
+    
+    result['etag'] = response.headers.get('ETag')
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code == 206 and '/' in content_range:
+        result['accept_ranges'] = True
+        size_text = content_range.split('/')[-1]
+    else:
+        result['accept_ranges'] = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        size_text = response.headers.get('Content-Length', '')
+    if size_text.isdigit() and int(size_text) > 0:
+        result['size_bytes'] = int(size_text)
+
+def is_recently_validated(source):
+    """下载源是否在 PROBE_CACHE_TTL 内验证(或测试)成功过"""
+    if not source.get('valid') or not source.get('last_validation'):
+        return False
+    with probe_cache_lock:
+        cached = source['url'] in probe_cache
+    if cached:
+        # 进程内已有探测缓存，由 probe_source 判断是否过期
+        return False
+    try:
+        last_validation = datetime.strptime(source['last_validation'], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return False
+    return (datetime.now() - last_validation).total_seconds() < PROBE_CACHE_TTL
+
+def get_file_size_from_url(url, timeout=10):
+    """获取远程文件大小"""
+    result = probe_source(url, timeout)
+    if result['error'] == '超时':
+        return "超时"
+    if result['size_bytes']:
+        return format_file_size(result['size_bytes'])
+    return "未知大小"
 
 def format_file_size(size_bytes):
     """格式化文件大小"""
@@ -328,223 +812,1766 @@ def format_file_size(size_bytes):
 
 def validate_url(url, timeout=10):
     """验证URL是否可用"""
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': '*/*'
+    return probe_source(url, timeout)['valid']
+
+class ThroughputSeries:
+    """单个源的吞吐量时间序列 - 定长数组实现的环形缓冲区
+
+    每个采样为 (距开始的秒数, 累计字节数, 与上一采样之间的速度(字节/秒))，
+    间隔小于 interval 的更新会被忽略；数组随采样增长，写满 capacity 个采样后覆盖最旧的，
+    长时间测试也不会继续占用内存，短测试只占用实际采样所需的内存。
+    """
+    
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL, capacity=SERIES_CAPACITY):
+        self.interval = max(MIN_SAMPLE_INTERVAL, float(interval or DEFAULT_SAMPLE_INTERVAL))
+        self.capacity = capacity
+        self.times = array('d')
+        self.sizes = array('d')
+        self.rates = array('d')
+        self.count = 0  # 累计写入的采样数（含已被覆盖的）
+        self.last_time = None
+        self.last_size = 0
+    
+    def add(self, elapsed, downloaded_size, force=False):
+        """记录一个采样，距上一采样不足 interval 且非 force 时忽略"""
+        if self.last_time is not None:
+            time_diff = elapsed - self.last_time
+            if time_diff <= 0 or (time_diff < self.interval and not force):
+                return
+            # 结束时补记的采样只在有新数据时记录
+            if force and time_diff < self.interval and downloaded_size == self.last_size:
+                return
+            rate = (downloaded_size - self.last_size) / time_diff
+        else:
+            rate = 0
+        
+        if self.count < self.capacity:
+            self.times.append(elapsed)
+            self.sizes.append(downloaded_size)
+            self.rates.append(rate)
+        else:
+            index = self.count % self.capacity
+            self.times[index] = elapsed
+            self.sizes[index] = downloaded_size
+            self.rates[index] = rate
+        # 先写数据再增加计数，读取方不会读到未写完的采样
+        self.count += 1
+        self.last_time = elapsed
+        self.last_size = downloaded_size
+    
+    def samples(self, since=0):
+        """返回序号不小于 since 的采样列表 [[秒, 字节, 字节/秒], ...]，已被覆盖的采样不再返回"""
+        count = self.count
+        first = max(since, count - self.capacity, 0)
+        samples = []
+        for position in range(first, count):
+            index = position % self.capacity
+            samples.append([round(self.times[index], 4), int(self.sizes[index]), round(self.rates[index], 1)])
+        return samples
+    
+    def to_dict(self, since=0):
+        """导出为可序列化的字典，next 为下次增量获取使用的序号"""
+        return {
+            'interval': self.interval,
+            'count': self.count,
+            'overwritten': max(0, self.count - self.capacity),
+            'next': self.count,
+            'samples': self.samples(since)
         }
+
+class ThroughputMeter:
+    """吞吐量统计 - 每秒采样一次速度，处理预热窗口、时长/字节上限和稳定提前停止"""
+    
+    def __init__(self, start_time, options=None):
+        options = options or {}
+        self.start_time = start_time
+        self.max_duration = float(options.get('max_duration') or 0)
+        self.max_bytes = int(options.get('max_bytes') or 0)
+        self.stable_stop = bool(options.get('stable_stop', False))
+        self.stable_tolerance = float(options.get('stable_tolerance') or 0.05)
+        self.stable_samples = max(2, int(options.get('stable_samples') or 5))
+        self.warmup_seconds = float(options.get('warmup_seconds') or 0)
+        self.direction = options.get('direction', 'download')
+        # 高分辨率速度曲线，与每秒采样相互独立
+        self.series = ThroughputSeries(options.get('sample_interval', DEFAULT_SAMPLE_INTERVAL))
+        self.series.add(0, 0)
         
-        # 先尝试HEAD请求
-        try:
-            response = requests.head(url, headers=headers, timeout=timeout, allow_redirects=True)
-            
-            # 处理重定向
-            if response.status_code in [301, 302, 303, 307, 308]:
-                redirect_url = response.headers.get('Location')
-                if redirect_url:
-                    if not redirect_url.startswith('http'):
-                        from urllib.parse import urljoin
-                        redirect_url = urljoin(url, redirect_url)
-                    url = redirect_url
-                    response = requests.head(redirect_url, headers=headers, timeout=timeout, allow_redirects=True)
-            
-            if response.status_code in [200, 206]:
-                return True
-        except:
-            pass
+        self.samples = []  # 预热之后的每秒速度(字节/秒)
+        self.last_sample_time = start_time
+        self.last_sample_size = 0
+        self.warmup_time = None
+        self.warmup_size = 0
+        self.stop_reason = None
+        # 所属测试（见 TestSession.add_meter），已传输的字节计入测试的流量
+        self.session = None
+        self.source_id = None
+        self.transferred = 0
+    
+    def account(self, downloaded_size):
+        """把新传输的字节计入所属测试的流量"""
+        if self.session is not None and downloaded_size > self.transferred:
+            self.session.add_transferred(self.source_id, downloaded_size - self.transferred)
+            self.transferred = downloaded_size
+    
+    def update(self, downloaded_size, current_time):
+        """记录当前进度，满1秒时返回本秒速度(字节/秒)，否则返回None"""
+        elapsed = current_time - self.start_time
+        self.account(downloaded_size)
         
-        # 如果HEAD不被支持，尝试GET请求
-        try:
-            response = requests.get(url, headers=headers, timeout=timeout, stream=True, allow_redirects=True)
-            if response.status_code in [200, 206]:
-                return True
-        except:
-            pass
+        if self.warmup_time is None and elapsed >= self.warmup_seconds:
+            self.warmup_time = current_time
+            self.warmup_size = downloaded_size
         
-        return False
+        if self.max_bytes and downloaded_size >= self.max_bytes:
+            self.stop_reason = '达到字节上限'
+        elif self.max_duration and elapsed >= self.max_duration:
+            self.stop_reason = '达到时长上限'
+        elif self.session is not None and self.session.byte_limit_reached:
+            self.stop_reason = '达到测试流量上限'
         
-    except Exception as e:
-        logger.error(f"验证URL失败 {url}: {e}")
-        return False
+        self.series.add(elapsed, downloaded_size)
+        
+        time_diff = current_time - self.last_sample_time
+        if time_diff < 1.0:
+            return None
+        
+        speed_bps = (downloaded_size - self.last_sample_size) / time_diff
+        self.last_sample_time = current_time
+        self.last_sample_size = downloaded_size
+        
+        if self.warmup_time is not None and self.warmup_time < current_time:
+            self.samples.append(speed_bps)
+            if self.stable_stop and not self.stop_reason and self.is_stable():
+                self.stop_reason = '速度已稳定'
+        
+        return speed_bps
+    
+    def is_stable(self):
+        """最近的采样是否已收敛到容差范围内"""
+        if len(self.samples) < self.stable_samples:
+            return False
+        recent = self.samples[-self.stable_samples:]
+        mean = sum(recent) / len(recent)
+        return mean > 0 and (max(recent) - min(recent)) / mean <= self.stable_tolerance
+    
+    def progress(self, downloaded_size, total_size, current_time):
+        """按文件大小、字节上限和时长上限中最先到达的计算进度"""
+        if self.max_bytes:
+            total_size = min(total_size, self.max_bytes) if total_size > 0 else self.max_bytes
+        progress = downloaded_size / total_size * 100 if total_size > 0 else 0
+        if self.max_duration:
+            progress = max(progress, (current_time - self.start_time) / self.max_duration * 100)
+        return min(progress, 100)
+    
+    def result(self, downloaded_size, end_time):
+        """返回 (平均速度(字节/秒), 计算速度使用的时长)，已越过预热窗口时排除预热部分"""
+        # 补上最后一个不足采样间隔的采样
+        self.account(downloaded_size)
+        self.series.add(end_time - self.start_time, downloaded_size, force=True)
+        if self.warmup_seconds and self.warmup_time is not None and end_time > self.warmup_time:
+            measured_time = end_time - self.warmup_time
+            measured_size = downloaded_size - self.warmup_size
+        else:
+            measured_time = end_time - self.start_time
+            measured_size = downloaded_size
+        speed_bps = measured_size / measured_time if measured_time > 0 else 0
+        return speed_bps, measured_time
+    
+    def info(self):
+        """本次测量的附加信息"""
+        return {
+            'stop_reason': self.stop_reason or ('上传完成' if self.direction == 'upload' else '下载完成'),
+            'warmup_excluded': bool(self.warmup_seconds and self.warmup_time is not None),
+            'warmup_seconds': self.warmup_seconds
+        }
+
+def download_file(source_id, url, file_path=None, progress_callback=None, speed_callback=None, downloaded_size_callback=None, buffer_size=None, options=None, info=None, session=None):
+    """下载文件 - 增加159秒超时，可中断
 
-def download_file(source_id, url, file_path, progress_callback=None, speed_callback=None, downloaded_size_callback=None):
-    """下载文件 - 增加159秒超时，可中断"""
+    file_path 为 None 时使用丢弃模式：数据读入可复用的缓冲区后直接丢弃，不写入磁盘；
+    指定 file_path 时为校验模式，将内容写入该文件。
+    buffer_size 为接收缓冲区大小，进度和速度统计每填充一次缓冲区更新一次。
+    options 中的时长/字节上限和稳定提前停止设置由 ThroughputMeter 处理，
+    info 字典（如提供）会写入结束原因等附加信息。
+    session 为所属的 TestSession，下载登记在其中以便停止，并记录时间序列。
+    """
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Encoding': 'gzip, deflate',
-            'Connection': 'keep-alive'
-        }
+        headers = dict(DOWNLOAD_HEADERS)
+        
+        # 预先建立连接，计时从复用已建立的连接开始
+        if (options or {}).get('warm_connection'):
+            warm_up_connections(url)
         
-        start_time = time.time()
+        # 使用单调时钟计时，不受系统时间调整影响
+        start_time = time.monotonic()
         timeout = 159  # 单个下载超时时间改为159秒
         
-        # 注册这个下载为活跃下载
-        active_downloads[source_id] = {
+        # 注册这个下载为活跃下载，停止时直接关闭其连接
+        download_state = {
             'start_time': start_time,
-            'active': True
+            'active': True,
+            'sockets': set()
         }
+        register_download(session, source_id, download_state)
         
         try:
-            response = requests.get(url, headers=headers, timeout=timeout, stream=True, allow_redirects=True)
-            response.raise_for_status()
-            
-            total_size = int(response.headers.get('Content-Length', 0))
-            downloaded_size = 0
-            last_progress_time = start_time
-            last_speed_update_time = start_time
-            last_downloaded_size = 0
-            
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if not active_downloads.get(source_id, {}).get('active', True):
-                        return None, None, None, None, "用户停止"
-                    
-                    # 检查是否超时
-                    if time.time() - start_time > timeout:
-                        return None, None, None, None, "超时(59秒)"
-                    
-                    if chunk:
-                        f.write(chunk)
-                        downloaded_size += len(chunk)
+            with tracked_connections(download_state):
+                response = http_session.get(url, headers=headers, timeout=timeout, stream=True, allow_redirects=True)
+                headers_time = time.monotonic()
+                response.raise_for_status()
+                phases = get_phase_timings(response, start_time, headers_time)
+                
+                total_size = int(response.headers.get('Content-Length', 0))
+                downloaded_size = 0
+                last_progress_time = start_time
+                # 速度只统计传输阶段，从收到响应头开始
+                meter = ThroughputMeter(headers_time, options)
+                if session is not None:
+                    session.add_meter(source_id, meter)
+                
+                # 接收缓冲区只分配一次，整个下载过程复用
+                buffer = memoryview(bytearray(normalize_buffer_size(buffer_size)))
+                readinto = get_raw_reader(response)
+                # 校验模式写入磁盘，丢弃模式读完即丢弃
+                payload_file = open(file_path, 'wb') if file_path else None
+                
+                try:
+                    while True:
+                        # 接近字节上限时只读到上限为止
+                        remaining = meter.max_bytes - downloaded_size if meter.max_bytes else len(buffer)
+                        received = readinto(buffer if remaining >= len(buffer) else buffer[:remaining])
+                        if not received:
+                            break
+                        
+                        if payload_file:
+                            payload_file.write(buffer[:received])
+                        downloaded_size += received
+                        
+                        # 每个缓冲区只取一次时间、检查一次状态
+                        current_time = time.monotonic()
+                        
+                        if not download_state['active']:
+                            return None, None, None, None, "用户停止"
+                        
+                        # 检查是否超时
+                        if current_time - start_time > timeout:
+                            return None, None, None, None, "超时(59秒)"
                         
                         # 更新已下载大小
                         if downloaded_size_callback:
                             downloaded_size_callback(source_id, downloaded_size)
                         
                         # 更新进度（每秒最多更新4次）
-                        current_time = time.time()
                         if current_time - last_progress_time > 0.25 and progress_callback:
-                            progress = (downloaded_size / total_size * 100) if total_size > 0 else 0
-                            progress_callback(source_id, progress)
+                            progress_callback(source_id, meter.progress(downloaded_size, total_size, current_time))
                             last_progress_time = current_time
                         
                         # 计算实时速度（每秒更新）
-                        if current_time - last_speed_update_time >= 1.0 and speed_callback:
-                            time_diff = current_time - last_speed_update_time
-                            size_diff = downloaded_size - last_downloaded_size
-                            if time_diff > 0:
-                                current_speed_bps = size_diff / time_diff
-                                current_speed_mbps = current_speed_bps * 8 / 1_000_000
-                                current_speed_mbs = current_speed_bps / (1024 * 1024)
-                                speed_callback(source_id, current_speed_mbps, current_speed_mbs, current_time - start_time)
-                            
-                            last_speed_update_time = current_time
-                            last_downloaded_size = downloaded_size
-            
-            end_time = time.time()
-            download_time = end_time - start_time
-            
-            if download_time > 0:
-                speed_bps = downloaded_size / download_time
+                        current_speed_bps = meter.update(downloaded_size, current_time)
+                        if current_speed_bps is not None and speed_callback:
+                            current_speed_mbps = current_speed_bps * 8 / 1_000_000
+                            current_speed_mbs = current_speed_bps / (1024 * 1024)
+                            speed_callback(source_id, current_speed_mbps, current_speed_mbs, current_time - start_time)
+                        
+                        # 达到时长/字节上限或速度已稳定
+                        if meter.stop_reason:
+                            break
+                finally:
+                    # 停止或出错时已收到的字节也计入流量
+                    meter.account(downloaded_size)
+                    if payload_file:
+                        payload_file.close()
+                    response.close()
+                
+                end_time = time.monotonic()
+                download_time = end_time - start_time
+                phases['transfer'] = end_time - headers_time
+                
+                # 速度只统计传输阶段，并排除预热窗口
+                speed_bps, measured_time = meter.result(downloaded_size, end_time)
                 speed_mbps = speed_bps * 8 / 1_000_000  # 转换为Mbps
-                speed_mbs = downloaded_size / download_time / (1024 * 1024)  # 转换为MB/s
-            else:
-                speed_mbps = 0
-                speed_mbs = 0
-            
-            return download_time, speed_mbps, speed_mbs, downloaded_size, "成功"
+                speed_mbs = speed_bps / (1024 * 1024)  # 转换为MB/s
+                
+                if info is not None:
+                    info.update(meter.info())
+                    info['measured_time'] = measured_time
+                    info['phases'] = phases
+                
+                return download_time, speed_mbps, speed_mbs, downloaded_size, "成功"
         
         except requests.exceptions.Timeout:
             return None, None, None, None, "超时(59秒)"
         except Exception as e:
+            if download_state.get('cancelled'):
+                return None, None, None, None, "用户停止"
             logger.error(f"下载文件失败 {url}: {e}")
             return None, None, None, None, f"错误: {str(e)}"
         finally:
             # 移除活跃下载
-            if source_id in active_downloads:
-                del active_downloads[source_id]
+            unregister_download(session, source_id, download_state)
     
     except Exception as e:
         logger.error(f"下载文件异常 {url}: {e}")
         return None, None, None, None, f"异常: {str(e)}"
 
-def stop_all_downloads():
-    """停止所有下载进程"""
-    for source_id in list(active_downloads.keys()):
-        active_downloads[source_id]['active'] = False
-    logger.info("已停止所有下载进程")
+def warm_up_connections(url, count=1, timeout=10):
+    """用HEAD请求预先建立连接并放回连接池
 
-def clean_temp_dir():
-    """清理临时目录"""
+    count 个请求同时发出，各自占用一个连接，结束后连接池中就有 count 个已完成握手的连接。
+    """
+    def warm_up():
+        try:
+            http_session.head(url, headers=DOWNLOAD_HEADERS, timeout=timeout, allow_redirects=True)
+        except Exception as e:
+            logger.warning(f"预先建立连接失败 {url}: {e}")
+    
+    if count <= 1:
+        warm_up()
+        return
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=count) as executor:
+        for _ in range(count):
+            # 线程池中的线程不继承地址限制
+            executor.submit(contextvars.copy_context().run, warm_up)
+
+def normalize_buffer_size(buffer_size):
+    """将接收缓冲区大小限制在允许范围内"""
     try:
-        for filename in os.listdir(TEMP_DIR):
-            file_path = os.path.join(TEMP_DIR, filename)
+        buffer_size = int(buffer_size or DEFAULT_BUFFER_SIZE)
+    except (TypeError, ValueError):
+        buffer_size = DEFAULT_BUFFER_SIZE
+    return max(MIN_BUFFER_SIZE, min(MAX_BUFFER_SIZE, buffer_size))
+
+def get_raw_reader(response):
+    """获取直接读入缓冲区的readinto方法
+
+    优先使用底层 http.client 响应的 readinto，数据从socket直接写入缓冲区，
+    避免 urllib3 每次读取时额外分配和复制 bytes；拿不到时退回 urllib3 的 readinto。
+    """
+    fp = getattr(response.raw, '_fp', None)
+    if fp is not None and hasattr(fp, 'readinto'):
+        return fp.readinto
+    return response.raw.readinto
+
+def probe_range_support(url, timeout=10):
+    """探测服务器是否支持Range分段下载
+
+    返回 (文件总大小, 最终URL)，不支持时文件总大小为 None
+    """
+    headers = dict(DOWNLOAD_HEADERS)
+    headers['Range'] = 'bytes=0-0'
+    try:
+        response = http_session.get(url, headers=headers, timeout=timeout, stream=True, allow_redirects=True)
+        content_range = response.headers.get('Content-Range', '')
+        if response.status_code == 206 and '/' in content_range:
+            # 只有1字节，读完后连接回到连接池供下载复用
+            response.content
+            size_bytes = int(content_range.split('/')[-1])
+            if size_bytes > 0:
+                return size_bytes, response.url
+        else:
+            # 服务器忽略Range时会返回完整文件，直接关闭连接
+            response.close()
+    except Exception as e:
+        logger.warning(f"探测分段下载支持失败 {url}: {e}")
+    return None, url
+
+def download_segment(url, start, end, buffer_size, download_state, counters, index, errors, header_times, file_path=None, timeout=159, segment_phases=None):
+    """下载一个Range分段，已下载字节数累加到 counters[index]，收到响应头的时间记入 header_times
+
+    提供 segment_phases 时把 (收到响应头的时间, 阶段耗时) 记入其中。
+    """
+    headers = dict(DOWNLOAD_HEADERS)
+    headers['Range'] = f'bytes={start}-{end}'
+    try:
+        with tracked_connections(download_state):
+            request_start = time.monotonic()
+            response = http_session.get(url, headers=headers, timeout=timeout, stream=True, allow_redirects=True)
+            headers_time = time.monotonic()
+            header_times.append(headers_time)
+            if segment_phases is not None:
+                segment_phases.append((headers_time, get_phase_timings(response, request_start, headers_time)))
             try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-            except Exception as e:
-                logger.error(f"删除临时文件失败 {file_path}: {e}")
-        logger.info("临时目录清理完成")
-        return True
+                if response.status_code != 206:
+                    errors.append(RANGE_UNSUPPORTED_STATUS)
+                    download_state['active'] = False
+                    return
+                
+                buffer = memoryview(bytearray(normalize_buffer_size(buffer_size)))
+                readinto = get_raw_reader(response)
+                payload_file = None
+                if file_path:
+                    payload_file = open(file_path, 'r+b')
+                    payload_file.seek(start)
+                
+                try:
+                    while download_state['active']:
+                        received = readinto(buffer)
+                        if not received:
+                            break
+                        if payload_file:
+                            payload_file.write(buffer[:received])
+                        counters[index] += received
+                finally:
+                    if payload_file:
+                        payload_file.close()
+            finally:
+                response.close()
+    except requests.exceptions.Timeout:
+        errors.append("超时(59秒)")
+        download_state['active'] = False
     except Exception as e:
-        logger.error(f"清理临时目录失败: {e}")
-        return False
+        # 停止测试时连接被关闭，不算作错误
+        if not download_state.get('cancelled'):
+            errors.append(f"错误: {str(e)}")
+        download_state['active'] = False
+
+def preallocate_file(file_path, size):
+    """创建 size 字节的文件，多连接下载的各分段写入自己的位置"""
+    with open(file_path, 'wb') as f:
+        f.truncate(size)
 
-def save_test_result(test_id, results):
-    """保存测试结果"""
+def download_file_multi(source_id, url, total_size, connections, file_path=None, progress_callback=None, speed_callback=None, downloaded_size_callback=None, buffer_size=None, options=None, info=None, session=None):
+    """多连接下载 - 按Range将文件切分为多段并行下载，汇总为一个速度
+
+    返回值与 download_file 相同；某个分段未返回206时状态为 RANGE_UNSUPPORTED_STATUS。
+    """
+    if (options or {}).get('warm_connection'):
+        warm_up_connections(url, connections)
+    
+    start_time = time.monotonic()
+    timeout = 159
+    
+    download_state = {
+        'start_time': start_time,
+        'active': True,
+        'sockets': set()
+    }
+    register_download(session, source_id, download_state)
+    
     try:
-        result_file = os.path.join(RESULT_DIR, f"{test_id}_测试结果.txt")
-        
-        # 计算平均速度
-        valid_results_mbps = []
-        valid_results_mbs = []
-        calculation_steps = []
+        if file_path:
+            preallocate_file(file_path, total_size)
         
-        for result in results.values():
-            if result['status'] == '成功' and result['time'] is not None:
-                valid_results_mbps.append(result['speed_mbps'])
-                valid_results_mbs.append(result['speed_mbs'])
+        # 切分Range，最后一段包含余数；有字节上限时只请求上限以内的部分，
+        # 各分段自然结束，不会因汇总间隔多下载
+        max_bytes = int((options or {}).get('max_bytes') or 0)
+        span = min(total_size, max(max_bytes, connections)) if max_bytes else total_size
+        segment_size = span // connections
+        counters = [0] * connections
+        errors = []
+        header_times = []
+        segment_phases = []
+        threads = []
+        for index in range(connections):
+            start = index * segment_size
+            end = span - 1 if index == connections - 1 else start + segment_size - 1
+            # 分段线程沿用当前的地址限制
+            thread = threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(download_segment, url, start, end, buffer_size, download_state, counters, index, errors, header_times, file_path, timeout, segment_phases)
+            )
+            thread.daemon = True
+            threads.append(thread)
+        for thread in threads:
+            thread.start()
         
-        current_time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # 速度只统计传输阶段，从第一个分段收到响应头开始
+        meter = None
+        status = "成功"
+        # 汇总间隔不超过时间序列的采样间隔
+        monitor_interval = min(0.25, max(MIN_SAMPLE_INTERVAL, float((options or {}).get('sample_interval') or DEFAULT_SAMPLE_INTERVAL)))
         
-        if valid_results_mbps:
-            calculation_steps.append(f"计算时间: {current_time_str}")
-            calculation_steps.append(f"有效测试源数量: {len(valid_results_mbps)}")
+        # 主线程只负责汇总进度和速度
+        while True:
+            alive_threads = [thread for thread in threads if thread.is_alive()]
+            if not alive_threads:
+                break
+            alive_threads[0].join(monitor_interval)
+            current_time = time.monotonic()
+            downloaded_size = sum(counters)
             
-            if len(valid_results_mbps) > 2:
-                # 去掉最高和最低值
-                sorted_mbps = sorted(valid_results_mbps)
-                sorted_mbs = sorted(valid_results_mbs)
-                
-                calculation_steps.append(f"原始速度数据(Mbps): {[round(s, 2) for s in sorted_mbps]}")
-                calculation_steps.append(f"去掉最高值: {round(sorted_mbps[-1], 2)} Mbps")
-                calculation_steps.append(f"去掉最低值: {round(sorted_mbps[0], 2)} Mbps")
-                
-                valid_results_mbps = sorted_mbps[1:-1]
-                valid_results_mbs = sorted_mbs[1:-1]
-                
-                calculation_steps.append(f"处理后速度数据(Mbps): {[round(s, 2) for s in valid_results_mbps]}")
-            else:
-                calculation_steps.append(f"速度数据(Mbps): {[round(s, 2) for s in valid_results_mbps]}")
-                calculation_steps.append("数据不足3个，不去除极值")
+            if not download_state['active'] and not errors and not (meter and meter.stop_reason):
+                status = "用户停止"
+                break
             
-            avg_speed_mbps = sum(valid_results_mbps) / len(valid_results_mbps)
-            avg_speed_mbs = sum(valid_results_mbs) / len(valid_results_mbs)
+            if current_time - start_time > timeout:
+                download_state['active'] = False
+                # 卡住的分段不会再检查标志，直接关闭连接
+                for sock in list(download_state['sockets']):
+                    shutdown_socket(sock)
+                status = "超时(59秒)"
+                break
             
-            calculation_steps.append(f"平均下载速度: {avg_speed_mbps:.2f} Mbps / {avg_speed_mbs:.2f} MB/s")
-        else:
-            calculation_steps.append(f"计算时间: {current_time_str}")
-            calculation_steps.append("无有效测试结果")
-            avg_speed_mbps = 0
-            avg_speed_mbs = 0
+            if meter is None:
+                if not header_times:
+                    continue
+                meter = ThroughputMeter(min(header_times), options)
+                if session is not None:
+                    session.add_meter(source_id, meter)
+            
+            if downloaded_size_callback:
+                downloaded_size_callback(source_id, downloaded_size)
+            if progress_callback:
+                progress_callback(source_id, meter.progress(downloaded_size, total_size, current_time))
+            
+            current_speed_bps = meter.update(downloaded_size, current_time)
+            if current_speed_bps is not None and speed_callback:
+                speed_callback(source_id, current_speed_bps * 8 / 1_000_000, current_speed_bps / (1024 * 1024), current_time - start_time)
+            
+            # 达到时长/字节上限或速度已稳定，通知所有分段停止
+            if meter.stop_reason:
+                download_state['active'] = False
         
-        # 生成计算过程字符串
-        global calculation_process, last_update_time
-        calculation_process = "\n".join(calculation_steps)
-        last_update_time = current_time_str
+        # 分段都在第一次汇总前结束时补建 ThroughputMeter；停止或出错时已收到的字节也计入流量
+        if meter is None and header_times:
+            meter = ThroughputMeter(min(header_times), options)
+            if session is not None:
+                session.add_meter(source_id, meter)
+        if meter is not None:
+            meter.account(sum(counters))
+            if span < total_size and not meter.stop_reason:
+                meter.stop_reason = '达到字节上限'
         
-        with open(result_file, 'w', encoding='utf-8') as f:
-            f.write(f"测速测试结果 - {test_id}\n")
-            f.write("=" * 50 + "\n\n")
-            
+        if status == "成功" and download_state.get('cancelled'):
+            status = "用户停止"
+        if status != "成功":
+            return None, None, None, None, status
+        if errors:
+            return None, None, None, None, errors[0]
+        
+        end_time = time.monotonic()
+        download_time = end_time - start_time
+        downloaded_size = sum(counters)
+        
+        if meter is None:
+            meter = ThroughputMeter(min(header_times) if header_times else start_time, options)
+        speed_bps, measured_time = meter.result(downloaded_size, end_time)
+        speed_mbps = speed_bps * 8 / 1_000_000
+        speed_mbs = speed_bps / (1024 * 1024)
+        
+        if info is not None:
+            info.update(meter.info())
+            info['measured_time'] = measured_time
+            # 阶段耗时取最先收到响应头的分段，传输时间为多连接的传输阶段
+            if segment_phases:
+                phases = dict(min(segment_phases, key=lambda item: item[0])[1])
+                phases['transfer'] = end_time - meter.start_time
+                info['phases'] = phases
+        
+        return download_time, speed_mbps, speed_mbs, downloaded_size, "成功"
+    
+    except Exception as e:
+        logger.error(f"多连接下载异常 {url}: {e}")
+        return None, None, None, None, f"异常: {str(e)}"
+    finally:
+        download_state['active'] = False
+        unregister_download(session, source_id, download_state)
+
+def upload_file(source_id, url, progress_callback=None, speed_callback=None, uploaded_size_callback=None, buffer_size=None, options=None, info=None, session=None):
+    """上传测试 - 把内存中生成的数据以 POST/PUT 发送到 url，增加159秒超时，可中断
+
+    数据来自只生成一次的随机内容缓冲区，每块直接从缓冲区发送，不写临时文件，也不为每块分配内存；
+    默认使用分块传输编码（upload_chunked 为 False 时发送 Content-Length）。上传 upload_bytes 字节，
+    时长/字节上限和稳定提前停止与下载相同；Content-Length 模式无法提前结束请求，只在开始前按字节上限
+    减少上传字节数。回调和返回值与 download_file 相同，已上传字节数通过 uploaded_size_callback 报告；
+    速度从请求头发出开始计算，到收到服务器响应为止，不包含仍在发送缓冲区中的数据。
+    """
+    options = options or {}
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return None, None, None, None, f"错误: 不支持的上传地址 {url}"
+    
+    method = options.get('upload_method', 'POST')
+    total_size = int(options.get('upload_bytes') or 0)
+    chunked = options.get('upload_chunked', True)
+    if not chunked and options.get('max_bytes'):
+        total_size = min(total_size, int(options['max_bytes']))
+    start_time = time.monotonic()
+    timeout = 159
+    
+    download_state = {
+        'start_time': start_time,
+        'active': True,
+        'sockets': set()
+    }
+    register_download(session, source_id, download_state)
+    connection = None
+    
+    try:
+        with tracked_connections(download_state):
+            # 使用与下载相同的连接类记录建立连接的阶段耗时，请求体由下面自己发送
+            if parsed.scheme == 'https':
+                connection = TimedHTTPSConnection(parsed.hostname, parsed.port, timeout=timeout, cert_reqs='CERT_REQUIRED', ca_certs=DEFAULT_CA_BUNDLE_PATH)
+            else:
+                connection = TimedHTTPConnection(parsed.hostname, parsed.port, timeout=timeout)
+            connection.connect()
+            
+            connection.putrequest(method, (parsed.path or '/') + (f"?{parsed.query}" if parsed.query else ''), skip_accept_encoding=True)
+            connection.putheader('User-Agent', DOWNLOAD_HEADERS['User-Agent'])
+            connection.putheader('Accept', '*/*')
+            connection.putheader('Content-Type', 'application/octet-stream')
+            if chunked:
+                connection.putheader('Transfer-Encoding', 'chunked')
+            else:
+                connection.putheader('Content-Length', str(total_size))
+            connection.endheaders()
+            headers_time = time.monotonic()
+            
+            timings = connection.phase_timings or {'dns': 0.0, 'connect': 0.0, 'tls': None, 'address': None}
+            phases = {'dns': timings['dns'], 'connect': timings['connect'], 'tls': timings['tls'], 'reused': False, 'address': timings['address']}
+            meter = ThroughputMeter(headers_time, options)
+            if session is not None:
+                session.add_meter(source_id, meter)
+            
+            # 发送缓冲区只生成一次，随机内容避免被中间设备压缩
+            buffer = memoryview(os.urandom(normalize_buffer_size(buffer_size)))
+            uploaded_size = 0
+            last_progress_time = start_time
+            
+            while uploaded_size < total_size:
+                count = min(len(buffer), total_size - uploaded_size)
+                if chunked:
+                    connection.send(b'%X\r\n' % count)
+                    connection.send(buffer[:count])
+                    connection.send(b'\r\n')
+                else:
+                    connection.send(buffer[:count])
+                uploaded_size += count
+                
+                current_time = time.monotonic()
+                
+                if not download_state['active']:
+                    return None, None, None, None, "用户停止"
+                
+                if current_time - start_time > timeout:
+                    return None, None, None, None, "超时(59秒)"
+                
+                if uploaded_size_callback:
+                    uploaded_size_callback(source_id, uploaded_size)
+                
+                if current_time - last_progress_time > 0.25 and progress_callback:
+                    progress_callback(source_id, meter.progress(uploaded_size, total_size, current_time))
+                    last_progress_time = current_time
+                
+                current_speed_bps = meter.update(uploaded_size, current_time)
+                if current_speed_bps is not None and speed_callback:
+                    current_speed_mbps = current_speed_bps * 8 / 1_000_000
+                    current_speed_mbs = current_speed_bps / (1024 * 1024)
+                    speed_callback(source_id, current_speed_mbps, current_speed_mbs, current_time - start_time)
+                
+                if meter.stop_reason and chunked:
+                    break
+            
+            if chunked:
+                connection.send(b'0\r\n\r\n')
+            # 等待服务器收完数据并响应；urllib3 的 getresponse 只能用于它自己发出的请求
+            sent_time = time.monotonic()
+            response = http.client.HTTPConnection.getresponse(connection)
+            # 上传的首字节时间为发完数据到收到响应头的时间
+            phases['ttfb'] = time.monotonic() - sent_time
+            response.read()
+            if response.status >= 400:
+                return None, None, None, None, f"错误: HTTP {response.status} {response.reason}"
+            
+            end_time = time.monotonic()
+            upload_time = end_time - start_time
+            phases['transfer'] = end_time - headers_time
+            
+            speed_bps, measured_time = meter.result(uploaded_size, end_time)
+            speed_mbps = speed_bps * 8 / 1_000_000
+            speed_mbs = speed_bps / (1024 * 1024)
+            
+            if info is not None:
+                info.update(meter.info())
+                info['measured_time'] = measured_time
+                info['phases'] = phases
+            
+            return upload_time, speed_mbps, speed_mbs, uploaded_size, "成功"
+    
+    except (socket.timeout, TimeoutError):
+        return None, None, None, None, "超时(59秒)"
+    except Exception as e:
+        if download_state.get('cancelled'):
+            return None, None, None, None, "用户停止"
+        logger.error(f"上传失败 {url}: {e}")
+        return None, None, None, None, f"错误: {str(e)}"
+    finally:
+        if connection is not None:
+            connection.close()
+        unregister_download(session, source_id, download_state)
+
+def measurement_halted(session):
+    """测试已被停止或已达到测试流量上限，不再开始新的测量"""
+    return session is not None and (session.stop_requested or session.byte_limit_reached)
+
+def register_download(session, source_id, download_state):
+    """登记活跃下载，停止测试时通过它中断下载"""
+    if session is not None:
+        session.register_download(source_id, download_state)
+    else:
+        active_downloads[source_id] = download_state
+
+def unregister_download(session, source_id, download_state):
+    """移除活跃下载"""
+    if session is not None:
+        session.unregister_download(source_id, download_state)
+    elif active_downloads.get(source_id) is download_state:
+        del active_downloads[source_id]
+
+def measure_source(source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback, options, session=None):
+    """按测试选项测量一个源，连接遵守 address_family 和 pin_addresses 的限制
+
+    per_address 为真时对源主机的每个地址分别测量（见 measure_per_address），否则测量一次（见 measure_source_once）。
+    """
+    pin = source_address_pin(source_id, url, options)
+    with address_pinned(pin):
+        if options.get('per_address'):
+            final_url = url if options.get('direction') == 'upload' else probe_source(url).get('final_url') or url
+            addresses, final_url = plan_address_runs(url, pin, final_url)
+            runs = []
+            for family, address in addresses:
+                if measurement_halted(session):
+                    break
+                with address_pinned({'host': urlparse(final_url).hostname, 'address': address, 'family': family}):
+                    measured = measure_source_once(
+                        source_id, final_url, file_path, progress_callback, speed_callback, downloaded_size_callback, options, session
+                    )
+                runs.append((family, address, measured, session.series.get(source_id) if session is not None else None))
+            return combine_address_runs(source_id, runs, session)
+        return measure_source_once(source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback, options, session)
+
+def plan_address_runs(url, pin, final_url):
+    """按地址测量时要测量的 [(地址族, IP)] 和测量使用的URL
+
+    测量重定向后的最终URL，地址为其主机的全部 A/AAAA 记录（受 address_family 限制）；
+    pin_addresses 为该源指定了IP时只测量这个IP。上传测试直接使用上传地址。
+    """
+    if pin is not None and pin['address']:
+        return [(pin['family'], pin['address'])], url
+    host = urlparse(final_url).hostname
+    try:
+        addresses = socket.getaddrinfo(host, None, pin['family'] if pin else 0, socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        logger.warning(f"解析 {host} 失败: {e}")
+        return [], final_url
+    return distinct_addresses(addresses), final_url
+
+def combine_address_runs(source_id, runs, session):
+    """合并按地址测量的结果 [(地址族, IP, 测量结果, 时间序列)]
+
+    源的结果取解析顺序中第一个测量成功的地址（都失败时取第一个地址），时间序列也使用该地址的曲线；
+    每个地址的状态和速度列在附加信息的 addresses 中，pinned_address 为源的结果所用的地址。
+    """
+    if not runs:
+        return None, None, None, None, "没有可用的地址", {'connections': 1, 'addresses': []}
+    addresses = [{
+        'address': address,
+        'family': address_family_name(family),
+        'status': measured[4],
+        'speed_mbps': measured[1] or 0,
+        'speed_mbs': measured[2] or 0,
+        'downloaded_size': measured[3] or 0,
+        'time': measured[0]
+    } for family, address, measured, _ in runs]
+    chosen = next((run for run in runs if run[2][4] == '成功'), runs[0])
+    _, address, measured, series = chosen
+    if series is not None:
+        session.series[source_id] = series
+    extra = dict(measured[5], addresses=addresses, pinned_address=address)
+    return measured[:5] + (extra,)
+
+def measure_source_once(source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback, options, session=None):
+    """按测试选项测量一个源一次
+
+    connections 大于1时先进行单连接测试，再进行多连接测试，两个速度都记录在返回的附加信息中，
+    最终速度取多连接结果；服务器不支持Range(未返回206)时只保留单连接结果。
+    """
+    connections = max(1, int(options.get('connections') or 1))
+    buffer_size = options.get('buffer_size')
+    
+    if options.get('direction') == 'upload':
+        # 上传测试只使用一个连接，url 为上传地址
+        extra = {'connections': 1, 'direction': 'upload'}
+        result = upload_file(
+            source_id, url, progress_callback, speed_callback, downloaded_size_callback,
+            buffer_size=buffer_size, options=options, info=extra, session=session
+        )
+        return result + (extra,)
+    
+    extra = {'connections': 1}
+    result = download_file(
+        source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback,
+        buffer_size=buffer_size, options=options, info=extra, session=session
+    )
+    if connections == 1 or result[4] != '成功' or measurement_halted(session):
+        return result + (extra,)
+    
+    extra['single_stream_speed_mbps'] = result[1]
+    extra['single_stream_speed_mbs'] = result[2]
+    
+    total_size, final_url = probe_range_support(url)
+    if not total_size or total_size < connections:
+        logger.info(f"{source_id} 服务器不支持分段下载，使用单连接结果")
+        extra['multi_stream_status'] = RANGE_UNSUPPORTED_STATUS
+        return result + (extra,)
+    
+    single_series = session.series.get(source_id) if session is not None else None
+    multi_info = {}
+    multi_result = download_file_multi(
+        source_id, final_url, total_size, connections, file_path,
+        progress_callback, speed_callback, downloaded_size_callback,
+        buffer_size=buffer_size, options=options, info=multi_info, session=session
+    )
+    return merge_multi_result(source_id, result, multi_result, multi_info, extra, connections, single_series, session)
+
+def merge_multi_result(source_id, result, multi_result, multi_info, extra, connections, single_series, session):
+    """合并单连接和多连接的测量结果，多连接不可用时保留单连接结果"""
+    extra['multi_stream_status'] = multi_result[4]
+    if multi_result[4] == RANGE_UNSUPPORTED_STATUS:
+        logger.info(f"{source_id} 分段请求未返回206，使用单连接结果")
+        # 时间序列与最终速度保持一致，使用单连接的曲线
+        if single_series is not None:
+            session.series[source_id] = single_series
+        return result + (extra,)
+    if multi_result[4] == '成功':
+        # 阶段耗时与速度一样以多连接为准，不保留单连接的
+        extra.pop('phases', None)
+        extra.update(multi_info)
+        extra['connections'] = connections
+        extra['multi_stream_speed_mbps'] = multi_result[1]
+        extra['multi_stream_speed_mbs'] = multi_result[2]
+    return multi_result + (extra,)
+
+class LatencyProber:
+    """测量到一个源主机的往返时延：每次采样建立一个TCP连接，连接耗时约为一个RTT
+
+    测试前测量空闲延迟，下载期间在后台线程中持续测量负载延迟，两者的差反映缓冲膨胀（bufferbloat）。
+    地址只解析一次（遵守 pin 的地址限制，见 address_pinned），采样不包含DNS时间；连接失败或超时记为丢失（None）。
+    负载采样在单独的线程中进行，异步引擎下也不受事件循环繁忙程度的影响。
+    """
+    
+    def __init__(self, url, timeout=LATENCY_PROBE_TIMEOUT, pin=None):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        self.timeout = timeout
+        self.pin = pin
+        self.address = None
+        self.idle = []  # 空闲延迟采样（秒）
+        self.loaded = []  # 负载延迟采样（秒）
+        self.stop_event = threading.Event()
+    
+    def resolve(self):
+        if self.address is None:
+            lookup_host, family = pinned_lookup(self.host, self.pin)
+            family, _, _, _, address = socket.getaddrinfo(lookup_host, self.port, family, socket.SOCK_STREAM)[0]
+            self.address = (family, address)
+        return self.address
+    
+    def sample(self):
+        """建立一次TCP连接，返回连接耗时（秒），失败时返回 None"""
+        try:
+            family, address = self.resolve()
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(self.timeout)
+                start = time.perf_counter()
+                sock.connect(address)
+                return time.perf_counter() - start
+            finally:
+                sock.close()
+        except OSError:
+            return None
+    
+    def measure_idle(self, count, should_stop=None):
+        """采样 count 次空闲延迟；连续两次失败（主机不可达）或 should_stop() 为真时提前结束"""
+        for index in range(count):
+            if should_stop and should_stop():
+                break
+            if index:
+                time.sleep(LATENCY_IDLE_INTERVAL)
+            self.idle.append(self.sample())
+            if self.idle[-2:] == [None, None]:
+                break
+    
+    def start_loaded(self, interval):
+        """在后台线程中每隔 interval 秒采样一次负载延迟，直到 stop_loaded"""
+        def run():
+            while not self.stop_event.wait(interval):
+                self.loaded.append(self.sample())
+        
+        self.stop_event.clear()
+        probe_thread = threading.Thread(target=run)
+        probe_thread.daemon = True
+        probe_thread.start()
+    
+    def stop_loaded(self):
+        # 不等待线程结束，正在进行的采样最多再追加一个结果
+        self.stop_event.set()
+    
+    def summary(self):
+        """空闲/负载延迟统计（毫秒），bufferbloat_ms 为负载与空闲中位数之差"""
+        idle = latency_stats(self.idle)
+        loaded = latency_stats(self.loaded)
+        bufferbloat = loaded['p50_ms'] - idle['p50_ms'] if 'p50_ms' in idle and 'p50_ms' in loaded else None
+        return {
+            'method': 'tcp_connect',
+            'host': self.host,
+            'address': self.address[1][0] if self.address else None,
+            'port': self.port,
+            'idle': idle,
+            'loaded': loaded,
+            'bufferbloat_ms': bufferbloat
+        }
+
+def latency_stats(samples):
+    """延迟采样（秒，丢失为 None）的统计，单位毫秒
+
+    抖动为相邻两次成功采样之差的绝对值的平均值。
+    """
+    values = [sample * 1000 for sample in list(samples) if sample is not None]
+    stats = {'count': len(samples), 'lost': len(samples) - len(values)}
+    if not values:
+        return stats
+    ordered = sorted(values)
+    stats.update({
+        'min_ms': ordered[0],
+        'p50_ms': percentile(ordered, 50),
+        'p90_ms': percentile(ordered, 90),
+        'p99_ms': percentile(ordered, 99),
+        'max_ms': ordered[-1],
+        'jitter_ms': sum(abs(b - a) for a, b in zip(values, values[1:])) / (len(values) - 1) if len(values) > 1 else 0.0
+    })
+    return stats
+
+def measure_idle_latency(session):
+    """测试开始前并发测量所有源的空闲延迟，探测器存入 session.latency"""
+    options = session.options
+    urls = {}
+    with sources_lock:
+        for source_id in session.sources:
+            source = download_sources.get(source_id)
+            url = source and (source.get('upload_url') if options['direction'] == 'upload' else source['url'])
+            if url:
+                urls[source_id] = url
+    if not urls:
+        return
+    
+    probers = {
+        source_id: LatencyProber(url, pin=source_address_pin(source_id, url, options))
+        for source_id, url in urls.items()
+    }
+    samples = int(options['latency_samples'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(probers))) as executor:
+        for prober in probers.values():
+            executor.submit(prober.measure_idle, samples, lambda: session.stop_requested)
+    with session.lock:
+        session.latency.update(probers)
+    logger.info(f"空闲延迟测量完成，共 {len(probers)} 个源")
+
+@contextlib.contextmanager
+def tracked_connections(download_state):
+    """期间当前线程建立的连接都登记到 download_state['sockets']，结束后移除
+
+    移除是必要的：连接结束后会回到连接池，之后可能被其他下载复用。
+    """
+    created = []
+    previous = getattr(download_context, 'tracking', None)
+    download_context.tracking = (download_state, created)
+    try:
+        yield
+    finally:
+        download_context.tracking = previous
+        download_state['sockets'].difference_update(created)
+
+def track_socket(sock):
+    """登记当前线程新建（或复用）的连接，所属下载已被取消时立即关闭"""
+    tracking = getattr(download_context, 'tracking', None)
+    if tracking is None or sock is None:
+        return
+    download_state, created = tracking
+    download_state['sockets'].add(sock)
+    created.append(sock)
+    if download_state.get('cancelled'):
+        shutdown_socket(sock)
+
+def shutdown_socket(sock):
+    """关闭连接的读写，阻塞在 recv 上的线程会立即返回"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def cancel_download(download_state):
+    """立即中断一个下载或一次验证
+
+    线程下载直接关闭登记的连接，阻塞中的读取马上出错返回；异步下载取消对应的协程。
+    """
+    download_state['active'] = False
+    download_state['cancelled'] = True
+    for sock in list(download_state.get('sockets', ())):
+        shutdown_socket(sock)
+    cancel = download_state.get('cancel')
+    if cancel is not None:
+        cancel()
+
+class AsyncEngine:
+    """异步引擎：在单独的线程中运行事件循环，验证和下载以协程的形式提交到这里
+
+    同时进行的请求总数和每个主机的请求数都由信号量限制，上百个源也只占用一个线程；
+    停止下载时直接取消对应的协程，不需要在读取循环中轮询标志。
+    """
+    
+    def __init__(self, max_connections=ASYNC_MAX_CONNECTIONS, per_host=ASYNC_PER_HOST_CONNECTIONS):
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.loop = None
+        self.connection_limit = None
+        self.host_limits = {}
+        self.ssl_context = None
+    
+    def start(self):
+        """第一次使用时启动事件循环线程"""
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='async-engine')
+                thread.daemon = True
+                thread.start()
+                self.loop = loop
+            return self.loop
+    
+    def run(self, coroutine):
+        """在事件循环中运行协程并等待结果，只能在事件循环线程以外调用"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.start()).result()
+    
+    def get_ssl_context(self):
+        # 加载证书较慢，所有连接共用一个
+        if self.ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        return self.ssl_context
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, host):
+        """占用该主机的一个名额和一个全局名额，先等主机名额，避免排队时占住全局名额"""
+        if self.connection_limit is None:
+            self.connection_limit = asyncio.Semaphore(self.max_connections)
+        host_limit = self.host_limits.get(host)
+        if host_limit is None:
+            host_limit = self.host_limits[host] = asyncio.Semaphore(self.per_host)
+        async with host_limit:
+            async with self.connection_limit:
+                yield
+
+async_engine = AsyncEngine()
+
+class AsyncHTTPResponse:
+    """异步引擎的HTTP响应，响应头已读完，响应体按 Content-Length、chunked 或读到连接关闭为止"""
+    
+    def __init__(self, url, status_code, headers, reader, writer, method, headers_time, phases):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+        self.headers_time = headers_time
+        self.phases = phases
+        self.chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        self.chunk_left = 0
+        length = headers.get('Content-Length', '')
+        self.remaining = int(length) if length.isdigit() and not self.chunked else None
+        self.done = method == 'HEAD' or status_code in (204, 304)
+    
+    async def read(self, size):
+        """读取最多 size 字节的响应体，读完时返回 b''"""
+        if self.done:
+            return b''
+        
+        if self.chunked:
+            if self.chunk_left == 0:
+                line = await self.reader.readline()
+                chunk_size = int(line.split(b';')[0].strip() or b'0', 16)
+                if chunk_size == 0:
+                    self.done = True
+                    return b''
+                self.chunk_left = chunk_size
+            data = await self.reader.read(min(size, self.chunk_left))
+            if not data:
+                raise ConnectionError('响应体不完整，连接已关闭')
+            self.chunk_left -= len(data)
+            if self.chunk_left == 0:
+                await self.reader.readexactly(2)
+            return data
+        
+        if self.remaining is not None:
+            if self.remaining == 0:
+                self.done = True
+                return b''
+            data = await self.reader.read(min(size, self.remaining))
+            if not data:
+                raise ConnectionError('响应体不完整，连接已关闭')
+            self.remaining -= len(data)
+            return data
+        
+        data = await self.reader.read(size)
+        if not data:
+            self.done = True
+        return data
+    
+    def close(self):
+        self.writer.close()
+
+async def async_send_request(url, method, headers, buffer_size):
+    """建立新连接发送一次请求并读取响应头，记录DNS解析、TCP连接和TLS握手的耗时，连接遵守当前的地址限制"""
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https'):
+        raise ValueError(f"不支持的协议: {parsed.scheme}")
+    host = parsed.hostname
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    loop = asyncio.get_running_loop()
+    lookup_host, family = pinned_lookup(host, address_pin.get())
+    
+    dns_start = time.monotonic()
+    addresses = await loop.getaddrinfo(lookup_host, port, family=family, type=socket.SOCK_STREAM)
+    connect_start = time.monotonic()
+    
+    # 逐个尝试解析到的地址
+    last_error = None
+    for address in addresses:
+        try:
+            reader, writer = await asyncio.open_connection(address[4][0], port, limit=buffer_size)
+            break
+        except OSError as e:
+            last_error = e
+    else:
+        raise last_error or ConnectionError(f"无法连接 {host}")
+    phases = {
+        'dns': connect_start - dns_start,
+        'connect': time.monotonic() - connect_start,
+        'tls': None,
+        'reused': False,
+        'address': address[4][0]
+    }
+    
+    try:
+        if parsed.scheme == 'https':
+            tls_start = time.monotonic()
+            await writer.start_tls(async_engine.get_ssl_context(), server_hostname=host)
+            phases['tls'] = time.monotonic() - tls_start
+        
+        # 每个请求使用独立的连接，读完即关闭
+        path = (parsed.path or '/') + (f"?{parsed.query}" if parsed.query else '')
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {parsed.netloc.rpartition('@')[2]}"]
+        lines.extend(f"{name}: {value}" for name, value in headers.items() if name.lower() not in ('host', 'connection'))
+        lines.append('Connection: close')
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        await writer.drain()
+        
+        head = await reader.readuntil(b'\r\n\r\n')
+        headers_time = time.monotonic()
+        status_line, *header_lines = head.decode('latin-1').split('\r\n')
+        status_code = int(status_line.split(' ', 2)[1])
+        response_headers = CaseInsensitiveDict()
+        for line in header_lines:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                response_headers[name.strip()] = value.strip()
+    except BaseException:
+        writer.close()
+        raise
+    
+    return AsyncHTTPResponse(url, status_code, response_headers, reader, writer, method, headers_time, phases)
+
+async def async_open(url, method='GET', headers=None, buffer_size=DEFAULT_BUFFER_SIZE):
+    """发送请求并自动跟随重定向，返回最终的 AsyncHTTPResponse
+
+    phases 中的首字节时间与 get_phase_timings 一致：从发出第一个请求到收到最终响应头，
+    减去最终连接的握手时间。
+    """
+    request_start = time.monotonic()
+    for _ in range(ASYNC_MAX_REDIRECTS + 1):
+        response = await async_send_request(url, method, headers or {}, buffer_size)
+        location = response.headers.get('Location')
+        if response.status_code in (301, 302, 303, 307, 308) and location:
+            response.close()
+            url = urljoin(url, location)
+            if response.status_code == 303 and method != 'HEAD':
+                method = 'GET'
+            continue
+        
+        phases = response.phases
+        handshake_time = phases['dns'] + phases['connect'] + (phases['tls'] or 0)
+        phases['ttfb'] = max(0.0, response.headers_time - request_start - handshake_time)
+        return response
+    raise ConnectionError(f"重定向次数超过 {ASYNC_MAX_REDIRECTS} 次")
+
+async def async_probe_source(url, timeout=10, use_cache=True):
+    """异步引擎的 probe_source，探测方式和返回值相同"""
+    if use_cache:
+        cached = get_cached_probe(url)
+        if cached:
+            return cached
+    
+    result = new_probe_result(url)
+    headers = dict(PROBE_HEADERS)
+    
+    try:
+        async with async_engine.slot(urlparse(url).hostname or ''):
+            response = await asyncio.wait_for(async_open(url, 'HEAD', headers), timeout)
+            response.close()
+            apply_probe_response(result, response)
+            
+            if not result['valid'] or not result['size_bytes']:
+                # HEAD不被支持或没有返回大小，改用只取1个字节的GET请求
+                headers['Range'] = 'bytes=0-0'
+                response = await asyncio.wait_for(async_open(url, 'GET', headers), timeout)
+                response.close()
+                if response.status_code in [200, 206] or not result['valid']:
+                    apply_probe_response(result, response)
+    
+    except asyncio.TimeoutError:
+        logger.warning(f"探测下载源超时: {url}")
+        result['error'] = '超时'
+    except Exception as e:
+        logger.error(f"探测下载源失败 {url}: {e}")
+        result['error'] = str(e)
+    
+    store_probe(url, result)
+    return result
+
+async def async_probe_many(urls, timeout=10, use_cache=True):
+    """同时探测多个URL，并发数由 async_engine 的信号量限制"""
+    return await asyncio.gather(*(async_probe_source(url, timeout, use_cache) for url in urls), return_exceptions=True)
+
+async def async_probe_range_support(url, timeout=10):
+    """异步引擎的 probe_range_support"""
+    headers = dict(DOWNLOAD_HEADERS)
+    headers['Range'] = 'bytes=0-0'
+    try:
+        response = await asyncio.wait_for(async_open(url, 'GET', headers), timeout)
+        response.close()
+        content_range = response.headers.get('Content-Range', '')
+        if response.status_code == 206 and '/' in content_range:
+            size_bytes = int(content_range.split('/')[-1])
+            if size_bytes > 0:
+                return size_bytes, response.url
+    except Exception as e:
+        logger.warning(f"探测分段下载支持失败 {url}: {e}")
+    return None, url
+
+async def async_download_file(source_id, url, file_path=None, progress_callback=None, speed_callback=None, downloaded_size_callback=None, options=None, info=None, session=None, total_size=None, connections=1):
+    """异步引擎的下载，返回值与 download_file 相同
+
+    total_size 和 connections 都提供且 connections 大于1时按Range分段多连接下载，
+    与 download_file_multi 相同。下载在单独的任务中运行，停止测试时取消该任务，
+    超过159秒同样取消。
+    """
+    start_time = time.monotonic()
+    timeout = 159
+    
+    loop = asyncio.get_running_loop()
+    transfer = asyncio.ensure_future(async_transfer(
+        source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback,
+        options or {}, info, session, start_time, total_size, connections
+    ))
+    download_state = {
+        'start_time': start_time,
+        'active': True,
+        'cancel': lambda: loop.call_soon_threadsafe(transfer.cancel)
+    }
+    register_download(session, source_id, download_state)
+    
+    try:
+        return await asyncio.wait_for(transfer, timeout)
+    except asyncio.TimeoutError:
+        return None, None, None, None, "超时(59秒)"
+    except asyncio.CancelledError:
+        return None, None, None, None, "用户停止"
+    except Exception as e:
+        logger.error(f"下载文件失败 {url}: {e}")
+        return None, None, None, None, f"错误: {str(e)}"
+    finally:
+        unregister_download(session, source_id, download_state)
+
+async def async_transfer(source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback, options, info, session, start_time, total_size, connections):
+    """async_download_file 的下载过程，出错时抛出异常"""
+    buffer_size = normalize_buffer_size(options.get('buffer_size'))
+    multi = bool(total_size) and connections > 1
+    # 回调间隔不超过时间序列的采样间隔
+    report_interval = min(0.25, max(MIN_SAMPLE_INTERVAL, float(options.get('sample_interval') or DEFAULT_SAMPLE_INTERVAL)))
+    state = {'meter': None, 'last_report': start_time, 'stopped': False}
+    
+    def report(downloaded_size, current_time, final=False):
+        # 每收到一块数据调用一次；回调限制频率，速度采样由 ThroughputMeter 处理；
+        # 传输结束时 final 为 True，强制报告最终的大小和进度
+        meter = state['meter']
+        if final:
+            if meter is not None:
+                if downloaded_size_callback:
+                    downloaded_size_callback(source_id, downloaded_size)
+                if progress_callback:
+                    progress_callback(source_id, meter.progress(downloaded_size, state['total_size'], current_time))
+            return
+        if current_time - state['last_report'] >= report_interval:
+            state['last_report'] = current_time
+            if downloaded_size_callback:
+                downloaded_size_callback(source_id, downloaded_size)
+            if progress_callback:
+                progress_callback(source_id, meter.progress(downloaded_size, state['total_size'], current_time))
+        
+        current_speed_bps = meter.update(downloaded_size, current_time)
+        if current_speed_bps is not None and speed_callback:
+            speed_callback(source_id, current_speed_bps * 8 / 1_000_000, current_speed_bps / (1024 * 1024), current_time - start_time)
+        if meter.stop_reason:
+            state['stopped'] = True
+    
+    def start_meter(headers_time):
+        # 速度只统计传输阶段，从（第一个）响应头到达开始
+        if state['meter'] is None:
+            state['meter'] = ThroughputMeter(headers_time, options)
+            if session is not None:
+                session.add_meter(source_id, state['meter'])
+    
+    if not multi:
+        response = await async_open(url, 'GET', dict(DOWNLOAD_HEADERS), buffer_size)
+        try:
+            if response.status_code >= 400:
+                raise ConnectionError(f"{response.status_code} Error for url: {response.url}")
+            headers_time = response.headers_time
+            state['total_size'] = int(response.headers.get('Content-Length', 0) or 0)
+            start_meter(headers_time)
+            downloaded_size = 0
+            # 校验模式写入磁盘，丢弃模式读完即丢弃；写入在线程池中进行，磁盘慢时不阻塞事件循环中的其他下载
+            payload_file = open(file_path, 'wb') if file_path else None
+            try:
+                while not state['stopped']:
+                    data = await response.read(buffer_size)
+                    if not data:
+                        break
+                    if payload_file:
+                        await asyncio.to_thread(payload_file.write, data)
+                    downloaded_size += len(data)
+                    report(downloaded_size, time.monotonic())
+            finally:
+                if payload_file:
+                    payload_file.close()
+        finally:
+            response.close()
+        phases = response.phases
+    else:
+        state['total_size'] = total_size
+        if file_path:
+            # 预先分配文件大小，在线程池中进行
+            await asyncio.to_thread(preallocate_file, file_path, total_size)
+        
+        counters = [0] * connections
+        errors = []
+        segment_phases = []
+        # 切分Range与 download_file_multi 相同，有字节上限时只请求上限以内的部分
+        max_bytes = int(options.get('max_bytes') or 0)
+        span = min(total_size, max(max_bytes, connections)) if max_bytes else total_size
+        segment_size = span // connections
+        
+        async def fetch_segment(index):
+            start = index * segment_size
+            end = span - 1 if index == connections - 1 else start + segment_size - 1
+            headers = dict(DOWNLOAD_HEADERS)
+            headers['Range'] = f'bytes={start}-{end}'
+            response = await async_open(url, 'GET', headers, buffer_size)
+            try:
+                if response.status_code != 206:
+                    errors.append(RANGE_UNSUPPORTED_STATUS)
+                    return
+                start_meter(response.headers_time)
+                segment_phases.append((response.headers_time, response.phases))
+                payload_file = None
+                if file_path:
+                    payload_file = open(file_path, 'r+b')
+                    payload_file.seek(start)
+                try:
+                    while not state['stopped'] and not errors:
+                        data = await response.read(buffer_size)
+                        if not data:
+                            break
+                        if payload_file:
+                            await asyncio.to_thread(payload_file.write, data)
+                        counters[index] += len(data)
+                        report(sum(counters), time.monotonic())
+                finally:
+                    if payload_file:
+                        payload_file.close()
+            finally:
+                response.close()
+        
+        tasks = [asyncio.ensure_future(fetch_segment(index)) for index in range(connections)]
+        try:
+            # 任意分段出错时取消其他分段
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+        if errors:
+            return None, None, None, None, errors[0]
+        downloaded_size = sum(counters)
+        if state['meter'] is not None and span < total_size and not state['meter'].stop_reason:
+            state['meter'].stop_reason = '达到字节上限'
+        # 阶段耗时取最先收到响应头的分段
+        phases = dict(min(segment_phases, key=lambda item: item[0])[1]) if segment_phases else None
+    
+    end_time = time.monotonic()
+    report(downloaded_size, end_time, final=True)
+    meter = state['meter'] or ThroughputMeter(start_time, options)
+    speed_bps, measured_time = meter.result(downloaded_size, end_time)
+    
+    if info is not None:
+        info.update(meter.info())
+        info['measured_time'] = measured_time
+        if phases is not None:
+            phases['transfer'] = end_time - meter.start_time
+            info['phases'] = phases
+    
+    return end_time - start_time, speed_bps * 8 / 1_000_000, speed_bps / (1024 * 1024), downloaded_size, "成功"
+
+async def async_measure_source(source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback, options, session=None):
+    """异步引擎的 measure_source，测量方式和返回值相同"""
+    pin = source_address_pin(source_id, url, options)
+    with address_pinned(pin):
+        if options.get('per_address'):
+            final_url = url if options.get('direction') == 'upload' else (await async_probe_source(url)).get('final_url') or url
+            # 解析是阻塞调用，放到线程池中
+            addresses, final_url = await asyncio.to_thread(plan_address_runs, url, pin, final_url)
+            runs = []
+            for family, address in addresses:
+                if measurement_halted(session):
+                    break
+                with address_pinned({'host': urlparse(final_url).hostname, 'address': address, 'family': family}):
+                    measured = await async_measure_source_once(
+                        source_id, final_url, file_path, progress_callback, speed_callback, downloaded_size_callback, options, session
+                    )
+                runs.append((family, address, measured, session.series.get(source_id) if session is not None else None))
+            return combine_address_runs(source_id, runs, session)
+        return await async_measure_source_once(
+            source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback, options, session
+        )
+
+async def async_measure_source_once(source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback, options, session=None):
+    """异步引擎的 measure_source_once，测量方式和返回值相同
+
+    每个源的测量占用该主机的一个名额，多连接测试的各个分段算作同一个名额。
+    上传测试只有多线程实现，占用名额后在线程池中运行 measure_source_once（线程沿用当前的地址限制）。
+    """
+    connections = max(1, int(options.get('connections') or 1))
+    
+    async with async_engine.slot(urlparse(url).hostname or ''):
+        if options.get('direction') == 'upload':
+            return await asyncio.to_thread(
+                measure_source_once, source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback, options, session
+            )
+        
+        extra = {'connections': 1}
+        result = await async_download_file(
+            source_id, url, file_path, progress_callback, speed_callback, downloaded_size_callback,
+            options=options, info=extra, session=session
+        )
+        if connections == 1 or result[4] != '成功' or measurement_halted(session):
+            return result + (extra,)
+        
+        extra['single_stream_speed_mbps'] = result[1]
+        extra['single_stream_speed_mbs'] = result[2]
+        
+        total_size, final_url = await async_probe_range_support(url)
+        if not total_size or total_size < connections:
+            logger.info(f"{source_id} 服务器不支持分段下载，使用单连接结果")
+            extra['multi_stream_status'] = RANGE_UNSUPPORTED_STATUS
+            return result + (extra,)
+        
+        single_series = session.series.get(source_id) if session is not None else None
+        multi_info = {}
+        multi_result = await async_download_file(
+            source_id, final_url, file_path, progress_callback, speed_callback, downloaded_size_callback,
+            options=options, info=multi_info, session=session, total_size=total_size, connections=connections
+        )
+        return merge_multi_result(source_id, result, multi_result, multi_info, extra, connections, single_series, session)
+
+def stop_all_downloads():
+    """停止所有下载进程"""
+    for download_state in list(active_downloads.values()):
+        cancel_download(download_state)
+    for session in list_sessions():
+        if session.running:
+            session.stop()
+    logger.info("已停止所有下载进程")
+
+def stop_validation():
+    """中断正在进行的下载源验证，已完成的源保留验证结果"""
+    runs = list(validation_runs)
+    for validation_state in runs:
+        cancel_download(validation_state)
+    if runs:
+        logger.info("已停止下载源验证")
+    return bool(runs)
+
+def clean_temp_dir():
+    """清理临时目录"""
+    try:
+        for filename in os.listdir(TEMP_DIR):
+            file_path = os.path.join(TEMP_DIR, filename)
+            try:
+                if os.path.isfile(file_path):
+                    os.unlink(file_path)
+                elif os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+            except Exception as e:
+                logger.error(f"删除临时文件失败 {file_path}: {e}")
+        logger.info("临时目录清理完成")
+        return True
+    except Exception as e:
+        logger.error(f"清理临时目录失败: {e}")
+        return False
+
+def percentile(sorted_values, p):
+    """已排序数据的百分位数（线性插值），p 取 0-100"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+def mbps_to_mbs(speed_mbps):
+    """Mbps 换算为 MB/s，两种单位由同一个速度换算，不再分别排序平均"""
+    return speed_mbps * 1_000_000 / 8 / (1024 * 1024)
+
+def mean_confidence_interval(count, mean, sum_squares):
+    """均值的95%置信区间（t 分布），少于2个样本时返回 None"""
+    if count < 2:
+        return None
+    variance = max(0.0, (sum_squares - count * mean * mean) / (count - 1))
+    degrees = count - 1
+    t_value = T_CRITICAL_95[degrees] if degrees < len(T_CRITICAL_95) else 1.96
+    margin = t_value * math.sqrt(variance / count)
+    return [mean - margin, mean + margin]
+
+class SpeedStatistics:
+    """成功测试源速度的增量统计
+
+    每个源完成时调用 add，速度插入有序列表并累加求和，查询汇总时不需要重新排序。
+    速度统一使用 Mbps，MB/s 由估计值换算。
+    """
+    
+    def __init__(self):
+        self.speeds = []
+        self.total = 0.0
+        self.sum_squares = 0.0
+        self.total_bytes = 0
+        self.weighted_total = 0.0
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def from_results(cls, results):
+        statistics = cls()
+        for result in results.values():
+            statistics.add_result(result)
+        return statistics
+    
+    def add_result(self, result):
+        """加入一个测试结果，只统计成功的源"""
+        if result['status'] == '成功' and result['time'] is not None:
+            self.add(result['speed_mbps'], result.get('downloaded_size') or 0)
+    
+    def add(self, speed_mbps, downloaded_size=0):
+        with self.lock:
+            bisect.insort(self.speeds, speed_mbps)
+            self.total += speed_mbps
+            self.sum_squares += speed_mbps * speed_mbps
+            self.total_bytes += downloaded_size
+            self.weighted_total += speed_mbps * downloaded_size
+    
+    def summary(self, estimator='trimmed_mean'):
+        """返回各项统计量和所选估计方法的结果，没有成功的源时返回 None"""
+        with self.lock:
+            speeds = list(self.speeds)
+            total = self.total
+            sum_squares = self.sum_squares
+            total_bytes = self.total_bytes
+            weighted_total = self.weighted_total
+        
+        count = len(speeds)
+        if not count:
+            return None
+        
+        mean = total / count
+        trimmed = speeds[1:-1] if count > 2 else speeds
+        estimates = {
+            'trimmed_mean': sum(trimmed) / len(trimmed),
+            'median': percentile(speeds, 50),
+            'mean': mean,
+            'byte_weighted': weighted_total / total_bytes if total_bytes else mean
+        }
+        estimator = estimator if estimator in estimates else 'trimmed_mean'
+        estimate = estimates[estimator]
+        
+        return {
+            'estimator': estimator,
+            'count': count,
+            'speeds_mbps': speeds,
+            'estimate_mbps': estimate,
+            'estimate_mbs': mbps_to_mbs(estimate),
+            'trimmed_mean_mbps': estimates['trimmed_mean'],
+            'median_mbps': estimates['median'],
+            'mean_mbps': mean,
+            'byte_weighted_mbps': estimates['byte_weighted'],
+            'min_mbps': speeds[0],
+            'max_mbps': speeds[-1],
+            'p10_mbps': percentile(speeds, 10),
+            'p90_mbps': percentile(speeds, 90),
+            'ci95_mbps': mean_confidence_interval(count, mean, sum_squares)
+        }
+
+def describe_speed_statistics(summary):
+    """生成报告中的统计行（不含估计结果行）"""
+    lines = [f"估计方法: {SPEED_ESTIMATORS[summary['estimator']]}"]
+    speeds = summary['speeds_mbps']
+    
+    if summary['estimator'] == 'trimmed_mean':
+        if summary['count'] > 2:
+            lines.append(f"原始速度数据(Mbps): {[round(s, 2) for s in speeds]}")
+            lines.append(f"去掉最高值: {round(speeds[-1], 2)} Mbps")
+            lines.append(f"去掉最低值: {round(speeds[0], 2)} Mbps")
+            lines.append(f"处理后速度数据(Mbps): {[round(s, 2) for s in speeds[1:-1]]}")
+        else:
+            lines.append(f"速度数据(Mbps): {[round(s, 2) for s in speeds]}")
+            lines.append("数据不足3个，不去除极值")
+    else:
+        lines.append(f"速度数据(Mbps): {[round(s, 2) for s in speeds]}")
+    
+    lines.append(f"中位数: {summary['median_mbps']:.2f} Mbps / P10: {summary['p10_mbps']:.2f} Mbps / P90: {summary['p90_mbps']:.2f} Mbps")
+    lines.append(f"算术平均: {summary['mean_mbps']:.2f} Mbps / 按字节加权平均: {summary['byte_weighted_mbps']:.2f} Mbps")
+    if summary['ci95_mbps']:
+        low, high = summary['ci95_mbps']
+        lines.append(f"算术平均95%置信区间: {low:.2f} - {high:.2f} Mbps")
+    return lines
+
+def format_latency(latency):
+    """延迟统计的单行描述：空闲/负载的中位数、P90、抖动和丢失数，以及负载增加的延迟"""
+    parts = []
+    for key, label in (('idle', '空闲'), ('loaded', '负载')):
+        stats = latency[key]
+        if 'p50_ms' in stats:
+            text = f"{label} 中位数 {stats['p50_ms']:.1f} ms / P90 {stats['p90_ms']:.1f} ms / 抖动 {stats['jitter_ms']:.1f} ms"
+        else:
+            text = f"{label} 无有效采样"
+        if stats['lost']:
+            text += f" / 丢失 {stats['lost']}/{stats['count']}"
+        parts.append(text)
+    if latency['bufferbloat_ms'] is not None:
+        parts.append(f"负载增加 {latency['bufferbloat_ms']:.1f} ms")
+    return '；'.join(parts)
+
+def calculate_aggregate_throughput(results):
+    """计算多源汇总吞吐量
+
+    所有成功源有重叠的下载时间窗口时（并行测试），按各源自身的平均速率估算窗口内的字节数，
+    汇总吞吐量 = 窗口内字节数 / 窗口时长；没有重叠时（逐个测试）使用总字节数除以总跨度。
+    """
+    intervals = []
+    for result in results.values():
+        if result['status'] == '成功' and result.get('start_time') and result.get('end_time'):
+            if result['end_time'] > result['start_time']:
+                intervals.append((result['start_time'], result['end_time'], result['downloaded_size']))
+    
+    if not intervals:
+        return None
+    
+    window_start = max(start for start, end, size in intervals)
+    window_end = min(end for start, end, size in intervals)
+    overlapping = len(intervals) > 1 and window_end > window_start
+    
+    if overlapping:
+        window_bytes = sum(size * (window_end - window_start) / (end - start) for start, end, size in intervals)
+    else:
+        window_start = min(start for start, end, size in intervals)
+        window_end = max(end for start, end, size in intervals)
+        window_bytes = sum(size for start, end, size in intervals)
+    
+    window_time = window_end - window_start
+    speed_bps = window_bytes / window_time if window_time > 0 else 0
+    
+    return {
+        'speed_mbps': speed_bps * 8 / 1_000_000,
+        'speed_mbs': speed_bps / (1024 * 1024),
+        'window_time': window_time,
+        'overlapping': overlapping,
+        'source_count': len(intervals)
+    }
+
+def save_test_result(session):
+    """保存测试结果，计算过程和汇总吞吐量写回 session"""
+    test_id = session.test_id
+    results = session.snapshot()
+    options = session.options
+    try:
+        result_file = os.path.join(RESULT_DIR, f"{test_id}_测试结果.txt")
+        
+        # 计算平均速度
+        estimator = (options or {}).get('estimator', 'trimmed_mean')
+        summary = SpeedStatistics.from_results(results).summary(estimator)
+        calculation_steps = []
+        current_time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        calculation_steps.append(f"计算时间: {current_time_str}")
+        
+        if summary:
+            calculation_steps.append(f"有效测试源数量: {summary['count']}")
+            calculation_steps.extend(describe_speed_statistics(summary))
+            
+            avg_speed_mbps = summary['estimate_mbps']
+            avg_speed_mbs = summary['estimate_mbs']
+            
+            calculation_steps.append(f"平均下载速度: {avg_speed_mbps:.2f} Mbps / {avg_speed_mbs:.2f} MB/s")
+        else:
+            calculation_steps.append("无有效测试结果")
+            avg_speed_mbps = 0
+            avg_speed_mbs = 0
+        
+        # 生成计算过程字符串
+        aggregate_throughput = calculate_aggregate_throughput(results)
+        with session.lock:
+            session.calculation_process = "\n".join(calculation_steps)
+            session.last_update_time = current_time_str
+            session.aggregate_throughput = aggregate_throughput
+        
+        with open(result_file, 'w', encoding='utf-8') as f:
+            f.write(f"测速测试结果 - {test_id}\n")
+            f.write("=" * 50 + "\n\n")
+            
             # 写入测试配置
             f.write("测试配置:\n")
             f.write(f"测试时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"测试源数量: {len(results)}\n\n")
+            f.write(f"测试源数量: {len(results)}\n")
+            verify_payload = (options or {}).get('verify_payload', False)
+            f.write(f"测试模式: {'校验(写入磁盘)' if verify_payload else '丢弃(不写入磁盘)'}\n")
+            f.write(f"调度模式: {(options or {}).get('schedule_mode', 'serial')}\n")
+            if (options or {}).get('max_duration'):
+                f.write(f"单源时长上限: {options['max_duration']} 秒\n")
+            if (options or {}).get('max_bytes'):
+                f.write(f"单源字节上限: {format_file_size(int(options['max_bytes']))}\n")
+            if (options or {}).get('byte_limit'):
+                f.write(f"测试流量上限: {format_file_size(int(options['byte_limit']))}，实际传输 {format_file_size(session.transferred_total)}\n")
+            f.write(f"速度估计方法: {SPEED_ESTIMATORS.get(estimator, estimator)}\n")
+            if (options or {}).get('stable_stop'):
+                f.write(f"稳定提前停止: 最近 {options['stable_samples']} 个采样波动 ≤ {float(options['stable_tolerance']) * 100:g}%\n")
+            if (options or {}).get('address_family', 'any') != 'any':
+                f.write(f"地址族: {options['address_family']}\n")
+            if (options or {}).get('per_address'):
+                f.write("按地址测量: 每个源的每个解析地址分别测量\n")
+            f.write("\n")
             
             # 写入详细结果
             f.write("详细结果:\n")
@@ -554,11 +2581,39 @@ def save_test_result(test_id, results):
                 f.write(f"名称: {result['name']}\n")
                 f.write(f"URL: {result['url']}\n")
                 f.write(f"状态: {result['status']}\n")
+                if result.get('latency'):
+                    f.write(f"延迟(TCP连接): {format_latency(result['latency'])}\n")
+                if 'addresses' in result:
+                    f.write("各地址速度:\n")
+                    for entry in result['addresses']:
+                        speed_text = f"{entry['speed_mbps']:.2f} Mbps / {entry['speed_mbs']:.2f} MB/s" if entry['status'] == '成功' else entry['status']
+                        chosen = ' (本结果)' if entry['address'] == result.get('pinned_address') else ''
+                        f.write(f"  {entry['address']} ({entry['family']}): {speed_text}{chosen}\n")
                 
                 if result['status'] == '成功':
                     f.write(f"下载时间: {result['time']:.2f} 秒\n")
                     f.write(f"下载速度: {result['speed_mbps']:.2f} Mbps / {result['speed_mbs']:.2f} MB/s\n")
                     f.write(f"已下载大小: {format_file_size(result.get('downloaded_size', 0))}\n")
+                    phases = result.get('phases')
+                    if phases:
+                        tls_text = f"{phases['tls'] * 1000:.1f} ms" if phases['tls'] is not None else "无"
+                        f.write(f"阶段耗时: DNS解析 {phases['dns'] * 1000:.1f} ms / TCP连接 {phases['connect'] * 1000:.1f} ms / "
+                                f"TLS握手 {tls_text} / 首字节 {phases['ttfb'] * 1000:.1f} ms / 传输 {phases['transfer']:.2f} 秒"
+                                f"{' (复用已有连接)' if phases['reused'] else ''}"
+                                f"{' / 地址 ' + phases['address'] if phases.get('address') else ''}\n")
+                    if result.get('stop_reason'):
+                        f.write(f"结束原因: {result['stop_reason']}\n")
+                    if result.get('warmup_excluded'):
+                        f.write(f"速度计算: 排除前 {result['warmup_seconds']:g} 秒预热，统计时长 {result['measured_time']:.2f} 秒\n")
+                    if 'single_stream_speed_mbps' in result:
+                        f.write(f"单连接速度: {result['single_stream_speed_mbps']:.2f} Mbps / {result['single_stream_speed_mbs']:.2f} MB/s\n")
+                    if 'multi_stream_speed_mbps' in result:
+                        f.write(f"多连接速度({result['connections']}连接): {result['multi_stream_speed_mbps']:.2f} Mbps / {result['multi_stream_speed_mbs']:.2f} MB/s\n")
+                    elif 'multi_stream_status' in result:
+                        f.write(f"多连接测试: {result['multi_stream_status']}\n")
+                    series = session.series.get(source_id)
+                    if series is not None and series.count:
+                        f.write(f"时间序列: {min(series.count, series.capacity)} 个采样，间隔 {series.interval:g} 秒\n")
                 elif '超时' in result['status']:
                     f.write(f"已下载大小: {format_file_size(result.get('downloaded_size', 0))}\n")
                 f.write("-" * 80 + "\n")
@@ -573,6 +2628,14 @@ def save_test_result(test_id, results):
                 f.write(f"\n最终平均下载速度: {avg_speed_mbps:.2f} Mbps / {avg_speed_mbs:.2f} MB/s\n")
             else:
                 f.write("\n无有效测试结果\n")
+            
+            if aggregate_throughput:
+                window_desc = '重叠窗口' if aggregate_throughput['overlapping'] else '总跨度'
+                f.write(f"汇总吞吐量({window_desc} {aggregate_throughput['window_time']:.2f} 秒): "
+                        f"{aggregate_throughput['speed_mbps']:.2f} Mbps / {aggregate_throughput['speed_mbs']:.2f} MB/s\n")
+        
+        save_throughput_series(test_id, results, session.series)
+        record_test_history(session, results, avg_speed_mbps, avg_speed_mbs)
         
         logger.info(f"测试结果已保存: {result_file}")
         return result_file, avg_speed_mbps, avg_speed_mbs
@@ -581,558 +2644,3087 @@ def save_test_result(test_id, results):
         logger.error(f"保存测试结果失败: {e}")
         return None, 0, 0
 
-def log_action(action):
-    """记录用户操作日志"""
+def save_throughput_series(test_id, results, throughput_series):
+    """将每个源的吞吐量时间序列保存到结果目录，与测试结果文件同名"""
+    series_file = os.path.join(RESULT_DIR, f"{test_id}_时间序列.json")
     try:
-        log_entry = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {action}\n"
-        action_log_file = os.path.join(LOG_DIR, f"用户操作_{datetime.now().strftime('%Y%m%d')}.log")
+        data = {}
+        for source_id, series in list(throughput_series.items()):
+            if source_id not in results:
+                continue
+            data[source_id] = {
+                'name': results[source_id]['name'],
+                'status': results[source_id]['status'],
+                **series.to_dict()
+            }
         
-        with open(action_log_file, 'a', encoding='utf-8') as f:
-            f.write(log_entry)
+        with open(series_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        return series_file
     except Exception as e:
-        logger.error(f"记录操作日志失败: {e}")
+        logger.error(f"保存时间序列失败: {e}")
+        return None
+
+def load_throughput_series(test_id):
+    """读取已保存的时间序列，文件不存在时返回 None"""
+    series_file = os.path.join(RESULT_DIR, f"{os.path.basename(test_id)}_时间序列.json")
+    if not os.path.exists(series_file):
+        return None
+    with open(series_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tests (
+    test_id TEXT PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    source_count INTEGER NOT NULL,
+    success_count INTEGER NOT NULL,
+    avg_speed_mbps REAL,
+    avg_speed_mbs REAL,
+    aggregate_speed_mbps REAL,
+    options TEXT,
+    calculation TEXT
+);
+CREATE TABLE IF NOT EXISTS source_results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    test_id TEXT NOT NULL REFERENCES tests(test_id) ON DELETE CASCADE,
+    source_id TEXT NOT NULL,
+    name TEXT,
+    url TEXT,
+    status TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    download_time REAL,
+    speed_mbps REAL,
+    speed_mbs REAL,
+    downloaded_size INTEGER,
+    connections INTEGER,
+    stop_reason TEXT,
+    details TEXT,
+    transferred_bytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS source_samples (
+    result_id INTEGER PRIMARY KEY REFERENCES source_results(id) ON DELETE CASCADE,
+    interval REAL NOT NULL,
+    sample_count INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tests_started_at ON tests(started_at);
+CREATE INDEX IF NOT EXISTS idx_source_results_source ON source_results(source_id, started_at);
+CREATE INDEX IF NOT EXISTS idx_source_results_started_at ON source_results(started_at);
+CREATE INDEX IF NOT EXISTS idx_source_results_test ON source_results(test_id);
+"""
+
+def open_history_db():
+    """打开历史数据库，首次打开时建表"""
+    global history_db_ready
+    conn = sqlite3.connect(HISTORY_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if not history_db_ready:
+        with history_db_lock:
+            if not history_db_ready:
+                # WAL 模式下查询不会被写入阻塞
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(HISTORY_SCHEMA)
+                # 旧版本建立的数据库补上新增的列
+                columns = {row['name'] for row in conn.execute('PRAGMA table_info(source_results)')}
+                if 'transferred_bytes' not in columns:
+                    conn.execute('ALTER TABLE source_results ADD COLUMN transferred_bytes INTEGER')
+                history_db_ready = True
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+def pack_series_samples(samples):
+    """把时间序列采样压缩为二进制：按 [秒, 字节, 字节/秒] 顺序排列的 float64 数组"""
+    values = array('d')
+    for sample in samples:
+        values.extend(sample)
+    return zlib.compress(values.tobytes())
+
+def unpack_series_samples(data):
+    """pack_series_samples 的逆操作"""
+    values = array('d')
+    values.frombytes(zlib.decompress(data))
+    return [[values[i], int(values[i + 1]), values[i + 2]] for i in range(0, len(values), 3)]
+
+def record_test_history(session, results, avg_speed_mbps, avg_speed_mbs):
+    """把一次测试写入历史数据库：每次测试一行，每个源一行，另存每个源的时间序列"""
+    test_id = session.test_id
+    aggregate_throughput = session.aggregate_throughput
+    try:
+        now = time.time()
+        start_times = [result['start_time'] for result in results.values() if result.get('start_time')]
+        success_count = sum(1 for result in results.values() if result['status'] == '成功')
+        
+        with closing(open_history_db()) as conn, history_db_lock, conn:
+            conn.execute('DELETE FROM tests WHERE test_id = ?', (test_id,))
+            conn.execute(
+                'INSERT INTO tests (test_id, started_at, finished_at, source_count, success_count, avg_speed_mbps, '
+                'avg_speed_mbs, aggregate_speed_mbps, options, calculation) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (test_id, min(start_times) if start_times else now, now, len(results), success_count,
+                 avg_speed_mbps, avg_speed_mbs,
+                 aggregate_throughput['speed_mbps'] if aggregate_throughput else None,
+                 json.dumps(session.options, ensure_ascii=False), session.calculation_process)
+            )
+            
+            for source_id, result in results.items():
+                details = {
+                    key: result[key] for key in (
+                        'phases', 'measured_time', 'warmup_excluded', 'single_stream_speed_mbps',
+                        'multi_stream_speed_mbps', 'multi_stream_status', 'direction', 'latency',
+                        'addresses', 'pinned_address'
+                    ) if key in result
+                }
+                cursor = conn.execute(
+                    'INSERT INTO source_results (test_id, source_id, name, url, status, started_at, download_time, '
+                    'speed_mbps, speed_mbs, downloaded_size, connections, stop_reason, details, transferred_bytes) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (test_id, source_id, result.get('name'), result.get('url'), result['status'],
+                     result.get('start_time') or now, result.get('time'),
+                     result.get('speed_mbps') or 0, result.get('speed_mbs') or 0,
+                     result.get('downloaded_size') or 0, result.get('connections', 1),
+                     result.get('stop_reason'), json.dumps(details, ensure_ascii=False),
+                     session.transferred[source_id])
+                )
+                
+                series = session.series.get(source_id)
+                if series is not None and series.count:
+                    samples = series.samples()
+                    conn.execute(
+                        'INSERT INTO source_samples (result_id, interval, sample_count, data) VALUES (?, ?, ?, ?)',
+                        (cursor.lastrowid, series.interval, len(samples), pack_series_samples(samples))
+                    )
+        return True
+    except Exception as e:
+        logger.error(f"写入历史数据库失败: {e}")
+        return False
+
+def parse_history_time(value):
+    """解析查询参数中的时间：时间戳或 YYYY-MM-DD[ HH:MM[:SS]]，无法解析时抛出 ValueError"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            continue
+    raise ValueError(f"无法解析时间: {value}")
+
+def history_filters(args, column='started_at', source_clause='source_id = ?'):
+    """根据查询参数 start/end/source 生成 WHERE 子句和参数
+
+    end 只给日期时包含当天全天；source 按 source_clause 过滤（查询 tests 表时传入子查询）。
+    """
+    clauses = []
+    params = []
+    start = parse_history_time(args.get('start'))
+    end = parse_history_time(args.get('end'))
+    if end is not None and len(args.get('end', '')) == 10:
+        end += 86400
+    if start is not None:
+        clauses.append(f'{column} >= ?')
+        params.append(start)
+    if end is not None:
+        clauses.append(f'{column} < ?')
+        params.append(end)
+    if args.get('source'):
+        clauses.append(source_clause)
+        params.append(args['source'])
+    return clauses, params
+
+class Histogram:
+    """Prometheus 风格的累计直方图"""
+    
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+    
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.total += value
+    
+    def render(self, name, labels):
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f"{name}_bucket{format_metric_labels({**labels, 'le': f'{bound:g}'})} {count}")
+        lines.append(f"{name}_bucket{format_metric_labels({**labels, 'le': '+Inf'})} {self.count}")
+        lines.append(f"{name}_sum{format_metric_labels(labels)} {self.total}")
+        lines.append(f"{name}_count{format_metric_labels(labels)} {self.count}")
+        return lines
+
+# 内存中的监控指标，测试过程中更新，/metrics 只读取不访问磁盘
+metrics = {
+    'tests_total': 0,
+    'last_test_duration': None,
+    'last_test_speed_mbps': None,
+    'source_results': collections.Counter(),  # {(source_id, 状态): 次数}
+    'downloaded_bytes': collections.Counter(),  # {source_id: 字节}
+    'uploaded_bytes': collections.Counter(),  # {source_id: 字节}
+    'last_speed': {},  # {source_id: (Mbps, 时间戳)}
+    'throughput': {},  # {source_id: Histogram}
+    'phases': {}  # {阶段: Histogram}
+}
+
+def format_metric_labels(labels):
+    """格式化 Prometheus 标签，转义反斜杠、引号和换行"""
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+def metric_status(status):
+    """状态归类：去掉错误详情，避免标签取值无限增长"""
+    return status.split(':', 1)[0].strip()
+
+def record_source_metrics(source_id, result, direction='download'):
+    """记录一个源的测试结果
+
+    字节数使用整个测量实际传输的字节（含失败、停止和单连接阶段），上传和下载分开统计。
+    """
+    with metrics_lock:
+        metrics['source_results'][(source_id, metric_status(result['status']))] += 1
+        transferred = result.get('transferred_bytes')
+        if transferred is None:
+            transferred = result.get('downloaded_size') or 0
+        metrics['uploaded_bytes' if direction == 'upload' else 'downloaded_bytes'][source_id] += transferred
+        
+        if result['status'] != '成功':
+            return
+        metrics['last_speed'][source_id] = (result['speed_mbps'], result.get('end_time') or time.time())
+        metrics['throughput'].setdefault(source_id, Histogram(THROUGHPUT_BUCKETS_MBPS)).observe(result['speed_mbps'])
+        
+        phases = result.get('phases')
+        if phases:
+            # 复用连接时没有握手阶段，只记录首字节时间
+            observed = {'ttfb': phases['ttfb']}
+            if not phases['reused']:
+                observed.update(dns=phases['dns'], connect=phases['connect'])
+                if phases['tls'] is not None:
+                    observed['tls'] = phases['tls']
+            for phase, value in observed.items():
+                metrics['phases'].setdefault(phase, Histogram(PHASE_BUCKETS_SECONDS)).observe(value)
+
+def record_test_metrics(duration, avg_speed_mbps):
+    """记录一次完成的测试"""
+    with metrics_lock:
+        metrics['tests_total'] += 1
+        metrics['last_test_duration'] = duration
+        metrics['last_test_speed_mbps'] = avg_speed_mbps
+
+def render_metrics():
+    """生成 Prometheus 文本格式的指标"""
+    lines = []
+    
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples)
+    
+    with sources_lock:
+        sources = {source_id: {'name': source.get('name', source_id), 'valid': source.get('valid')}
+                   for source_id, source in download_sources.items()}
+    
+    def source_labels(source_id):
+        return {'source_id': source_id, 'name': sources.get(source_id, {}).get('name', source_id)}
+    
+    session_states = collections.Counter(session.state for session in list_sessions())
+    with metrics_lock:
+        metric('chuanliu_tests_total', 'counter', '已完成的测试次数', [f"chuanliu_tests_total {metrics['tests_total']}"])
+        metric('chuanliu_test_running', 'gauge', '是否有测试正在进行或排队', [f"chuanliu_test_running {int(is_test_running())}"])
+        metric('chuanliu_sessions', 'gauge', '按状态统计的测试会话数', [
+            f"chuanliu_sessions{format_metric_labels({'state': state})} {count}"
+            for state, count in session_states.items()
+        ])
+        if metrics['last_test_duration'] is not None:
+            metric('chuanliu_last_test_duration_seconds', 'gauge', '最近一次测试的总耗时',
+                   [f"chuanliu_last_test_duration_seconds {metrics['last_test_duration']}"])
+            metric('chuanliu_last_test_speed_mbps', 'gauge', '最近一次测试的平均速度',
+                   [f"chuanliu_last_test_speed_mbps {metrics['last_test_speed_mbps']}"])
+        
+        metric('chuanliu_source_valid', 'gauge', '下载源是否可用（最近一次验证结果）', [
+            f"chuanliu_source_valid{format_metric_labels(source_labels(source_id))} {int(bool(source.get('valid')))}"
+            for source_id, source in sources.items()
+        ])
+        metric('chuanliu_source_speed_mbps', 'gauge', '每个源最近一次成功测试的速度', [
+            f"chuanliu_source_speed_mbps{format_metric_labels(source_labels(source_id))} {speed}"
+            for source_id, (speed, _) in metrics['last_speed'].items()
+        ])
+        metric('chuanliu_source_last_success_timestamp_seconds', 'gauge', '每个源最近一次成功测试的时间', [
+            f"chuanliu_source_last_success_timestamp_seconds{format_metric_labels(source_labels(source_id))} {finished_at:.3f}"
+            for source_id, (_, finished_at) in metrics['last_speed'].items()
+        ])
+        metric('chuanliu_source_results_total', 'counter', '每个源按状态统计的测试次数', [
+            f"chuanliu_source_results_total{format_metric_labels({**source_labels(source_id), 'status': status})} {count}"
+            for (source_id, status), count in metrics['source_results'].items()
+        ])
+        metric('chuanliu_downloaded_bytes_total', 'counter', '每个源累计下载的字节数', [
+            f"chuanliu_downloaded_bytes_total{format_metric_labels(source_labels(source_id))} {count}"
+            for source_id, count in metrics['downloaded_bytes'].items()
+        ])
+        metric('chuanliu_uploaded_bytes_total', 'counter', '每个源累计上传的字节数', [
+            f"chuanliu_uploaded_bytes_total{format_metric_labels(source_labels(source_id))} {count}"
+            for source_id, count in metrics['uploaded_bytes'].items()
+        ])
+        
+        throughput_lines = []
+        for source_id, histogram in metrics['throughput'].items():
+            throughput_lines.extend(histogram.render('chuanliu_source_throughput_mbps', source_labels(source_id)))
+        metric('chuanliu_source_throughput_mbps', 'histogram', '每个源成功测试的速度分布', throughput_lines)
+        
+        phase_lines = []
+        for phase, histogram in metrics['phases'].items():
+            phase_lines.extend(histogram.render('chuanliu_phase_seconds', {'phase': phase}))
+        metric('chuanliu_phase_seconds', 'histogram', '连接阶段耗时分布（dns/connect/tls/ttfb）', phase_lines)
+    
+    return "\n".join(lines) + "\n"
+
+def build_status_summary(results, statistics=None, estimator='trimmed_mean'):
+    """统计测试状态，平均速度取自增量维护的 SpeedStatistics"""
+    testing_count = 0
+    completed_count = 0
+    success_count = 0
+    failed_count = 0
+    
+    for result in results.values():
+        if result['status'] == '测试中...' or result['status'] == '测试中':
+            testing_count += 1
+        else:
+            completed_count += 1
+            if result['status'] == '成功':
+                success_count += 1
+            else:
+                failed_count += 1
+    
+    summary = statistics.summary(estimator) if statistics else None
+    calculation_steps = []
+    
+    if summary:
+        # 生成当前计算过程（只显示最后三行）
+        calculation_steps.append(f"当前有效源: {summary['count']} 个")
+        calculation_steps.append(f"估计方法: {SPEED_ESTIMATORS[summary['estimator']]}")
+        calculation_steps.append(f"当前平均速度: {summary['estimate_mbps']:.2f} Mbps / {summary['estimate_mbs']:.2f} MB/s")
+    
+    return {
+        'avg_speed_mbps': summary['estimate_mbps'] if summary else 0,
+        'avg_speed_mbs': summary['estimate_mbs'] if summary else 0,
+        'valid_count': summary['count'] if summary else 0,
+        'statistics': summary,
+        'calculation_steps': calculation_steps,
+        'stats': {
+            'testing_count': testing_count,
+            'completed_count': completed_count,
+            'success_count': success_count,
+            'failed_count': failed_count
+        }
+    }
+
+class TestSession:
+    """一次测试的全部状态
+
+    结果条目写时复制：更新时生成新的条目字典替换旧的，已发出的条目不会再被修改；
+    所有写入和快照都在 lock 内完成，读取方拿到的是浅拷贝，不会与测试线程竞争。
+    版本号来自全局递增计数器，不同测试之间也不会重复。
+    state 为 queued（等待带宽）、running、finished 或 cancelled（排队时被停止）。
+    """
+    
+    def __init__(self, test_id, sources, options, trigger='手动'):
+        self.test_id = test_id
+        self.sources = list(sources)
+        self.options = options
+        self.trigger = trigger
+        self.lock = threading.RLock()
+        self.results = {}
+        self.speed_data = {}  # 实时速度 {source_id: {...}}
+        self.downloads = {}  # 活跃下载 {source_id: download_state}
+        self.series = {}  # 吞吐量时间序列 {source_id: ThroughputSeries}
+        self.latency = {}  # 延迟探测器 {source_id: LatencyProber}
+        self.byte_limit = int(options.get('byte_limit') or 0)
+        self.transferred = collections.Counter()  # 每个源所有测量已传输的字节数（含失败和停止的测量）
+        self.transferred_total = 0
+        self.transfer_lock = threading.Lock()
+        self.byte_limit_reached = False
+        self.statistics = SpeedStatistics()
+        self.running = True  # 排队中和测试中都为 True
+        self.state = 'queued'
+        self.stop_requested = False
+        self.calculation_process = ""
+        self.last_update_time = None
+        self.aggregate_throughput = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = threading.Event()  # 测试线程退出后置位
+        self.base_revision = next(status_revisions)
+        self.revision = self.base_revision
+        self.result_revisions = {}  # 每个源最后一次变化时的版本号
+        self.summary = build_status_summary({})
+    
+    def mark_changed(self, source_id=None):
+        """递增版本号，source_id 不为空时记录该源的变化版本"""
+        with self.lock:
+            self.revision = next(status_revisions)
+            if source_id is not None:
+                self.result_revisions[source_id] = self.revision
+            return self.revision
+    
+    def snapshot(self):
+        """结果的浅拷贝，条目本身不会再被修改"""
+        with self.lock:
+            return dict(self.results)
+    
+    def get_result(self, source_id):
+        with self.lock:
+            return self.results.get(source_id)
+    
+    def set_result(self, source_id, result):
+        """写入一个源的完整结果（开始或结束），同时重新计算汇总"""
+        with self.lock:
+            self.results[source_id] = result
+            if result['status'] not in ('测试中...', '测试中'):
+                self.speed_data.pop(source_id, None)
+                self.statistics.add_result(result)
+            self.summary = build_status_summary(self.results, self.statistics, self.options.get('estimator', 'trimmed_mean'))
+            self.mark_changed(source_id)
+            summary = self.summary
+        
+        publish_event('result', {
+            'test_id': self.test_id,
+            'source_id': source_id,
+            'result': result,
+            'avg_speed_mbps': summary['avg_speed_mbps'],
+            'avg_speed_mbs': summary['avg_speed_mbs'],
+            'stats': summary['stats']
+        })
+    
+    def update_result(self, source_id, **changes):
+        """更新一个源的进度字段，返回新的条目；源不存在时返回 None"""
+        with self.lock:
+            result = self.results.get(source_id)
+            if result is None:
+                return None
+            result = {**result, **changes}
+            self.results[source_id] = result
+            self.mark_changed(source_id)
+            return result
+    
+    def update_speed(self, source_id, speed_mbps, speed_mbs, elapsed_time):
+        """记录实时速度"""
+        with self.lock:
+            if source_id not in self.results:
+                return False
+            self.speed_data[source_id] = {
+                'speed_mbps': speed_mbps,
+                'speed_mbs': speed_mbs,
+                'elapsed_time': elapsed_time
+            }
+        self.update_result(source_id, current_speed_mbps=speed_mbps, current_speed_mbs=speed_mbs, elapsed_time=elapsed_time)
+        return True
+    
+    def add_meter(self, source_id, meter):
+        """登记一次测量的 ThroughputMeter：记录其时间序列，传输的字节计入测试流量"""
+        meter.session = self
+        meter.source_id = source_id
+        self.series[source_id] = meter.series
+    
+    def add_transferred(self, source_id, size):
+        """累计已传输的字节，达到 byte_limit 后所有测量在下一次更新时结束"""
+        with self.transfer_lock:
+            self.transferred[source_id] += size
+            self.transferred_total += size
+            if self.byte_limit and self.transferred_total >= self.byte_limit:
+                self.byte_limit_reached = True
+    
+    def register_download(self, source_id, download_state):
+        with self.lock:
+            self.downloads[source_id] = download_state
+            if self.stop_requested:
+                cancel_download(download_state)
+    
+    def unregister_download(self, source_id, download_state):
+        with self.lock:
+            if self.downloads.get(source_id) is download_state:
+                del self.downloads[source_id]
+    
+    def start(self):
+        """获得带宽，开始测试"""
+        with self.lock:
+            self.state = 'running'
+            self.started_at = time.time()
+            self.mark_changed()
+        publish_event('test_start', {
+            'test_id': self.test_id,
+            'sources': self.sources,
+            'options': self.options,
+            'trigger': self.trigger
+        })
+    
+    def stop(self):
+        """请求停止：不再开始新的源，并中断正在进行的下载；排队中的测试直接取消"""
+        with self.lock:
+            self.stop_requested = True
+            for download_state in self.downloads.values():
+                cancel_download(download_state)
+        bandwidth_arbiter.wake()
+    
+    def finish(self):
+        """测试线程结束时调用"""
+        with self.lock:
+            self.running = False
+            self.state = 'finished' if self.started_at is not None else 'cancelled'
+            self.finished_at = time.time()
+            self.speed_data = {}
+            for download_state in self.downloads.values():
+                cancel_download(download_state)
+            self.mark_changed()
+        self.finished.set()
+    
+    def wait_finished(self, timeout=STOP_WAIT_SECONDS):
+        """等待测试线程退出，返回是否已退出"""
+        return self.finished.wait(timeout)
+    
+    def status_payload(self, since=None):
+        """生成测试状态
+
+        since 为客户端已有的版本号时只返回该版本之后变化的源；没有变化时只返回
+        changed=False 和当前版本号。不传或版本早于本次测试时返回全量结果。
+        """
+        with self.lock:
+            revision = self.revision
+            delta = since is not None and self.base_revision <= since <= revision
+            if delta and since == revision:
+                return {
+                    'success': True,
+                    'changed': False,
+                    'revision': revision,
+                    'is_testing': self.running,
+                    'state': self.state,
+                    'test_id': self.test_id
+                }
+            
+            if delta:
+                results = {
+                    source_id: self.results[source_id]
+                    for source_id, changed_at in self.result_revisions.items()
+                    if changed_at > since and source_id in self.results
+                }
+            else:
+                results = dict(self.results)
+            
+            summary = self.summary
+            running = self.running
+            state = self.state
+            speed_data = dict(self.speed_data)
+            calculation_process = self.calculation_process
+            has_results = bool(self.results)
+        
+        avg_speed_mbps = summary['avg_speed_mbps']
+        avg_speed_mbs = summary['avg_speed_mbs']
+        
+        if running:
+            current_calculation = calculation_process or "\n".join(summary['calculation_steps'])
+        elif has_results and not calculation_process and summary['valid_count']:
+            # 测试完成但没有计算过程，生成一个
+            calculation_steps = []
+            calculation_steps.append(f"最终计算时间: {self.last_update_time or datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            calculation_steps.append(f"有效测试源数量: {summary['valid_count']}")
+            calculation_steps.append(f"最终平均下载速度: {avg_speed_mbps:.2f} Mbps / {avg_speed_mbs:.2f} MB/s")
+            current_calculation = "\n".join(calculation_steps)
+        else:
+            # 使用保存的最终计算过程
+            current_calculation = calculation_process
+        
+        return {
+            'success': True,
+            'changed': True,
+            'delta': delta,
+            'revision': revision,
+            'is_testing': running,
+            'state': state,
+            'queue_position': bandwidth_arbiter.queue_position(self),
+            'test_id': self.test_id,
+            'results': results,
+            'avg_speed_mbps': avg_speed_mbps,
+            'avg_speed_mbs': avg_speed_mbs,
+            'speed_data': speed_data,
+            'aggregate_throughput': self.aggregate_throughput,
+            'calculation_process': current_calculation,
+            'statistics': summary['statistics'],
+            'options': self.options,
+            'stats': summary['stats']
+        }
+
+    def describe(self):
+        """测试会话列表中的一项"""
+        with self.lock:
+            info = {
+                'test_id': self.test_id,
+                'state': self.state,
+                'trigger': self.trigger,
+                'bandwidth_mode': self.options['bandwidth_mode'],
+                'source_count': len(self.sources),
+                'queued_at': self.queued_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'avg_speed_mbps': self.summary['avg_speed_mbps'],
+                'stats': self.summary['stats']
+            }
+        info['queue_position'] = bandwidth_arbiter.queue_position(self)
+        return info
+
+class BandwidthArbiter:
+    """决定测试会话可以同时进行还是需要排队
+
+    测试按提交顺序排队（先到先得，不会插队）。队首的测试在以下情况可以开始：
+    没有测试在进行；或者它和所有进行中的测试都是 shared 模式，且进行中的
+    测试少于 MAX_SHARED_SESSIONS 个。exclusive 测试因此总是独占带宽，
+    测得的速度不受其他测试影响。
+    """
+    
+    def __init__(self, max_shared=MAX_SHARED_SESSIONS):
+        self.max_shared = max_shared
+        self.condition = threading.Condition()
+        self.waiting = collections.deque()
+        self.running = {}  # {test_id: TestSession}
+    
+    def _admit(self, session):
+        """队首的 session 能开始时移入进行中，调用方持有 condition"""
+        if not self.waiting or self.waiting[0] is not session:
+            return False
+        if self.running:
+            if session.options['bandwidth_mode'] != 'shared':
+                return False
+            if any(other.options['bandwidth_mode'] != 'shared' for other in self.running.values()):
+                return False
+            if len(self.running) >= self.max_shared:
+                return False
+        self.waiting.popleft()
+        self.running[session.test_id] = session
+        session.start()
+        # 下一个排队的测试也许可以一起开始
+        self.condition.notify_all()
+        return True
+    
+    def submit(self, session):
+        """加入队列，可以立即开始时直接开始，返回是否已开始"""
+        with self.condition:
+            self.waiting.append(session)
+            return self._admit(session)
+    
+    def wait(self, session):
+        """阻塞直到 session 开始，排队时被停止则移出队列并返回 False"""
+        with self.condition:
+            while session.test_id not in self.running:
+                if session.stop_requested:
+                    if session in self.waiting:
+                        self.waiting.remove(session)
+                    self.condition.notify_all()
+                    return False
+                if self._admit(session):
+                    break
+                self.condition.wait(0.5)
+            return True
+    
+    def release(self, session):
+        """测试结束，让出带宽"""
+        with self.condition:
+            self.running.pop(session.test_id, None)
+            if session in self.waiting:
+                self.waiting.remove(session)
+            self.condition.notify_all()
+    
+    def wake(self):
+        """唤醒排队的测试重新检查（例如有测试被停止）"""
+        with self.condition:
+            self.condition.notify_all()
+    
+    def queue_position(self, session):
+        """排队位置，从1开始；不在队列中时为0"""
+        with self.condition:
+            for position, waiting in enumerate(self.waiting, 1):
+                if waiting is session:
+                    return position
+            return 0
+    
+    def describe(self):
+        with self.condition:
+            return {
+                'running': list(self.running),
+                'waiting': [session.test_id for session in self.waiting],
+                'max_shared': self.max_shared
+            }
+
+bandwidth_arbiter = BandwidthArbiter()
+
+def get_session(test_id):
+    """按测试ID查找测试会话，不存在时返回 None"""
+    with test_start_lock:
+        return test_sessions.get(test_id)
+
+def list_sessions():
+    with test_start_lock:
+        return list(test_sessions.values())
+
+def prune_sessions():
+    """只保留最近 FINISHED_SESSIONS_KEPT 个已结束的会话，调用方持有 test_start_lock"""
+    finished = [test_id for test_id, session in test_sessions.items()
+                if not session.running and session is not current_session]
+    for test_id in finished[:max(0, len(finished) - FINISHED_SESSIONS_KEPT)]:
+        del test_sessions[test_id]
+
+def is_test_running():
+    """是否有测试正在进行或排队"""
+    return any(session.running for session in list_sessions())
+
+class EventSubscriber:
+    """单个推送客户端待发送的事件
+
+    进度和速度样本按 key 合并，慢客户端只会收到每个源最新的样本；
+    其他事件按顺序排队，积压超过上限时丢弃最旧的。
+    """
+    
+    def __init__(self, max_events=EVENT_QUEUE_SIZE):
+        self.max_events = max_events
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()
+        self.sequence = 0
+        self.dropped = 0
+        self.closed = False
+    
+    def push(self, event, data, key=None):
+        with self.condition:
+            if key is None:
+                self.sequence += 1
+                key = ('event', self.sequence)
+            elif key in self.pending:
+                # 旧样本还没发出去，用新样本替换并移到队尾
+                del self.pending[key]
+                self.dropped += 1
+            
+            if len(self.pending) >= self.max_events:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            
+            self.pending[key] = (event, data)
+            self.condition.notify()
+    
+    def pop_all(self, timeout):
+        """等待并取出所有待发送事件，超时返回空列表"""
+        with self.condition:
+            if not self.pending and not self.closed:
+                self.condition.wait(timeout)
+            events = list(self.pending.values())
+            self.pending.clear()
+            return events
+    
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+def subscribe_events():
+    """注册一个推送客户端"""
+    subscriber = EventSubscriber()
+    with event_subscribers_lock:
+        event_subscribers.append(subscriber)
+    return subscriber
+
+def unsubscribe_events(subscriber):
+    """注销推送客户端"""
+    subscriber.close()
+    with event_subscribers_lock:
+        if subscriber in event_subscribers:
+            event_subscribers.remove(subscriber)
+    if subscriber.dropped:
+        logger.info(f"推送客户端断开，共合并或丢弃 {subscriber.dropped} 个过期事件")
+
+def publish_event(event, data, key=None):
+    """把事件分发给所有订阅者，key 相同的样本会合并"""
+    if not event_subscribers:
+        return
+    with event_subscribers_lock:
+        subscribers = list(event_subscribers)
+    for subscriber in subscribers:
+        subscriber.push(event, data, key)
+
+def format_sse(event, data):
+    """格式化为 text/event-stream 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def log_action(action):
+    """记录用户操作日志"""
+    try:
+        log_entry = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} {action}\n"
+        action_log_file = os.path.join(LOG_DIR, f"用户操作_{datetime.now().strftime('%Y%m%d')}.log")
+        
+        with open(action_log_file, 'a', encoding='utf-8') as f:
+            f.write(log_entry)
+    except Exception as e:
+        logger.error(f"记录操作日志失败: {e}")
+
+@app.route('/')
+def index():
+    """主页面"""
+    return render_template('index.html')
+
+@app.route('/api/config', methods=['GET'])
+def get_config():
+    """获取配置"""
+    with sources_lock:
+        return jsonify({
+            'success': True,
+            'sources': download_sources,
+            'validation_in_progress': validation_in_progress
+        })
+
+@app.route('/api/validate', methods=['POST'])
+def validate_sources():
+    """验证下载源"""
+    global validation_in_progress
+    
+    try:
+        data = request.json
+        sources_to_validate = data.get('sources', [])
+        
+        # 如果没有指定源，验证所有源
+        if not sources_to_validate:
+            sources_to_validate = list(download_sources.keys())
+        
+        # engine 指定验证引擎，不指定时按源的数量选择
+        engine = data.get('engine')
+        if engine is not None and engine not in ENGINES:
+            return jsonify({
+                'success': False,
+                'message': f"未知的验证引擎: {engine}"
+            })
+        
+        validation_in_progress = True
+        publish_event('validation', {'in_progress': True})
+        
+        # force 为 true 时忽略探测缓存，重新探测
+        use_cache = not data.get('force', False)
+        
+        # 启动验证线程
+        validation_thread = threading.Thread(target=validate_sources_thread, args=(sources_to_validate, use_cache, engine))
+        validation_thread.daemon = True
+        validation_thread.start()
+        
+        return jsonify({
+            'success': True,
+            'message': '验证已开始，请等待完成'
+        })
+    
+    except Exception as e:
+        logger.error(f"验证下载源失败: {e}")
+        validation_in_progress = False
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+@app.route('/api/validate/stop', methods=['POST'])
+def stop_validating():
+    """停止正在进行的下载源验证"""
+    if not stop_validation():
+        return jsonify({
+            'success': False,
+            'message': '没有正在进行的验证'
+        })
+    
+    log_action("停止验证下载源")
+    return jsonify({
+        'success': True,
+        'message': '验证已停止'
+    })
+
+def probe_sources(urls, use_cache=True, engine='thread', validation_state=None):
+    """并发探测多个下载源，逐个返回 (源ID, 探测结果或异常)
+
+    thread 引擎用线程池并发探测，按完成顺序返回；asyncio 引擎在事件循环中同时探测，全部完成后返回。
+    validation_state 被 cancel_download 取消后，未开始的探测不再进行，进行中的探测连接被关闭，
+    不再返回任何结果。
+    """
+    validation_state = validation_state or {'active': True, 'sockets': set()}
+    
+    if engine == 'asyncio':
+        future = asyncio.run_coroutine_threadsafe(async_probe_many(list(urls.values()), 10, use_cache), async_engine.start())
+        validation_state['cancel'] = future.cancel
+        if not validation_state['active']:
+            future.cancel()
+        try:
+            probes = future.result()
+        except concurrent.futures.CancelledError:
+            return
+        yield from zip(urls, probes)
+        return
+    
+    def tracked_probe(url):
+        with tracked_connections(validation_state):
+            return probe_source(url, 10, use_cache)
+    
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+    validation_state['cancel'] = lambda: executor.shutdown(wait=False, cancel_futures=True)
+    try:
+        future_to_source = {executor.submit(tracked_probe, url): source_id for source_id, url in urls.items()}
+        for future in concurrent.futures.as_completed(future_to_source):
+            if not validation_state['active']:
+                return
+            try:
+                yield future_to_source[future], future.result()
+            except Exception as e:
+                yield future_to_source[future], e
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def validate_sources_thread(sources_to_validate, use_cache=True, engine=None):
+    """验证下载源线程，engine 为 None 时按源的数量选择验证引擎"""
+    global validation_in_progress, download_sources
+    
+    validation_state = {'active': True, 'sockets': set()}
+    try:
+        results = {}
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        
+        urls = {}
+        with sources_lock:
+            for source_id in sources_to_validate:
+                if source_id in download_sources:
+                    # 配置文件中记录的最近验证仍在有效期内（如刚重启），跳过探测
+                    if use_cache and is_recently_validated(download_sources[source_id]):
+                        continue
+                    urls[source_id] = download_sources[source_id]['url']
+        
+        if engine is None:
+            engine = 'asyncio' if len(urls) > ASYNC_VALIDATION_THRESHOLD else 'thread'
+        logger.info(f"开始验证 {len(urls)} 个下载源，验证引擎: {ENGINES[engine]}")
+        
+        # 登记本次验证，stop_validation 可以随时中断
+        validation_runs.append(validation_state)
+        
+        for source_id, probe in probe_sources(urls, use_cache, engine, validation_state):
+            try:
+                if isinstance(probe, Exception):
+                    raise probe
+                is_valid = probe['valid']
+                with sources_lock:
+                    # 验证期间下载源可能已被删除
+                    if source_id not in download_sources:
+                        continue
+                    download_sources[source_id]['valid'] = is_valid
+                    download_sources[source_id]['last_validation'] = current_time
+                    
+                    # 文件大小来自同一次探测
+                    if is_valid:
+                        size = format_file_size(probe['size_bytes']) if probe['size_bytes'] else '未知大小'
+                        download_sources[source_id]['size'] = size
+                        download_sources[source_id]['last_status'] = '验证成功'
+                    else:
+                        download_sources[source_id]['size'] = '链接不可用'
+                        download_sources[source_id]['last_status'] = '验证失败'
+                    
+                    results[source_id] = {
+                        'valid': is_valid,
+                        'size': download_sources[source_id]['size'],
+                        'last_validation': current_time,
+                        'last_status': download_sources[source_id]['last_status'],
+                        'final_url': probe['final_url'],
+                        'accept_ranges': probe['accept_ranges'],
+                        'etag': probe['etag']
+                    }
+            except Exception as e:
+                logger.error(f"验证源 {source_id} 失败: {e}")
+                with sources_lock:
+                    if source_id not in download_sources:
+                        continue
+                    download_sources[source_id]['valid'] = False
+                    download_sources[source_id]['size'] = '验证失败'
+                    download_sources[source_id]['last_validation'] = current_time
+                    download_sources[source_id]['last_status'] = '验证异常'
+                results[source_id] = {
+                    'valid': False,
+                    'size': '验证失败',
+                    'last_validation': current_time,
+                    'last_status': '验证异常'
+                }
+        
+        # 保存配置
+        save_config()
+        
+        logger.info(f"验证完成，共验证 {len(results)} 个源")
+        
+    except Exception as e:
+        logger.error(f"验证线程执行失败: {e}")
+    
+    finally:
+        if validation_state in validation_runs:
+            validation_runs.remove(validation_state)
+        if not validation_state['active']:
+            logger.info("验证已停止")
+        validation_in_progress = False
+        publish_event('validation', {'in_progress': False})
+
+def option_number(options, key, name, convert=int, minimum=0, maximum=None):
+    """把数值选项转换为 int/float 并检查范围，写回 options；null 使用默认值，无效时抛出 ValueError"""
+    value = options[key]
+    if value is None:
+        value = DEFAULT_TEST_OPTIONS[key]
+    try:
+        value = convert(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"{name}应为数字: {options[key]}")
+    if not minimum <= value or (maximum is not None and value > maximum):
+        if maximum is None:
+            raise ValueError(f"{name}不能小于 {minimum}")
+        raise ValueError(f"{name}应在 {minimum} - {maximum} 之间")
+    options[key] = value
+    return value
+
+def build_test_options(data):
+    """从请求数据中取出测试选项，未提供的使用默认值，选项无效时抛出 ValueError"""
+    options = dict(DEFAULT_TEST_OPTIONS)
+    for key in DEFAULT_TEST_OPTIONS:
+        if key in data:
+            options[key] = data[key]
+    
+    option_number(options, 'buffer_size', '接收缓冲区大小', minimum=MIN_BUFFER_SIZE, maximum=MAX_BUFFER_SIZE)
+    option_number(options, 'connections', '并行连接数', minimum=1, maximum=MAX_CONNECTIONS)
+    option_number(options, 'max_workers', '同时测试的源数量', minimum=1)
+    option_number(options, 'max_duration', '最长测试时间', convert=float)
+    option_number(options, 'max_bytes', '最大下载字节数')
+    option_number(options, 'byte_limit', '测试流量上限')
+    option_number(options, 'stable_tolerance', '稳定判定容差', convert=float)
+    option_number(options, 'stable_samples', '稳定判定采样数', minimum=2)
+    option_number(options, 'warmup_seconds', '预热时间', convert=float)
+    option_number(options, 'sample_interval', '采样间隔', convert=float, minimum=MIN_SAMPLE_INTERVAL)
+    option_number(options, 'upload_bytes', '上传字节数', minimum=1)
+    option_number(options, 'latency_samples', '延迟采样次数', minimum=1)
+    option_number(options, 'latency_interval', '延迟采样间隔', convert=float, minimum=MIN_LATENCY_INTERVAL)
+    
+    if options['estimator'] not in SPEED_ESTIMATORS:
+        raise ValueError(f"未知的估计方法: {options['estimator']}")
+    
+    if options['schedule_mode'] not in SCHEDULE_MODES:
+        raise ValueError(f"未知的调度模式: {options['schedule_mode']}")
+    
+    if options['bandwidth_mode'] not in BANDWIDTH_MODES:
+        raise ValueError(f"未知的带宽模式: {options['bandwidth_mode']}")
+    
+    if options['engine'] not in ENGINES:
+        raise ValueError(f"未知的下载引擎: {options['engine']}")
+    
+    if options['direction'] not in TEST_DIRECTIONS:
+        raise ValueError(f"未知的测试方向: {options['direction']}")
+    
+    options['upload_method'] = str(options['upload_method']).upper()
+    if options['upload_method'] not in UPLOAD_METHODS:
+        raise ValueError(f"不支持的上传方法: {options['upload_method']}")
+    
+    if options['address_family'] not in ADDRESS_FAMILIES:
+        raise ValueError(f"未知的地址族: {options['address_family']}")
+    
+    if not isinstance(options['pin_addresses'] or {}, dict):
+        raise ValueError("pin_addresses 应为 {源ID: IP地址}")
+    pin_addresses = {}
+    for source_id, address in (options['pin_addresses'] or {}).items():
+        try:
+            ip = ipaddress.ip_address(str(address).strip('[]'))
+        except ValueError:
+            raise ValueError(f"源 {source_id} 的固定地址无效: {address}")
+        if options['address_family'] != 'any' and options['address_family'] != f"ipv{ip.version}":
+            raise ValueError(f"源 {source_id} 的固定地址 {ip} 与地址族 {options['address_family']} 不符")
+        pin_addresses[str(source_id)] = str(ip)
+    options['pin_addresses'] = pin_addresses
+    
+    return options
+
+def begin_test(selected_sources, options, trigger='手动'):
+    """创建测试会话并启动测试线程，返回测试ID；排队的测试过多时返回 None
+
+    带宽被其他测试占用时，测试线程先排队等待，由 bandwidth_arbiter 决定何时开始。
+    """
+    global current_session
+    
+    # 网页请求、命令行和定时任务可能同时启动测试
+    with test_start_lock:
+        queued = sum(1 for session in test_sessions.values() if session.state == 'queued')
+        if queued >= MAX_QUEUED_SESSIONS:
+            return None
+        
+        # 只有校验模式会写入临时文件，没有其他测试时清理临时目录
+        if options['verify_payload'] and not any(session.running for session in test_sessions.values()):
+            clean_temp_dir()
+        
+        # 生成测试ID
+        test_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{''.join(random.choices(string.digits, k=4))}"
+        while test_id in test_sessions:
+            test_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{''.join(random.choices(string.digits, k=4))}"
+        session = TestSession(test_id, selected_sources, options, trigger)
+        test_sessions[test_id] = session
+        current_session = session
+        prune_sessions()
+    
+    if not bandwidth_arbiter.submit(session):
+        publish_event('test_queued', {
+            'test_id': test_id,
+            'queue_position': bandwidth_arbiter.queue_position(session),
+            'trigger': trigger
+        })
+    
+    # 记录操作
+    log_action(f"开始测试 {test_id}（{trigger}，{BANDWIDTH_MODES[options['bandwidth_mode']]}）")
+    
+    # 启动测试线程
+    test_thread = threading.Thread(target=run_download_test, args=(session,))
+    test_thread.daemon = True
+    test_thread.start()
+    
+    return test_id
+
+@app.route('/api/test', methods=['POST'])
+def start_test():
+    """开始测试，带宽被占用时排队"""
+    try:
+        data = request.json
+        selected_sources = data.get('sources', [])
+        
+        if not selected_sources:
+            return jsonify({
+                'success': False,
+                'message': '请选择至少一个下载源'
+            })
+        
+        # 测试选项
+        try:
+            options = build_test_options(data)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            })
+        
+        test_id = begin_test(selected_sources, options)
+        if test_id is None:
+            return jsonify({
+                'success': False,
+                'message': '排队等待的测试过多，请稍后再试'
+            })
+        
+        queue_position = bandwidth_arbiter.queue_position(get_session(test_id))
+        return jsonify({
+            'success': True,
+            'test_id': test_id,
+            'queue_position': queue_position,
+            'message': f'测试已加入队列，排在第 {queue_position} 位' if queue_position else '测试已开始'
+        })
+    
+    except Exception as e:
+        logger.error(f"启动测试失败: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+@app.route('/api/schedule', methods=['GET'])
+def get_schedule():
+    """获取定时测试配置和运行状态"""
+    try:
+        used_today = bytes_downloaded_today()
+    except Exception as e:
+        logger.error(f"统计今日流量失败: {e}")
+        used_today = None
+    
+    return jsonify({
+        'success': True,
+        'schedule': schedule_config,
+        'state': {
+            **scheduler_state,
+            'bytes_downloaded_today': used_today
+        }
+    })
+
+@app.route('/api/schedule', methods=['POST'])
+def update_schedule():
+    """更新定时测试配置"""
+    global schedule_config
+    
+    try:
+        data = request.json or {}
+        config = dict(schedule_config)
+        for key in DEFAULT_SCHEDULE:
+            if key in data:
+                config[key] = data[key]
+        
+        if config['mode'] not in ('interval', 'cron'):
+            raise ValueError(f"未知的定时方式: {config['mode']}")
+        if config['mode'] == 'cron':
+            next_cron_time(config['cron'], datetime.now())
+        elif float(config['interval_minutes']) <= 0:
+            raise ValueError("间隔时间必须大于0")
+        build_test_options(config['options'] or {})
+        unknown = [source_id for source_id in config['sources'] if source_id not in download_sources]
+        if unknown:
+            raise ValueError(f"未知的下载源: {', '.join(unknown)}")
+        
+        schedule_config = config
+        save_schedule()
+        scheduler_wakeup.set()
+        log_action(f"更新定时测试配置: {'启用' if config['enabled'] else '停用'}")
+        
+        return jsonify({
+            'success': True,
+            'schedule': schedule_config,
+            'message': '定时测试配置已更新'
+        })
+    
+    except (ValueError, TypeError) as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        })
+    except Exception as e:
+        logger.error(f"更新定时测试配置失败: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+@app.route('/api/stop', methods=['POST'])
+def stop_testing():
+    """停止所有测试"""
+    if not is_test_running():
+        return jsonify({
+            'success': False,
+            'message': '没有正在进行的测试'
+        })
+    
+    sessions = [session for session in list_sessions() if session.running]
+    stop_all_downloads()
+    log_action("停止测试")
+    
+    # 下载连接已被关闭，测试线程通常立即退出；超时则返回 stopped=False 由前端继续轮询
+    deadline = time.time() + STOP_WAIT_SECONDS
+    stopped = all(session.wait_finished(max(0, deadline - time.time())) for session in sessions)
+    
+    return jsonify({
+        'success': True,
+        'stopped': stopped,
+        'message': '测试已停止' if stopped else '测试停止请求已发送，正在停止所有下载...'
+    })
+
+@app.route('/api/stop/<test_id>', methods=['POST'])
+def stop_session(test_id):
+    """停止指定的测试，排队中的测试直接取消"""
+    session = get_session(test_id)
+    if session is None:
+        return jsonify({
+            'success': False,
+            'message': '没有找到该测试'
+        }), 404
+    if not session.running:
+        return jsonify({
+            'success': False,
+            'message': '该测试已经结束'
+        })
+    
+    session.stop()
+    log_action(f"停止测试 {test_id}")
+    stopped = session.wait_finished()
+    
+    return jsonify({
+        'success': True,
+        'stopped': stopped,
+        'message': '测试已停止' if stopped else '测试停止请求已发送'
+    })
+
+def build_status_payload(since=None):
+    """最近一次开始的测试的状态，还没有测试时返回空状态"""
+    session = current_session
+    if session is not None:
+        return session.status_payload(since)
+    
+    if since is not None:
+        return {
+            'success': True,
+            'changed': False,
+            'revision': 0,
+            'is_testing': False,
+            'state': None,
+            'test_id': None
+        }
+    empty_summary = build_status_summary({})
+    return {
+        'success': True,
+        'changed': True,
+        'delta': False,
+        'revision': 0,
+        'is_testing': False,
+        'state': None,
+        'queue_position': 0,
+        'test_id': None,
+        'results': {},
+        'avg_speed_mbps': 0,
+        'avg_speed_mbs': 0,
+        'speed_data': {},
+        'aggregate_throughput': None,
+        'calculation_process': '',
+        'statistics': None,
+        'options': {},
+        'stats': empty_summary['stats']
+    }
+
+@app.route('/api/status', methods=['GET'])
+def get_test_status():
+    """获取最近一次测试的状态，支持 ?since=<revision> 增量获取"""
+    return jsonify(build_status_payload(request.args.get('since', type=int)))
+
+@app.route('/api/status/<test_id>', methods=['GET'])
+def get_session_status(test_id):
+    """获取指定测试的状态，支持 ?since=<revision> 增量获取"""
+    session = get_session(test_id)
+    if session is None:
+        return jsonify({
+            'success': False,
+            'message': '没有找到该测试'
+        }), 404
+    return jsonify(session.status_payload(request.args.get('since', type=int)))
+
+@app.route('/api/sessions', methods=['GET'])
+def get_sessions():
+    """列出进行中、排队中和最近结束的测试"""
+    return jsonify({
+        'success': True,
+        'sessions': [session.describe() for session in list_sessions()],
+        'arbiter': bandwidth_arbiter.describe()
+    })
 
-@app.route('/')
-def index():
-    """主页面"""
-    return render_template('index.html')
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """推送测试进度（Server-Sent Events）
 
-@app.route('/api/config', methods=['GET'])
-def get_config():
-    """获取配置"""
+    连接后先发送一次最近测试的完整状态，之后推送 progress、speed、result、
+    test_queued、test_start、test_done、validation 和 reset 事件，测试相关事件都带 test_id。
+    """
+    subscriber = subscribe_events()
+    
+    def generate():
+        try:
+            yield format_sse('status', build_status_payload())
+            while not subscriber.closed:
+                events = subscriber.pop_all(EVENT_HEARTBEAT_INTERVAL)
+                if not events:
+                    # 心跳，顺便发现已经断开的客户端
+                    yield ": keep-alive\n\n"
+                    continue
+                for event, data in events:
+                    yield format_sse(event, data)
+                # 限制推送频率，间隔内的样本在队列中合并
+                time.sleep(EVENT_PUSH_INTERVAL)
+        finally:
+            unsubscribe_events(subscriber)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/series', methods=['GET'])
+@app.route('/api/series/<source_id>', methods=['GET'])
+def get_throughput_series(source_id=None):
+    """获取吞吐量时间序列
+
+    默认返回最近一次测试的数据，测试中可用 ?since=<序号> 只获取新增采样；
+    传入 ?test_id= 时返回该测试的数据，测试会话已不在内存中时读取保存的时间序列。
+    """
+    test_id = request.args.get('test_id')
+    since = request.args.get('since', 0, type=int)
+    
+    session = get_session(test_id) if test_id else current_session
+    if session is None and test_id:
+        try:
+            series = load_throughput_series(test_id)
+        except Exception as e:
+            logger.error(f"读取时间序列失败: {e}")
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            }), 500
+        if series is None:
+            return jsonify({
+                'success': False,
+                'message': '没有找到该测试的时间序列'
+            }), 404
+    elif session is not None:
+        results = session.snapshot()
+        series = {
+            key: {'name': results.get(key, {}).get('name', key), **value.to_dict(since)}
+            for key, value in list(session.series.items())
+        }
+    else:
+        series = {}
+    
+    if source_id is not None:
+        if source_id not in series:
+            return jsonify({
+                'success': False,
+                'message': '没有该下载源的时间序列'
+            }), 404
+        series = {source_id: series[source_id]}
+    
     return jsonify({
         'success': True,
-        'sources': download_sources,
-        'validation_in_progress': validation_in_progress
+        'test_id': test_id or (session.test_id if session is not None else None),
+        'series': series
     })
 
-@app.route('/api/validate', methods=['POST'])
-def validate_sources():
-    """验证下载源"""
-    global validation_in_progress
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 指标"""
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/history', methods=['GET'])
+def get_history():
+    """分页查询历史测试
+
+    参数: start/end（时间戳或日期）、source（只返回包含该源的测试）、page、page_size
+    """
+    try:
+        page = max(1, request.args.get('page', 1, type=int))
+        page_size = min(HISTORY_MAX_PAGE_SIZE, max(1, request.args.get('page_size', 50, type=int)))
+        clauses, params = history_filters(
+            request.args, source_clause='test_id IN (SELECT test_id FROM source_results WHERE source_id = ?)'
+        )
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        
+        with closing(open_history_db()) as conn:
+            total = conn.execute(f'SELECT COUNT(*) FROM tests {where}', params).fetchone()[0]
+            rows = conn.execute(
+                f'SELECT * FROM tests {where} ORDER BY started_at DESC LIMIT ? OFFSET ?',
+                params + [page_size, (page - 1) * page_size]
+            ).fetchall()
+            
+            tests = []
+            for row in rows:
+                test = dict(row)
+                test['options'] = json.loads(test['options'] or '{}')
+                test['sources'] = {}
+                tests.append(test)
+            
+            if tests:
+                by_id = {test['test_id']: test for test in tests}
+                placeholders = ','.join('?' * len(by_id))
+                for row in conn.execute(
+                    f'SELECT test_id, source_id, name, status, speed_mbps, speed_mbs FROM source_results '
+                    f'WHERE test_id IN ({placeholders})', list(by_id)
+                ):
+                    by_id[row['test_id']]['sources'][row['source_id']] = {
+                        'name': row['name'],
+                        'status': row['status'],
+                        'speed_mbps': row['speed_mbps'],
+                        'speed_mbs': row['speed_mbs']
+                    }
+        
+        return jsonify({
+            'success': True,
+            'total': total,
+            'page': page,
+            'page_size': page_size,
+            'tests': tests
+        })
     
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    except Exception as e:
+        logger.error(f"查询历史失败: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+@app.route('/api/history/stats', methods=['GET'])
+def get_history_stats():
+    """历史速度统计
+
+    参数: start/end、source、group_by（source 按源分组 / day 按天分组）、
+    percentiles（逗号分隔，默认 10,50,90）。只统计成功的测试速度。
+    """
     try:
-        data = request.json
-        sources_to_validate = data.get('sources', [])
+        group_by = request.args.get('group_by', 'source')
+        if group_by not in ('source', 'day'):
+            raise ValueError(f"未知的分组方式: {group_by}")
+        percentiles = [float(p) for p in request.args.get('percentiles', '10,50,90').split(',') if p.strip()]
+        if any(p < 0 or p > 100 for p in percentiles):
+            raise ValueError("百分位数需在 0-100 之间")
         
-        # 如果没有指定源，验证所有源
-        if not sources_to_validate:
-            sources_to_validate = list(download_sources.keys())
+        clauses, params = history_filters(request.args)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        group_column = 'source_id' if group_by == 'source' else "date(started_at, 'unixepoch', 'localtime')"
         
-        validation_in_progress = True
+        groups = {}
+        with closing(open_history_db()) as conn:
+            for row in conn.execute(
+                f'SELECT {group_column} AS bucket, source_id, name, status, speed_mbps FROM source_results {where} '
+                f'ORDER BY bucket, speed_mbps', params
+            ):
+                group = groups.setdefault(row['bucket'], {'count': 0, 'speeds': [], 'names': set()})
+                group['count'] += 1
+                group['names'].add(row['name'] or row['source_id'])
+                if row['status'] == '成功':
+                    group['speeds'].append(row['speed_mbps'])
         
-        # 启动验证线程
-        validation_thread = threading.Thread(target=validate_sources_thread, args=(sources_to_validate,))
-        validation_thread.daemon = True
-        validation_thread.start()
+        stats = []
+        for bucket, group in groups.items():
+            speeds = group['speeds']
+            stats.append({
+                group_by: bucket,
+                'names': sorted(group['names']),
+                'count': group['count'],
+                'success_count': len(speeds),
+                'success_rate': len(speeds) / group['count'] if group['count'] else 0,
+                'mean_mbps': sum(speeds) / len(speeds) if speeds else None,
+                'min_mbps': speeds[0] if speeds else None,
+                'max_mbps': speeds[-1] if speeds else None,
+                'percentiles_mbps': {f'p{p:g}': percentile(speeds, p) for p in percentiles}
+            })
         
         return jsonify({
             'success': True,
-            'message': '验证已开始，请等待完成'
+            'group_by': group_by,
+            'stats': stats
         })
     
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
     except Exception as e:
-        logger.error(f"验证下载源失败: {e}")
-        validation_in_progress = False
+        logger.error(f"查询历史统计失败: {e}")
         return jsonify({
             'success': False,
             'message': str(e)
         }), 500
 
-def validate_sources_thread(sources_to_validate):
-    """验证下载源线程"""
-    global validation_in_progress, download_sources
+@app.route('/api/history/<test_id>', methods=['GET'])
+def get_history_test(test_id):
+    """查询单次测试的详细结果，?samples=1 时附带时间序列"""
+    try:
+        include_samples = request.args.get('samples', '0') in ('1', 'true')
+        
+        with closing(open_history_db()) as conn:
+            row = conn.execute('SELECT * FROM tests WHERE test_id = ?', (test_id,)).fetchone()
+            if row is None:
+                return jsonify({
+                    'success': False,
+                    'message': '没有找到该测试'
+                }), 404
+            
+            test = dict(row)
+            test['options'] = json.loads(test['options'] or '{}')
+            test['sources'] = {}
+            for source_row in conn.execute(
+                'SELECT r.*, s.interval, s.sample_count, s.data FROM source_results r '
+                'LEFT JOIN source_samples s ON s.result_id = r.id WHERE r.test_id = ?', (test_id,)
+            ):
+                result = dict(source_row)
+                data = result.pop('data')
+                result.pop('id')
+                result.pop('test_id')
+                result['details'] = json.loads(result['details'] or '{}')
+                if include_samples and data is not None:
+                    result['samples'] = unpack_series_samples(data)
+                test['sources'][result.pop('source_id')] = result
+        
+        return jsonify({
+            'success': True,
+            'test': test
+        })
     
+    except Exception as e:
+        logger.error(f"查询历史测试失败: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+@app.route('/api/config/update', methods=['POST'])
+def update_config():
+    """更新配置"""
     try:
-        results = {}
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        data = request.json
+        action = data.get('action')
         
-        # 使用线程池并发验证
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_source = {}
-            for source_id in sources_to_validate:
-                if source_id in download_sources:
-                    url = download_sources[source_id]['url']
-                    future = executor.submit(validate_url, url)
-                    future_to_source[future] = source_id
+        # 网页请求、验证线程和测试线程都会修改下载源
+        with sources_lock:
+            if action == 'add':
+                name = data.get('name', '').strip()
+                url = data.get('url', '').strip()
+                
+                if not name or not url:
+                    return jsonify({
+                        'success': False,
+                        'message': '名称和URL不能为空'
+                    })
+                
+                # 生成ID
+                source_id = f"custom_{int(time.time())}_{len(download_sources)}"
+                
+                # 添加新源
+                download_sources[source_id] = {
+                    'name': name,
+                    'url': url,
+                    'size': '待验证',
+                    'enabled': True,
+                    'valid': False,
+                    'last_validation': '',
+                    'last_status': ''
+                }
+                # 上传测试的地址（可选）
+                upload_url = data.get('upload_url', '').strip()
+                if upload_url:
+                    download_sources[source_id]['upload_url'] = upload_url
+                
+                log_action(f"添加下载源: {name}")
             
-            for future in concurrent.futures.as_completed(future_to_source):
-                source_id = future_to_source[future]
-                try:
-                    is_valid = future.result()
-                    download_sources[source_id]['valid'] = is_valid
-                    download_sources[source_id]['last_validation'] = current_time
+            elif action == 'update':
+                source_id = data.get('id')
+                name = data.get('name', '').strip()
+                url = data.get('url', '').strip()
+                
+                if source_id in download_sources:
+                    if name:
+                        download_sources[source_id]['name'] = name
                     
-                    # 获取文件大小
-                    if is_valid:
-                        size = get_file_size_from_url(download_sources[source_id]['url'])
-                        download_sources[source_id]['size'] = size
-                        download_sources[source_id]['last_status'] = '验证成功'
-                    else:
-                        download_sources[source_id]['size'] = '链接不可用'
-                        download_sources[source_id]['last_status'] = '验证失败'
+                    if url:
+                        download_sources[source_id]['url'] = url
+                        download_sources[source_id]['valid'] = False
+                        download_sources[source_id]['size'] = '待验证'
+                        download_sources[source_id]['last_status'] = '待验证'
                     
-                    results[source_id] = {
-                        'valid': is_valid,
-                        'size': download_sources[source_id]['size'],
-                        'last_validation': current_time,
-                        'last_status': download_sources[source_id]['last_status']
-                    }
-                except Exception as e:
-                    logger.error(f"验证源 {source_id} 失败: {e}")
-                    download_sources[source_id]['valid'] = False
-                    download_sources[source_id]['size'] = '验证失败'
-                    download_sources[source_id]['last_validation'] = current_time
-                    download_sources[source_id]['last_status'] = '验证异常'
-                    results[source_id] = {
-                        'valid': False,
-                        'size': '验证失败',
-                        'last_validation': current_time,
-                        'last_status': '验证异常'
-                    }
+                    # 传入空字符串时清除上传地址
+                    if 'upload_url' in data:
+                        download_sources[source_id]['upload_url'] = data['upload_url'].strip()
+                    
+                    log_action(f"更新下载源: {download_sources[source_id]['name']}")
+            
+            elif action == 'delete':
+                source_id = data.get('id')
+                if source_id in download_sources:
+                    name = download_sources[source_id]['name']
+                    del download_sources[source_id]
+                    log_action(f"删除下载源: {name}")
+            
+            elif action == 'toggle':
+                source_id = data.get('id')
+                enabled = data.get('enabled', True)
+                
+                if source_id in download_sources:
+                    download_sources[source_id]['enabled'] = enabled
+                    log_action(f"{'启用' if enabled else '禁用'}下载源: {download_sources[source_id]['name']}")
+            
+            elif action == 'toggle_all':
+                enabled = data.get('enabled', True)
+                for source_id in download_sources:
+                    download_sources[source_id]['enabled'] = enabled
+                log_action(f"{'全选' if enabled else '全不选'}下载源")
         
         # 保存配置
         save_config()
         
-        logger.info(f"验证完成，共验证 {len(results)} 个源")
-        
-    except Exception as e:
-        logger.error(f"验证线程执行失败: {e}")
+        with sources_lock:
+            return jsonify({
+                'success': True,
+                'sources': download_sources
+            })
     
-    finally:
-        validation_in_progress = False
+    except Exception as e:
+        logger.error(f"更新配置失败: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
 
-@app.route('/api/test', methods=['POST'])
-def start_test():
-    """开始测试"""
-    global is_testing, stop_test, current_test_id, test_results, current_speed_data, calculation_process, last_update_time
+@app.route('/api/reset', methods=['POST'])
+def reset_test():
+    """重置所有状态"""
+    global current_session
+    
+    # 停止所有测试（包括排队中的）和验证，等待测试线程退出
+    sessions = [session for session in list_sessions() if session.running]
+    stop_all_downloads()
+    stop_validation()
+    deadline = time.time() + STOP_WAIT_SECONDS
+    for session in sessions:
+        if not session.wait_finished(max(0, deadline - time.time())):
+            logger.warning(f"测试 {session.test_id} 未能在 {STOP_WAIT_SECONDS} 秒内停止")
+    
+    # 重置所有状态，旧测试线程仍持有自己的 session，不会再影响新状态
+    with test_start_lock:
+        test_sessions.clear()
+        current_session = None
+    publish_event('reset', {})
+    
+    # 清理临时目录
+    clean_temp_dir()
+    
+    # 重新加载配置（不清除下载源）
+    load_config()
+    
+    log_action("重置所有状态")
     
-    if is_testing:
+    with sources_lock:
         return jsonify({
-            'success': False,
-            'message': '测试正在进行中'
+            'success': True,
+            'message': '所有状态已重置',
+            'sources': download_sources
+        })
+
+def start_source_test(session, source_id):
+    """准备测试一个源：写入初始结果并生成回调，不需要下载时返回 None"""
+    options = session.options
+    if session.stop_requested:
+        return None
+    
+    with sources_lock:
+        source = download_sources.get(source_id)
+        source = dict(source) if source is not None else None
+    if source is None:
+        return None
+    
+    # 上传测试使用上传地址，下载地址是否可用不影响上传
+    upload = options['direction'] == 'upload'
+    url = source.get('upload_url') if upload else source['url']
+    
+    if not url or not (upload or source.get('valid', False)):
+        skipped_status = '未配置上传地址' if upload else 'URL不可用'
+    elif session.byte_limit_reached:
+        skipped_status = '已达到测试流量上限'
+    else:
+        skipped_status = None
+    
+    if skipped_status:
+        session.set_result(source_id, {
+            'name': source['name'],
+            'url': url or source['url'],
+            'downloaded_size': 0,
+            'status': skipped_status,
+            'time': None,
+            'speed_mbps': 0,
+            'speed_mbs': 0,
+            'progress': 0,
+            'elapsed_time': 0,
+            'current_speed_mbps': 0,
+            'current_speed_mbs': 0
         })
+        return None
+    
+    logger.info(f"开始测试: {source['name']}")
+    source_start_time = time.time()
+    
+    # 初始化结果
+    session.set_result(source_id, {
+        'name': source['name'],
+        'url': url,
+        'downloaded_size': 0,
+        'status': '测试中...',
+        'time': None,
+        'speed_mbps': 0,
+        'speed_mbs': 0,
+        'progress': 0,
+        'elapsed_time': 0,
+        'current_speed_mbps': 0,
+        'current_speed_mbs': 0
+    })
+    
+    # 校验模式才生成临时文件名，默认丢弃模式不落盘
+    temp_file = None
+    if options['verify_payload'] and not upload:
+        # 文件名加上测试ID和源ID，避免并行测试时同名文件冲突
+        filename = os.path.basename(urlparse(source['url']).path) or "download"
+        temp_file = os.path.join(TEMP_DIR, f"{session.test_id}_{source_id}_{filename}")
+    
+    progress_callback, speed_callback, downloaded_size_callback = make_source_callbacks(session)
+    return {
+        'source': source,
+        'url': url,
+        'latency': session.latency.get(source_id),
+        'start_time': source_start_time,
+        'temp_file': temp_file,
+        'measure_args': (
+            source_id, url, temp_file, progress_callback, speed_callback, downloaded_size_callback, options
+        )
+    }
+
+def make_source_callbacks(session):
+    """生成下载进度回调 (progress_callback, speed_callback, downloaded_size_callback)，写入 session 并推送事件"""
+    def publish_progress(source_id, result):
+        # 进度和已下载大小合并成一个样本，慢客户端只保留最新值
+        if not result:
+            return
+        publish_event('progress', {
+            'test_id': session.test_id,
+            'source_id': source_id,
+            'progress': result['progress'],
+            'downloaded_size': result['downloaded_size']
+        }, key=('progress', source_id))
+    
+    def progress_callback(source_id, progress):
+        # 更新进度
+        publish_progress(source_id, session.update_result(source_id, progress=progress))
+    
+    def speed_callback(source_id, speed_mbps, speed_mbs, elapsed_time):
+        # 更新实时速度和已耗时
+        if session.update_speed(source_id, speed_mbps, speed_mbs, elapsed_time):
+            publish_event('speed', {
+                'test_id': session.test_id,
+                'source_id': source_id,
+                'speed_mbps': speed_mbps,
+                'speed_mbs': speed_mbs,
+                'elapsed_time': elapsed_time
+            }, key=('speed', source_id))
+    
+    def downloaded_size_callback(source_id, downloaded_size):
+        # 更新已下载大小
+        publish_progress(source_id, session.update_result(source_id, downloaded_size=downloaded_size))
+    
+    return progress_callback, speed_callback, downloaded_size_callback
+
+def finish_source_test(session, source_id, prepared, measured):
+    """记录一个源的测量结果，更新下载源状态并删除临时文件"""
+    source = prepared['source']
+    temp_file = prepared['temp_file']
+    download_time, speed_mbps, speed_mbs, downloaded_size, status, extra = measured
+    source_end_time = time.time()
+    
+    # 更新下载源状态（特别是超时状态）
+    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    if '超时' in status:
+        last_status = f'测试超时: {status}'
+    elif status == '成功':
+        last_status = '测试成功'
+    else:
+        last_status = f'测试失败: {status}'
+    with sources_lock:
+        # 测试期间下载源可能已被删除
+        if source_id in download_sources:
+            download_sources[source_id]['last_status'] = last_status
+            # 只有测试成功才算验证过，失败的源启动时仍需重新验证
+            if status == '成功':
+                download_sources[source_id]['last_validation'] = current_time
+    
+    # 记录结果
+    result = {
+        'name': source['name'],
+        'url': prepared['url'],
+        'downloaded_size': downloaded_size if downloaded_size else 0,
+        'status': status,
+        'time': download_time,
+        'speed_mbps': speed_mbps if speed_mbps else 0,
+        'speed_mbs': speed_mbs if speed_mbs else 0,
+        'progress': 100 if status == '成功' else 0,
+        'elapsed_time': download_time if download_time else 0,
+        'current_speed_mbps': 0,
+        'current_speed_mbs': 0,
+        'start_time': prepared['start_time'],
+        'end_time': source_end_time,
+        'transferred_bytes': session.transferred[source_id],
+        **extra
+    }
+    if prepared['latency'] is not None:
+        result['latency'] = prepared['latency'].summary()
+    session.set_result(source_id, result)
+    record_source_metrics(source_id, result, session.options['direction'])
+    
+    # 删除临时文件
+    if temp_file and os.path.exists(temp_file):
+        try:
+            os.remove(temp_file)
+        except:
+            pass
+    
+    logger.info(f"测试完成: {source['name']} - 状态: {status}")
+
+def test_source(session, source_id):
+    """测试单个下载源（多线程引擎），结果写入 session"""
+    try:
+        prepared = start_source_test(session, source_id)
+        if prepared is None:
+            return
+        prober = prepared['latency']
+        if prober is not None:
+            prober.start_loaded(float(session.options['latency_interval']))
+        try:
+            measured = measure_source(*prepared['measure_args'], session=session)
+        finally:
+            if prober is not None:
+                prober.stop_loaded()
+        finish_source_test(session, source_id, prepared, measured)
     
+    except Exception as e:
+        logger.error(f"测试源 {source_id} 失败: {e}")
+
+async def test_source_async(session, source_id):
+    """测试单个下载源（异步引擎），结果写入 session"""
     try:
-        data = request.json
-        selected_sources = data.get('sources', [])
+        prepared = start_source_test(session, source_id)
+        if prepared is None:
+            return
+        prober = prepared['latency']
+        if prober is not None:
+            prober.start_loaded(float(session.options['latency_interval']))
+        try:
+            measured = await async_measure_source(*prepared['measure_args'], session=session)
+        finally:
+            if prober is not None:
+                prober.stop_loaded()
+        finish_source_test(session, source_id, prepared, measured)
+    
+    except Exception as e:
+        logger.error(f"测试源 {source_id} 失败: {e}")
+
+async def run_sources_async(session, concurrency):
+    """在事件循环中测试所有源，同时测试的源数量不超过 concurrency"""
+    limit = asyncio.Semaphore(concurrency)
+    
+    async def run_one(source_id):
+        async with limit:
+            await test_source_async(session, source_id)
+    
+    await asyncio.gather(*(run_one(source_id) for source_id in session.sources))
+
+def run_download_test(session):
+    """运行下载测试
+
+    schedule_mode 为 serial 时逐个测试；parallel 时所有源同时测试；
+    bounded 时最多 max_workers 个源同时测试。engine 为 asyncio 时所有源在
+    async_engine 的事件循环中测试，不再为每个源创建线程。
+    """
+    selected_sources = session.sources
+    options = session.options
+    
+    try:
+        # 等待带宽，排队时被停止则直接结束
+        if not bandwidth_arbiter.wait(session):
+            logger.info(f"测试 {session.test_id} 在排队时被取消")
+            return
+        test_start_time = time.monotonic()
         
-        if not selected_sources:
-            return jsonify({
-                'success': False,
-                'message': '请选择至少一个下载源'
-            })
+        # 空闲延迟在获得带宽之后、开始下载之前测量
+        if options['latency_probe']:
+            measure_idle_latency(session)
         
-        # 清理临时目录
-        clean_temp_dir()
+        schedule_mode = options['schedule_mode']
+        logger.info(f"开始下载测试，共 {len(selected_sources)} 个源，调度模式: {schedule_mode}，下载引擎: {ENGINES[options['engine']]}")
         
-        # 生成测试ID
-        current_test_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{''.join(random.choices(string.digits, k=4))}"
+        if options['engine'] == 'asyncio':
+            if schedule_mode == 'serial':
+                concurrency = 1
+            elif schedule_mode == 'parallel':
+                concurrency = max(1, len(selected_sources))
+            else:
+                concurrency = max(1, int(options['max_workers']))
+            async_engine.run(run_sources_async(session, concurrency))
+            
+            if session.stop_requested:
+                logger.info("测试被用户停止")
+        elif schedule_mode == 'serial':
+            for source_id in selected_sources:
+                if session.stop_requested:
+                    logger.info("测试被用户停止")
+                    break
+                test_source(session, source_id)
+        else:
+            if schedule_mode == 'parallel':
+                max_workers = max(1, len(selected_sources))
+            else:
+                max_workers = max(1, int(options['max_workers']))
+            
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(test_source, session, source_id) for source_id in selected_sources]
+                concurrent.futures.wait(futures)
+            
+            if session.stop_requested:
+                logger.info("测试被用户停止")
         
-        # 重置状态
-        is_testing = True
-        stop_test = False
-        test_results = {}
-        current_speed_data = {}
-        calculation_process = ""
-        last_update_time = None
+        # 保存测试结果
+        if session.snapshot():
+            result_file, avg_speed_mbps, avg_speed_mbs = save_test_result(session)
+            logger.info(f"最终平均下载速度: {avg_speed_mbps:.2f} Mbps / {avg_speed_mbs:.2f} MB/s")
+            record_test_metrics(time.monotonic() - test_start_time, avg_speed_mbps)
         
-        # 记录操作
-        log_action(f"开始测试 {current_test_id}")
+        # 保存更新后的配置
+        save_config()
         
-        # 启动测试线程
-        test_thread = threading.Thread(target=run_download_test, args=(selected_sources,))
-        test_thread.daemon = True
-        test_thread.start()
+        logger.info("下载测试完成")
         
-        return jsonify({
-            'success': True,
-            'test_id': current_test_id,
-            'message': '测试已开始'
-        })
+    except Exception as e:
+        logger.error(f"下载测试执行失败: {e}")
+        import traceback
+        traceback.print_exc()
+    
+    finally:
+        # 让出带宽，停止本次测试残留的下载
+        bandwidth_arbiter.release(session)
+        session.finish()
+        publish_event('test_done', session.status_payload())
+
+def load_schedule():
+    """加载定时测试配置"""
+    global schedule_config
     
+    if not os.path.exists(SCHEDULE_FILE):
+        schedule_config = dict(DEFAULT_SCHEDULE)
+        return
+    try:
+        with open(SCHEDULE_FILE, 'r', encoding='utf-8') as f:
+            schedule_config = {**DEFAULT_SCHEDULE, **json.load(f)}
+        logger.info(f"成功加载定时测试配置，{'已启用' if schedule_config['enabled'] else '未启用'}")
     except Exception as e:
-        logger.error(f"启动测试失败: {e}")
-        return jsonify({
-            'success': False,
-            'message': str(e)
-        }), 500
+        logger.error(f"加载定时测试配置失败: {e}")
+        schedule_config = dict(DEFAULT_SCHEDULE)
+
+def save_schedule():
+    """保存定时测试配置"""
+    try:
+        with open(SCHEDULE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(schedule_config, f, ensure_ascii=False, indent=2)
+        return True
+    except Exception as e:
+        logger.error(f"保存定时测试配置失败: {e}")
+        return False
+
+def parse_cron_field(field, low, high):
+    """解析cron的一段，支持 *、*/n、a-b、a-b/n 和逗号分隔的列表"""
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step <= 0:
+                raise ValueError(f"cron步长无效: {field}")
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start_text, end_text = part.split('-', 1)
+            start, end = int(start_text), int(end_text)
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError(f"cron取值超出范围 {low}-{high}: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+def parse_cron(expression):
+    """解析5段cron表达式，返回 (分, 时, 日, 月, 周, 日是否受限, 周是否受限)，格式错误时抛出 ValueError"""
+    fields = expression.split()
+    if len(fields) != 5:
+        raise ValueError(f"cron表达式需要5段（分 时 日 月 周）: {expression}")
+    try:
+        minutes = parse_cron_field(fields[0], 0, 59)
+        hours = parse_cron_field(fields[1], 0, 23)
+        days = parse_cron_field(fields[2], 1, 31)
+        months = parse_cron_field(fields[3], 1, 12)
+        # 周日可以写作0或7
+        weekdays = {day % 7 for day in parse_cron_field(fields[4], 0, 7)}
+    except ValueError as e:
+        raise ValueError(f"cron表达式无效: {expression} ({e})")
+    # 与标准cron一致：以 * 开头的段（包括 */n）不算受限
+    return minutes, hours, days, months, weekdays, not fields[2].startswith('*'), not fields[4].startswith('*')
+
+def next_cron_time(expression, after):
+    """after 之后（不含）第一个匹配cron表达式的时间
 
-@app.route('/api/stop', methods=['POST'])
-def stop_testing():
-    """停止测试"""
-    global stop_test, is_testing
+    时间为本地时间。夏令时跳过的时间按跳变前的偏移换算（如跳过的 02:30 在 03:30 执行）；
+    夏令时结束时重复的一小时内，after 处于第二遍时已经过去的第一遍时间不会被返回。
+    """
+    minutes, hours, days, months, weekdays, days_restricted, weekdays_restricted = parse_cron(expression)
+    candidate = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = candidate + timedelta(days=366 * 4)
     
-    if not is_testing:
-        return jsonify({
-            'success': False,
-            'message': '没有正在进行的测试'
-        })
+    while candidate < limit:
+        day_match = candidate.day in days
+        weekday_match = (candidate.weekday() + 1) % 7 in weekdays
+        # 与标准cron一致：日和周都受限时满足其一即可
+        if days_restricted and weekdays_restricted:
+            date_match = day_match or weekday_match
+        else:
+            date_match = day_match and weekday_match
+        
+        if candidate.month not in months or not date_match:
+            candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+        elif candidate.hour not in hours:
+            candidate = candidate.replace(minute=0) + timedelta(hours=1)
+        elif candidate.minute not in minutes or candidate.timestamp() <= after.timestamp():
+            candidate += timedelta(minutes=1)
+        else:
+            return candidate
+    raise ValueError(f"cron表达式没有可执行的时间: {expression}")
+
+def compute_next_run(now=None, config=None):
+    """按定时配置（默认为 schedule_config）计算下一次运行的时间戳（含随机延迟）"""
+    now = now or time.time()
+    config = config or schedule_config
+    if config['mode'] == 'cron':
+        next_run = next_cron_time(config['cron'], datetime.fromtimestamp(now)).timestamp()
+    else:
+        next_run = now + max(1.0, float(config['interval_minutes'])) * 60
+    jitter = float(config.get('jitter_seconds') or 0)
+    if jitter > 0:
+        next_run += random.uniform(0, jitter)
+    return next_run
+
+def bytes_downloaded_today():
+    """历史记录中今天所有测试实际传输的字节数
+
+    包括单连接/多连接、按地址测量的每次测量以及失败和停止的测量；
+    没有 transferred_bytes 的旧记录按最终结果的 downloaded_size 计算。
+    """
+    today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    with closing(open_history_db()) as conn:
+        row = conn.execute(
+            'SELECT COALESCE(SUM(COALESCE(transferred_bytes, downloaded_size)), 0) FROM source_results WHERE started_at >= ?',
+            (today_start,)
+        ).fetchone()
+    return row[0]
+
+def run_scheduled_test():
+    """执行一次定时测试，返回说明文字"""
+    if is_test_running():
+        return '已有测试在进行中，跳过本次定时测试'
     
-    stop_test = True
-    stop_all_downloads()
-    log_action("停止测试")
+    # 定时线程与请求线程同时修改下载源，在锁内取快照
+    with sources_lock:
+        sources = schedule_config.get('sources') or [
+            source_id for source_id, source in download_sources.items()
+            if source.get('enabled', True) and source.get('valid', False)
+        ]
+        sources = [source_id for source_id in sources if source_id in download_sources]
+    if not sources:
+        return '没有可测试的下载源，跳过本次定时测试'
     
-    return jsonify({
-        'success': True,
-        'message': '测试停止请求已发送，正在停止所有下载...'
-    })
+    # 保存的选项可能来自旧版本，无效时跳过本次测试
+    try:
+        options = build_test_options(schedule_config.get('options') or {})
+    except ValueError as e:
+        return f"定时测试选项无效: {e}，跳过本次定时测试"
+    
+    # 当天流量上限：剩余额度作为整个测试的流量上限（byte_limit），达到后所有测量结束；
+    # 同时平均分给每个源的每次测量（多连接时每个源测量两次）作为字节上限，避免前面的源用完额度
+    daily_limit = int(schedule_config.get('daily_byte_limit') or 0)
+    if daily_limit:
+        remaining = daily_limit - bytes_downloaded_today()
+        measurements = len(sources) * (2 if int(options['connections']) > 1 else 1)
+        per_measurement = remaining // measurements
+        if per_measurement <= 0:
+            return f"今日流量已达上限 {format_file_size(daily_limit)}，跳过本次定时测试"
+        if not int(options['byte_limit']) or int(options['byte_limit']) > remaining:
+            options['byte_limit'] = remaining
+        if not int(options['max_bytes']) or int(options['max_bytes']) > per_measurement:
+            options['max_bytes'] = per_measurement
+    
+    test_id = begin_test(sources, options, trigger='定时')
+    if test_id is None:
+        return '已有测试在进行中，跳过本次定时测试'
+    scheduler_state['last_test_id'] = test_id
+    return f"已开始定时测试 {test_id}"
 
-@app.route('/api/status', methods=['GET'])
-def get_test_status():
-    """获取测试状态"""
-    global is_testing, test_results, current_test_id, current_speed_data, calculation_process, last_update_time
+def scheduler_loop():
+    """定时任务线程：到达计划时间时启动测试，配置变更时重新计算下一次时间"""
+    while True:
+        try:
+            if not schedule_config['enabled']:
+                scheduler_state['next_run'] = None
+                scheduler_wakeup.wait(60)
+                scheduler_wakeup.clear()
+                continue
+            
+            if scheduler_state['next_run'] is None:
+                scheduler_state['next_run'] = compute_next_run()
+                logger.info(f"下一次定时测试: {datetime.fromtimestamp(scheduler_state['next_run']).strftime('%Y-%m-%d %H:%M:%S')}")
+            
+            now = time.time()
+            if now >= scheduler_state['next_run']:
+                scheduler_state['last_run'] = now
+                scheduler_state['last_message'] = run_scheduled_test()
+                logger.info(scheduler_state['last_message'])
+                scheduler_state['next_run'] = None
+                continue
+            
+            if scheduler_wakeup.wait(min(60, scheduler_state['next_run'] - now)):
+                scheduler_wakeup.clear()
+                scheduler_state['next_run'] = None
+        except Exception as e:
+            logger.error(f"定时任务执行失败: {e}")
+            scheduler_state['last_message'] = f"定时任务执行失败: {e}"
+            scheduler_state['next_run'] = None
+            time.sleep(60)
+
+def start_scheduler():
+    """启动定时任务线程"""
+    load_schedule()
+    scheduler_thread = threading.Thread(target=scheduler_loop)
+    scheduler_thread.daemon = True
+    scheduler_thread.start()
+
+class LoopbackOriginHandler(BaseHTTPRequestHandler):
+    """回环测速源的请求处理：GET/HEAD 任意路径都返回按查询参数生成的内容
+
+    响应体第 i 个字节为 i % 256，分段请求的内容与完整下载对应位置一致。
+    POST/PUT 作为上传测试的接收端：读完请求体后丢弃，返回收到的字节数。
+    """
+    protocol_version = 'HTTP/1.1'
+    # 所有响应共用的发送块，按偏移量取切片发送，不为每个请求分配内存
+    payload = memoryview(bytes(range(256)) * (ORIGIN_BLOCK_SIZE // 256 + 1))
     
-    # 统计测试状态
-    testing_count = 0
-    completed_count = 0
-    success_count = 0
-    failed_count = 0
+    def log_message(self, format, *args):
+        pass
     
-    for result in test_results.values():
-        if result['status'] == '测试中...' or result['status'] == '测试中':
-            testing_count += 1
-        else:
-            completed_count += 1
-            if result['status'] == '成功':
-                success_count += 1
-            else:
-                failed_count += 1
+    def do_GET(self):
+        self.respond(send_body=True)
     
-    # 计算当前平均速度
-    avg_speed_mbps = 0
-    avg_speed_mbs = 0
-    valid_results_mbps = []
-    valid_results_mbs = []
+    def do_HEAD(self):
+        self.respond(send_body=False)
     
-    current_time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    def do_POST(self):
+        self.receive()
     
-    for result in test_results.values():
-        if result['status'] == '成功' and result['time'] is not None:
-            valid_results_mbps.append(result['speed_mbps'])
-            valid_results_mbs.append(result['speed_mbs'])
+    def do_PUT(self):
+        self.receive()
     
-    if valid_results_mbps:
-        # 每测试完一个源就更新平均速度
-        temp_mbps = valid_results_mbps.copy()
-        temp_mbs = valid_results_mbs.copy()
-        
-        if len(temp_mbps) > 2:
-            # 去掉最高和最低值
-            temp_mbps.sort()
-            temp_mbs.sort()
-            temp_mbps = temp_mbps[1:-1]
-            temp_mbs = temp_mbs[1:-1]
+    def origin_params(self):
+        """服务器默认参数加上URL查询参数，参数值无效时抛出 ValueError"""
+        params = dict(self.server.origin_defaults)
+        for key, values in parse_qs(urlparse(self.path).query).items():
+            if key in params:
+                params[key] = type(ORIGIN_DEFAULTS[key])(float(values[-1]))
+        if params['size'] < 0 or params['rate'] < 0 or params['latency'] < 0:
+            raise ValueError("参数不能为负数")
+        return params
+    
+    def respond(self, send_body):
+        try:
+            params = self.origin_params()
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
         
-        avg_speed_mbps = sum(temp_mbps) / len(temp_mbps)
-        avg_speed_mbs = sum(temp_mbs) / len(temp_mbs)
+        if params['latency'] or params['jitter']:
+            time.sleep((params['latency'] + random.uniform(0, params['jitter'])) / 1000)
         
-        # 生成当前计算过程（只显示最后三行）
-        calculation_steps = []
+        size = params['size']
+        start, end = 0, size - 1
+        byte_range = self.headers.get('Range') if params['ranges'] else None
+        if byte_range:
+            start, end = parse_byte_range(byte_range, size)
+            if start is None:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
         
-        if len(valid_results_mbps) > 2:
-            sorted_mbps = sorted(valid_results_mbps)
-            calculation_steps.append(f"已去掉最高值: {round(sorted_mbps[-1], 2)} Mbps")
-            calculation_steps.append(f"已去掉最低值: {round(sorted_mbps[0], 2)} Mbps")
-            calculation_steps.append(f"当前有效源: {len(valid_results_mbps)} 个")
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if params['ranges']:
+            self.send_header('Accept-Ranges', 'bytes')
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        if params['chunked']:
+            self.send_header('Transfer-Encoding', 'chunked')
         else:
-            calculation_steps.append(f"当前有效源: {len(valid_results_mbps)} 个")
-            if len(valid_results_mbps) < 3:
-                calculation_steps.append("数据不足3个，不去除极值")
-        
-        calculation_steps.append(f"当前平均速度: {avg_speed_mbps:.2f} Mbps / {avg_speed_mbs:.2f} MB/s")
+            self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
         
-        # 如果没有手动设置的计算过程，使用当前计算过程
-        if not calculation_process:
-            calculation_process = "\n".join(calculation_steps)
-    
-    # 如果测试完成且有最终计算过程，使用最终计算过程
-    if not is_testing and test_results and calculation_process:
-        # 使用保存的最终计算过程
-        pass
-    elif not is_testing and test_results and not calculation_process:
-        # 测试完成但没有计算过程，生成一个
-        if valid_results_mbps:
-            calculation_steps = []
-            calculation_steps.append(f"最终计算时间: {last_update_time or current_time_str}")
-            calculation_steps.append(f"有效测试源数量: {len(valid_results_mbps)}")
-            calculation_steps.append(f"最终平均下载速度: {avg_speed_mbps:.2f} Mbps / {avg_speed_mbs:.2f} MB/s")
-            calculation_process = "\n".join(calculation_steps)
+        if send_body:
+            try:
+                self.send_payload(start, end + 1, params)
+            except OSError:
+                # 客户端提前断开（达到字节上限、停止测试）
+                self.close_connection = True
     
-    return jsonify({
-        'success': True,
-        'is_testing': is_testing,
-        'test_id': current_test_id,
-        'results': test_results,
-        'avg_speed_mbps': avg_speed_mbps,
-        'avg_speed_mbs': avg_speed_mbs,
-        'speed_data': current_speed_data,
-        'calculation_process': calculation_process,
-        'stats': {
-            'testing_count': testing_count,
-            'completed_count': completed_count,
-            'success_count': success_count,
-            'failed_count': failed_count
-        }
-    })
-
-@app.route('/api/config/update', methods=['POST'])
-def update_config():
-    """更新配置"""
-    try:
-        data = request.json
-        action = data.get('action')
-        
-        if action == 'add':
-            name = data.get('name', '').strip()
-            url = data.get('url', '').strip()
-            
-            if not name or not url:
-                return jsonify({
-                    'success': False,
-                    'message': '名称和URL不能为空'
-                })
-            
-            # 生成ID
-            source_id = f"custom_{int(time.time())}_{len(download_sources)}"
-            
-            # 添加新源
-            download_sources[source_id] = {
-                'name': name,
-                'url': url,
-                'size': '待验证',
-                'enabled': True,
-                'valid': False,
-                'last_validation': '',
-                'last_status': ''
-            }
-            
-            log_action(f"添加下载源: {name}")
+    def receive(self):
+        """接收上传的请求体（Content-Length 或分块传输编码），rate / latency 同样生效"""
+        try:
+            params = self.origin_params()
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
         
-        elif action == 'update':
-            source_id = data.get('id')
-            name = data.get('name', '').strip()
-            url = data.get('url', '').strip()
-            
-            if source_id in download_sources:
-                if name:
-                    download_sources[source_id]['name'] = name
-                
-                if url:
-                    download_sources[source_id]['url'] = url
-                    download_sources[source_id]['valid'] = False
-                    download_sources[source_id]['size'] = '待验证'
-                    download_sources[source_id]['last_status'] = '待验证'
-                
-                log_action(f"更新下载源: {download_sources[source_id]['name']}")
-        
-        elif action == 'delete':
-            source_id = data.get('id')
-            if source_id in download_sources:
-                name = download_sources[source_id]['name']
-                del download_sources[source_id]
-                log_action(f"删除下载源: {name}")
-        
-        elif action == 'toggle':
-            source_id = data.get('id')
-            enabled = data.get('enabled', True)
-            
-            if source_id in download_sources:
-                download_sources[source_id]['enabled'] = enabled
-                log_action(f"{'启用' if enabled else '禁用'}下载源: {download_sources[source_id]['name']}")
+        buffer = memoryview(bytearray(ORIGIN_BLOCK_SIZE))
+        rate = params['rate']
+        started = time.monotonic()
+        received = 0
         
-        elif action == 'toggle_all':
-            enabled = data.get('enabled', True)
-            for source_id in download_sources:
-                download_sources[source_id]['enabled'] = enabled
-            log_action(f"{'全选' if enabled else '全不选'}下载源")
+        def read_exactly(length):
+            nonlocal received
+            while length > 0:
+                count = self.rfile.readinto(buffer[:min(length, len(buffer))])
+                if not count:
+                    raise ConnectionError("上传数据不完整")
+                length -= count
+                received += count
+                if rate:
+                    delay = started + origin_send_time(received, rate, params['ramp'] / 1000) - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
         
-        # 保存配置
-        save_config()
+        try:
+            if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+                while True:
+                    length = int(self.rfile.readline(1024).split(b';')[0].strip() or b'0', 16)
+                    if length == 0:
+                        # 跳过结尾的 trailer
+                        while self.rfile.readline(1024) not in (b'\r\n', b'\n', b''):
+                            pass
+                        break
+                    read_exactly(length)
+                    self.rfile.readline(1024)
+            else:
+                read_exactly(int(self.headers.get('Content-Length') or 0))
+        except (OSError, ValueError):
+            self.close_connection = True
+            return
         
-        return jsonify({
-            'success': True,
-            'sources': download_sources
-        })
+        if params['latency'] or params['jitter']:
+            time.sleep((params['latency'] + random.uniform(0, params['jitter'])) / 1000)
+        body = json.dumps({'received': received}).encode()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            self.close_connection = True
     
-    except Exception as e:
-        logger.error(f"更新配置失败: {e}")
-        return jsonify({
-            'success': False,
-            'message': str(e)
-        }), 500
+    def send_payload(self, start, stop, params):
+        """发送 [start, stop) 区间的内容
 
-@app.route('/api/reset', methods=['POST'])
-def reset_test():
-    """重置所有状态"""
-    global is_testing, stop_test, test_results, current_test_id, current_speed_data, calculation_process, last_update_time
-    
-    # 停止当前测试
-    if is_testing:
-        stop_test = True
-        stop_all_downloads()
-        time.sleep(1)  # 等待停止
-    
-    # 重置所有状态
-    is_testing = False
-    stop_test = False
-    test_results = {}
-    current_test_id = None
-    current_speed_data = {}
-    calculation_process = ""
-    last_update_time = None
+        限速时按 origin_send_time 计算每块数据的发送时间，停顿和抖动不会累积成突发；
+        stall_at / reset_at 按本次响应已发送的字节数计算。
+        """
+        rate = params['rate']
+        jitter = params['jitter'] / 1000
+        # 限速时每次最多发送约10毫秒的数据，速度更平滑
+        block_size = min(ORIGIN_BLOCK_SIZE, max(1024, int(rate / 100))) if rate else ORIGIN_BLOCK_SIZE
+        write = self.wfile.write
+        started = time.monotonic()
+        position = start
+        while position < stop:
+            sent = position - start
+            if params['reset_at'] and sent >= params['reset_at']:
+                self.reset_connection()
+                return
+            if params['stall'] and params['stall_at'] and sent >= params['stall_at']:
+                # 停顿只发生一次，之后仍按原来的速度发送
+                time.sleep(params['stall'] / 1000)
+                started += params['stall'] / 1000
+                params['stall'] = 0
+            
+            count = min(block_size, stop - position)
+            for limit in (params['reset_at'], params['stall_at'] if params['stall'] else 0):
+                if limit > sent:
+                    count = min(count, limit - sent)
+            offset = position % 256
+            if params['chunked']:
+                write(b'%X\r\n' % count)
+                write(self.payload[offset:offset + count])
+                write(b'\r\n')
+            else:
+                write(self.payload[offset:offset + count])
+            position += count
+            
+            if rate:
+                delay = started + origin_send_time(position - start, rate, params['ramp'] / 1000) - time.monotonic()
+                delay += random.uniform(0, jitter) if jitter else 0
+                if delay > 0:
+                    time.sleep(delay)
+            elif jitter:
+                time.sleep(random.uniform(0, jitter))
+        if params['chunked']:
+            write(b'0\r\n\r\n')
     
-    # 清理临时目录
-    clean_temp_dir()
+    def reset_connection(self):
+        """立即关闭连接并发送RST，客户端读取时得到连接重置错误"""
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+        self.close_connection = True
+
+def origin_send_time(sent, rate, ramp=0):
+    """限速的回环源发送完前 sent 个字节的时间（秒）
+
+    速度在 ramp 秒内从 0 线性增加到 rate（字节/秒），之后保持 rate。
+    """
+    if ramp and sent <= rate * ramp / 2:
+        return math.sqrt(2 * ramp * sent / rate)
+    return sent / rate + ramp / 2
+
+def expected_speed_mbps(size, params, warmup_seconds=0):
+    """按回环源的损伤参数计算下载 size 字节的理论速度（Mbps），从收到响应头开始计时
+
+    包含爬升和停顿的影响；warmup_seconds 与 ThroughputMeter 相同，排除开头的预热时间。
+    """
+    rate = params['rate']
+    ramp = params['ramp'] / 1000
+    transfer_time = origin_send_time(size, rate, ramp)
+    if params['stall'] and 0 < params['stall_at'] < size:
+        transfer_time += params['stall'] / 1000
+    warmup_bytes = 0
+    if 0 < warmup_seconds < transfer_time:
+        # 预热时间内发送的字节数（假设停顿发生在预热之后）
+        warmup_bytes = rate * warmup_seconds ** 2 / (2 * ramp) if ramp and warmup_seconds < ramp else rate * (warmup_seconds - ramp / 2)
+        transfer_time -= warmup_seconds
+    return (size - warmup_bytes) * 8 / transfer_time / 1_000_000
+
+def parse_byte_range(header, size):
+    """解析单个区间的 Range 请求头，返回 (start, end)；无法满足时返回 (None, None)"""
+    try:
+        unit, _, spec = header.partition('=')
+        first, _, last = spec.split(',')[0].strip().partition('-')
+        if unit.strip() != 'bytes':
+            return None, None
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            # bytes=-N 表示最后N个字节
+            start, end = max(0, size - int(last)), size - 1
+    except ValueError:
+        return None, None
+    if start > end or start >= size:
+        return None, None
+    return start, end
+
+def make_origin_server(host, port, defaults):
+    """创建回环测速源的HTTP服务器，port 为 0 时自动选择空闲端口"""
+    server = ThreadingHTTPServer((host, port), LoopbackOriginHandler)
+    server.daemon_threads = True
+    server.origin_defaults = defaults
+    return server
+
+def serve_origin_process(host, port, defaults, ready):
+    """子进程入口：启动回环测速源，把实际端口放入 ready 队列"""
+    server = make_origin_server(host, port, defaults)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+class LoopbackOrigin:
+    """本地回环测速源
+
+    内容在内存中生成，不读写磁盘，支持限速、响应延迟、Range 和分块传输编码，
+    用于离线测量下载引擎本身能达到的速度。start() 在当前进程的线程中运行；
+    start_process() 在子进程中运行，基准测试统计的CPU时间不包含源的开销。
+    """
     
-    # 重新加载配置（不清除下载源）
-    load_config()
+    def __init__(self, host='127.0.0.1', port=0, **defaults):
+        unknown = set(defaults) - set(ORIGIN_DEFAULTS)
+        if unknown:
+            raise ValueError(f"未知的回环源参数: {', '.join(sorted(unknown))}")
+        self.host = host
+        self.port = port
+        self.defaults = {**ORIGIN_DEFAULTS, **defaults}
+        self.server = None
+        self.process = None
     
-    log_action("重置所有状态")
+    def start(self):
+        self.server = make_origin_server(self.host, self.port, self.defaults)
+        self.port = self.server.server_address[1]
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return self
     
-    return jsonify({
-        'success': True,
-        'message': '所有状态已重置',
-        'sources': download_sources
+    def start_process(self):
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve_origin_process, args=(self.host, self.port, self.defaults, ready))
+        self.process.daemon = True
+        self.process.start()
+        self.port = ready.get(timeout=30)
+        return self
+    
+    def url(self, path='/payload', **params):
+        """生成下载地址，params 覆盖该请求的响应参数"""
+        query = urlencode({key: int(value) if isinstance(value, bool) else value for key, value in params.items()})
+        return f"http://{self.host}:{self.port}{path}" + (f"?{query}" if query else '')
+    
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(5)
+            self.process = None
+
+def timed_callbacks(callbacks, totals):
+    """包装下载回调，累计调用次数和耗时到 totals['calls'] / totals['seconds']"""
+    def wrap(callback):
+        def timed(*args):
+            started = time.perf_counter()
+            try:
+                return callback(*args)
+            finally:
+                totals['seconds'] += time.perf_counter() - started
+                totals['calls'] += 1
+        return timed
+    return tuple(wrap(callback) for callback in callbacks)
+
+def run_bench_case(origin, case_id, size, buffer_size=None):
+    """用回环源运行一个基准测试用例一次
+
+    下载使用网页测试相同的回调（写入一个不登记的 TestSession 并推送事件），
+    返回速度、CPU时间和回调开销；下载未成功或字节数不对时抛出 RuntimeError。
+    """
+    case = BENCH_CASES[case_id]
+    url = origin.url(size=size, **case['origin'])
+    connections = case['connections']
+    direction = case.get('direction', 'download')
+    options = build_test_options({
+        'engine': case['engine'], 'connections': connections, 'buffer_size': normalize_buffer_size(buffer_size),
+        'direction': direction, 'upload_bytes': size
     })
+    
+    session = TestSession(f"bench_{case_id}", [BENCH_SOURCE_ID], options, trigger='基准测试')
+    session.set_result(BENCH_SOURCE_ID, {
+        'name': case['description'],
+        'url': url,
+        'downloaded_size': 0,
+        'status': '测试中...',
+        'progress': 0
+    })
+    totals = {'calls': 0, 'seconds': 0.0}
+    callbacks = timed_callbacks(make_source_callbacks(session), totals)
+    if case['engine'] == 'asyncio':
+        async_engine.start()
+    
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    if direction == 'upload':
+        result = upload_file(BENCH_SOURCE_ID, url, *callbacks, buffer_size=buffer_size, options=options, session=session)
+    elif case['engine'] == 'asyncio':
+        result = async_engine.run(async_download_file(
+            BENCH_SOURCE_ID, url, None, *callbacks, options=options, session=session,
+            total_size=size if connections > 1 else None, connections=connections
+        ))
+    elif connections > 1:
+        result = download_file_multi(BENCH_SOURCE_ID, url, size, connections, None, *callbacks, buffer_size=buffer_size, options=options, session=session)
+    else:
+        result = download_file(BENCH_SOURCE_ID, url, None, *callbacks, buffer_size=buffer_size, options=options, session=session)
+    wall_seconds = time.perf_counter() - wall_start
+    cpu_seconds = time.process_time() - cpu_start
+    
+    download_time, speed_mbps, speed_mbs, downloaded_size, status = result[:5]
+    if status != '成功':
+        raise RuntimeError(f"{case['description']} 失败: {status}")
+    if downloaded_size != size:
+        raise RuntimeError(f"{case['description']} 传输了 {downloaded_size} 字节，应为 {size} 字节")
+    
+    return {
+        'mbps': downloaded_size * 8 / wall_seconds / 1_000_000,  # 包含建立连接的端到端速度
+        'measured_mbps': speed_mbps,  # 下载引擎报告的速度
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': cpu_seconds,
+        'cpu_seconds_per_gb': cpu_seconds / (downloaded_size / 1_000_000_000),
+        'callback_calls': totals['calls'],
+        'callback_seconds': totals['seconds'],
+        'callback_us_per_call': totals['seconds'] / totals['calls'] * 1_000_000 if totals['calls'] else 0,
+        'callback_share': totals['seconds'] / wall_seconds
+    }
+
+def run_benchmark(size, repeat=3, cases=None, buffer_size=None, in_process=False, progress=None):
+    """在回环源上运行基准测试用例，每个用例重复 repeat 次
 
-def run_download_test(selected_sources):
-    """运行下载测试"""
-    global is_testing, stop_test, test_results, current_speed_data, calculation_process, last_update_time
+    速度取最大值（可达到的最高速度），CPU时间和回调开销取中位数。
+    in_process 为 True 时回环源运行在当前进程中，CPU时间会包含源的开销。
+    """
+    cases = list(cases or BENCH_CASES)
+    origin = LoopbackOrigin()
+    if in_process:
+        origin.start()
+    else:
+        origin.start_process()
     
+    report = {
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'size': size,
+        'repeat': repeat,
+        'buffer_size': normalize_buffer_size(buffer_size),
+        'in_process': in_process,
+        'cases': {}
+    }
     try:
-        logger.info(f"开始下载测试，共 {len(selected_sources)} 个源")
-        
-        for source_id in selected_sources:
-            if stop_test:
-                logger.info("测试被用户停止")
-                break
-            
-            if source_id not in download_sources:
-                continue
-            
-            source = download_sources[source_id]
+        for case_id in cases:
+            runs = []
+            for index in range(repeat):
+                runs.append(run_bench_case(origin, case_id, size, buffer_size))
+                if progress:
+                    run = runs[-1]
+                    progress(f"{case_id} #{index + 1}: {run['mbps']:.0f} Mbps，CPU {run['cpu_seconds_per_gb']:.3f} 秒/GB，"
+                             f"回调 {run['callback_calls']} 次 {run['callback_us_per_call']:.1f} 微秒/次")
             
-            if not source.get('valid', False):
-                test_results[source_id] = {
-                    'name': source['name'],
-                    'url': source['url'],
-                    'downloaded_size': 0,
-                    'status': 'URL不可用',
-                    'time': None,
-                    'speed_mbps': 0,
-                    'speed_mbs': 0,
-                    'progress': 0,
-                    'elapsed_time': 0,
-                    'current_speed_mbps': 0,
-                    'current_speed_mbs': 0
-                }
-                continue
+            def median(key):
+                return percentile(sorted(run[key] for run in runs), 50)
             
-            logger.info(f"开始测试: {source['name']}")
+            report['cases'][case_id] = {
+                'description': BENCH_CASES[case_id]['description'],
+                'max_mbps': max(run['mbps'] for run in runs),
+                'cpu_seconds_per_gb': median('cpu_seconds_per_gb'),
+                'callback_calls': median('callback_calls'),
+                'callback_us_per_call': median('callback_us_per_call'),
+                'callback_share': median('callback_share'),
+                'runs': runs
+            }
+    finally:
+        origin.stop()
+    return report
+
+def compare_benchmark(report, baseline, tolerance):
+    """与基准结果比较，返回退化的说明列表
+
+    最高速度低于基准的 (1 - tolerance) 倍或每GB的CPU时间高于基准的 (1 + tolerance) 倍算作退化，
+    只比较两份结果中都有的用例。
+    """
+    regressions = []
+    for case_id, case in report['cases'].items():
+        previous = baseline.get('cases', {}).get(case_id)
+        if not previous:
+            continue
+        if case['max_mbps'] < previous['max_mbps'] * (1 - tolerance):
+            regressions.append(f"{case_id}: 最高速度 {case['max_mbps']:.0f} Mbps，基准 {previous['max_mbps']:.0f} Mbps")
+        if case['cpu_seconds_per_gb'] > previous['cpu_seconds_per_gb'] * (1 + tolerance):
+            regressions.append(f"{case_id}: CPU {case['cpu_seconds_per_gb']:.3f} 秒/GB，基准 {previous['cpu_seconds_per_gb']:.3f} 秒/GB")
+    return regressions
+
+def run_accuracy(rate_mbps, seconds, profiles=None, options=None, progress=None):
+    """准确度测试：在带网络损伤的回环源上按测试选项测量，与已知的注入速度比较
+
+    每个场景下载 rate_mbps 限速下约 seconds 秒的数据，测量方式与 run_download_test
+    中每个源相同（measure_source / async_measure_source），但不保存结果和历史。
+    error_vs_cap 为报告速度相对限速的误差，error_vs_expected 为相对考虑爬升、停顿和预热后理论速度的误差（百分比）。
+    """
+    profiles = list(profiles or ACCURACY_PROFILES)
+    rate = rate_mbps * 1_000_000 / 8
+    size = int(rate * seconds)
+    origin = LoopbackOrigin(rate=rate).start_process()
+    
+    report = {
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'rate_mbps': rate_mbps,
+        'size': size,
+        'options': options or {},
+        'profiles': {}
+    }
+    try:
+        for profile_id in profiles:
+            profile = ACCURACY_PROFILES[profile_id]
+            impairments = dict(profile['origin'])
+            for key in ('stall_at', 'reset_at'):
+                if key in impairments:
+                    impairments[key] = int(size * impairments[key])
+            params = {**origin.defaults, **impairments, 'size': size}
+            test_options = build_test_options({**(options or {}), **profile.get('options', {})})
+            url = origin.url(size=size, **impairments)
             
-            # 初始化结果
-            test_results[source_id] = {
-                'name': source['name'],
-                'url': source['url'],
+            session = TestSession(f"accuracy_{profile_id}", [BENCH_SOURCE_ID], test_options, trigger='准确度测试')
+            session.set_result(BENCH_SOURCE_ID, {
+                'name': profile['description'],
+                'url': url,
                 'downloaded_size': 0,
                 'status': '测试中...',
-                'time': None,
-                'speed_mbps': 0,
-                'speed_mbs': 0,
-                'progress': 0,
-                'elapsed_time': 0,
-                'current_speed_mbps': 0,
-                'current_speed_mbs': 0
-            }
-            
-            # 生成临时文件名
-            filename = os.path.basename(urlparse(source['url']).path) or f"download_{source_id}"
-            temp_file = os.path.join(TEMP_DIR, filename)
-            
-            # 下载文件
-            def progress_callback(source_id, progress):
-                # 更新进度
-                if source_id in test_results:
-                    test_results[source_id]['progress'] = progress
-            
-            def speed_callback(source_id, speed_mbps, speed_mbs, elapsed_time):
-                # 更新实时速度和已耗时
-                if source_id in test_results:
-                    test_results[source_id]['current_speed_mbps'] = speed_mbps
-                    test_results[source_id]['current_speed_mbs'] = speed_mbs
-                    test_results[source_id]['elapsed_time'] = elapsed_time
-                    current_speed_data[source_id] = {
-                        'speed_mbps': speed_mbps,
-                        'speed_mbs': speed_mbs,
-                        'elapsed_time': elapsed_time
-                    }
-            
-            def downloaded_size_callback(source_id, downloaded_size):
-                # 更新已下载大小
-                if source_id in test_results:
-                    test_results[source_id]['downloaded_size'] = downloaded_size
-            
-            download_time, speed_mbps, speed_mbs, downloaded_size, status = download_file(
-                source_id, source['url'], temp_file, progress_callback, speed_callback, downloaded_size_callback
-            )
-            
-            # 更新下载源状态（特别是超时状态）
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            if '超时' in status:
-                download_sources[source_id]['last_status'] = f'测试超时: {status}'
-                download_sources[source_id]['last_validation'] = current_time
-            elif status == '成功':
-                download_sources[source_id]['last_status'] = '测试成功'
-                download_sources[source_id]['last_validation'] = current_time
+                'progress': 0
+            })
+            measure_args = (BENCH_SOURCE_ID, url, None, *make_source_callbacks(session), test_options)
+            if test_options['engine'] == 'asyncio':
+                measured = async_engine.run(async_measure_source(*measure_args, session=session))
             else:
-                download_sources[source_id]['last_status'] = f'测试失败: {status}'
-                download_sources[source_id]['last_validation'] = current_time
+                measured = measure_source(*measure_args, session=session)
+            download_time, speed_mbps, speed_mbs, downloaded_size, status, extra = measured
             
-            # 记录结果
-            test_results[source_id] = {
-                'name': source['name'],
-                'url': source['url'],
-                'downloaded_size': downloaded_size if downloaded_size else 0,
+            expected_mbps = None if profile.get('expect_failure') else expected_speed_mbps(size, params, test_options['warmup_seconds'])
+            result = {
+                'description': profile['description'],
                 'status': status,
-                'time': download_time,
-                'speed_mbps': speed_mbps if speed_mbps else 0,
-                'speed_mbs': speed_mbs if speed_mbs else 0,
-                'progress': 100 if status == '成功' else 0,
-                'elapsed_time': download_time if download_time else 0,
-                'current_speed_mbps': 0,
-                'current_speed_mbs': 0
+                'cap_mbps': rate_mbps,
+                'expected_mbps': expected_mbps,
+                'reported_mbps': speed_mbps,
+                'error_vs_cap': (speed_mbps - rate_mbps) / rate_mbps * 100 if speed_mbps else None,
+                'error_vs_expected': (speed_mbps - expected_mbps) / expected_mbps * 100 if speed_mbps and expected_mbps else None,
+                'ok': status != '成功' if profile.get('expect_failure') else status == '成功'
             }
-            
-            # 删除临时文件
-            if os.path.exists(temp_file):
-                try:
-                    os.remove(temp_file)
-                except:
-                    pass
-            
-            logger.info(f"测试完成: {source['name']} - 状态: {status}")
-        
-        # 保存测试结果
-        if test_results:
-            result_file, avg_speed_mbps, avg_speed_mbs = save_test_result(current_test_id, test_results)
-            logger.info(f"最终平均下载速度: {avg_speed_mbps:.2f} Mbps / {avg_speed_mbs:.2f} MB/s")
-        
-        # 保存更新后的配置
-        save_config()
+            report['profiles'][profile_id] = result
+            if progress:
+                if result['reported_mbps']:
+                    progress(f"{profile['description']}: 报告 {speed_mbps:.2f} Mbps，理论 {expected_mbps:.2f} Mbps，"
+                             f"相对限速误差 {result['error_vs_cap']:+.2f}%，相对理论误差 {result['error_vs_expected']:+.2f}%")
+                else:
+                    progress(f"{profile['description']}: {status}")
+    finally:
+        origin.stop()
+    return report
+
+def run_cron_check(progress=None):
+    """定时计划自检：按 CRON_CHECKS 用 compute_next_run 计算下一次运行时间，与期望值比较
+
+    指定时区的用例临时切换进程的时区（time.tzset），结束后恢复；不支持 tzset 的系统上跳过这些用例。
+    有随机延迟的用例检查结果是否在期望时间到期望时间加随机延迟之间。
+    """
+    original_tz = os.environ.get('TZ')
+    
+    def set_timezone(tz):
+        if tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = tz
+        time.tzset()
+    
+    report = {'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'cases': []}
+    for case in CRON_CHECKS:
+        result = {'description': case['description'], 'config': case['config'], 'after': case['after'], 'expected': case['expected']}
+        report['cases'].append(result)
+        if case.get('tz') and not hasattr(time, 'tzset'):
+            result.update(ok=True, skipped=True)
+            continue
         
-        logger.info("下载测试完成")
+        if case.get('tz'):
+            set_timezone(case['tz'])
+        try:
+            after = datetime.strptime(case['after'], '%Y-%m-%d %H:%M').replace(fold=case.get('fold', 0)).timestamp()
+            try:
+                next_run = compute_next_run(after, case['config'])
+            except ValueError as e:
+                result.update(actual=None, error=str(e), ok=case['expected'] is None)
+            else:
+                result['actual'] = datetime.fromtimestamp(next_run).strftime('%Y-%m-%d %H:%M:%S')
+                if case['expected'] is None:
+                    result['ok'] = False
+                else:
+                    expected = datetime.strptime(case['expected'], '%Y-%m-%d %H:%M').timestamp()
+                    jitter = float(case['config'].get('jitter_seconds') or 0)
+                    result['ok'] = next_run > after and expected <= next_run <= expected + jitter
+        finally:
+            if case.get('tz'):
+                set_timezone(original_tz)
         
-    except Exception as e:
-        logger.error(f"下载测试执行失败: {e}")
-        import traceback
-        traceback.print_exc()
+        if progress and not result['ok']:
+            progress(f"{case['description']}: 期望 {case['expected'] or '报错'}，实际 {result.get('actual') or result.get('error')}")
+    return report
+
+def parse_bench_args(argv):
+    """解析基准测试模式的参数"""
+    parser = argparse.ArgumentParser(
+        prog='chuanliu.py bench',
+        description='本地基准测试：在回环地址上启动测速源，测量下载引擎本身的最高速度、每GB的CPU时间和回调开销，不需要网络'
+    )
+    parser.add_argument('-s', '--size', type=float, default=256, help='每次下载的大小（MB）')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='每个用例的重复次数')
+    parser.add_argument('-c', '--cases', help=f"要运行的用例，逗号分隔，可选 {', '.join(BENCH_CASES)}；默认全部")
+    parser.add_argument('--buffer-size', type=int, help='接收缓冲区大小（字节）')
+    parser.add_argument('--in-process', action='store_true', help='回环源运行在当前进程中（CPU时间包含源的开销）')
+    parser.add_argument('-o', '--output', help='结果JSON写入该文件，默认输出到标准输出')
+    parser.add_argument('--baseline', help='与之前保存的结果JSON比较，有退化时退出码为 2')
+    parser.add_argument('--tolerance', type=float, default=15, help='允许的退化幅度或准确度测试允许的误差（百分比）')
+    parser.add_argument('--accuracy', action='store_true', help='运行准确度测试：在带网络损伤的回环源上测量，与注入的速度比较')
+    parser.add_argument('-p', '--profiles', help=f"准确度测试的场景，逗号分隔，可选 {', '.join(ACCURACY_PROFILES)}；默认全部")
+    parser.add_argument('--rate', type=float, default=100, help='准确度测试的限速（Mbps）')
+    parser.add_argument('--seconds', type=float, default=4, help='准确度测试每个场景按限速下载的秒数')
+    parser.add_argument('--options', help='准确度测试的测试选项，JSON 格式，与 /api/test 相同')
+    parser.add_argument('--cron', action='store_true', help='运行定时计划自检：检查cron表达式解析和下一次运行时间的计算，不需要网络')
+    parser.add_argument('--serve', action='store_true', help='只启动回环测速源，按 Ctrl+C 退出')
+    parser.add_argument('--host', default='127.0.0.1', help='--serve 监听的地址')
+    parser.add_argument('--port', type=int, default=8500, help='--serve 监听的端口')
+    parser.add_argument('-q', '--quiet', action='store_true', help='不输出进度')
+    return parser.parse_args(argv)
+
+def run_bench(argv):
+    """基准测试模式入口，返回退出码
+
+    0 完成；1 参数错误或下载失败；2 与 --baseline 相比有退化，准确度测试的误差超过 --tolerance，或定时计划自检有失败的用例。
+    """
+    args = parse_bench_args(argv)
+    set_console_log_level(logging.WARNING)
+    
+    def progress(message):
+        if not args.quiet:
+            print(message, file=sys.stderr, flush=True)
+    
+    if args.serve:
+        server = make_origin_server(args.host, args.port, dict(ORIGIN_DEFAULTS))
+        progress(f"回环测速源: http://{args.host}:{server.server_address[1]}/payload"
+                 f"（查询参数: {', '.join(ORIGIN_DEFAULTS)}）")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+    
+    if args.accuracy:
+        return run_accuracy_cli(args, progress)
+    
+    if args.cron:
+        return run_cron_check_cli(args, progress)
+    
+    cases = [case_id.strip() for case_id in args.cases.split(',') if case_id.strip()] if args.cases else list(BENCH_CASES)
+    unknown = [case_id for case_id in cases if case_id not in BENCH_CASES]
+    if unknown:
+        print(f"未知的用例: {', '.join(unknown)}", file=sys.stderr)
+        return 1
+    
+    size = int(args.size * 1024 * 1024)
+    progress(f"基准测试: {len(cases)} 个用例，每次下载 {format_file_size(size)}，重复 {args.repeat} 次")
+    try:
+        report = run_benchmark(size, max(1, args.repeat), cases, args.buffer_size, args.in_process, progress)
+    except RuntimeError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    
+    for case_id, case in report['cases'].items():
+        progress(f"{case['description']}: 最高 {case['max_mbps']:.0f} Mbps，CPU {case['cpu_seconds_per_gb']:.3f} 秒/GB，"
+                 f"回调占用 {case['callback_share'] * 100:.2f}% 时间")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+    
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_benchmark(report, json.load(f), args.tolerance / 100)
+        for regression in regressions:
+            progress(f"退化 {regression}")
+        if regressions:
+            return 2
+    return 0
+
+def run_accuracy_cli(args, progress):
+    """bench --accuracy：运行准确度测试并输出结果，返回退出码"""
+    profiles = [profile_id.strip() for profile_id in args.profiles.split(',') if profile_id.strip()] if args.profiles else list(ACCURACY_PROFILES)
+    unknown = [profile_id for profile_id in profiles if profile_id not in ACCURACY_PROFILES]
+    if unknown:
+        print(f"未知的场景: {', '.join(unknown)}", file=sys.stderr)
+        return 1
+    try:
+        options = json.loads(args.options or '{}')
+        build_test_options(options)
+    except ValueError as e:
+        print(f"测试选项无效: {e}", file=sys.stderr)
+        return 1
+    
+    progress(f"准确度测试: {len(profiles)} 个场景，限速 {args.rate:g} Mbps，每个场景约 {args.seconds:g} 秒")
+    report = run_accuracy(args.rate, args.seconds, profiles, options, progress)
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+    
+    failed = [
+        profile_id for profile_id, result in report['profiles'].items()
+        if not result['ok'] or (result['error_vs_expected'] is not None and abs(result['error_vs_expected']) > args.tolerance)
+    ]
+    if failed:
+        progress(f"超出允许误差或结果不符合预期的场景: {', '.join(failed)}")
+        return 2
+    return 0
+
+def run_cron_check_cli(args, progress):
+    """bench --cron：运行定时计划自检并输出结果，返回退出码"""
+    report = run_cron_check(progress)
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+    
+    failed = [case['description'] for case in report['cases'] if not case['ok']]
+    skipped = sum(1 for case in report['cases'] if case.get('skipped'))
+    progress(f"定时计划自检: {len(report['cases'])} 个用例，失败 {len(failed)} 个" + (f"，跳过 {skipped} 个" if skipped else ''))
+    return 2 if failed else 0
+
+def set_console_log_level(level):
+    """调整标准错误的日志级别，日志文件仍记录详细日志"""
+    for handler in logging.getLogger().handlers:
+        if type(handler) is logging.StreamHandler:
+            handler.setLevel(level)
+
+def parse_cli_args(argv):
+    """解析命令行模式的参数"""
+    parser = argparse.ArgumentParser(
+        prog='chuanliu.py cli',
+        description='川流测速命令行模式：不启动网页服务，测试结果以 JSON 或 CSV 输出到标准输出，进度输出到标准错误'
+    )
+    parser.add_argument('-s', '--sources', help='要测试的源ID，逗号分隔；默认测试所有已启用且可用的源')
+    parser.add_argument('--validate', action='store_true', help='测试前重新验证所选下载源')
+    parser.add_argument('-m', '--schedule-mode', choices=SCHEDULE_MODES, default=DEFAULT_TEST_OPTIONS['schedule_mode'], help='多源调度模式')
+    parser.add_argument('-w', '--max-workers', type=int, default=DEFAULT_TEST_OPTIONS['max_workers'], help='bounded 模式下同时测试的源数量')
+    parser.add_argument('-c', '--connections', type=int, default=DEFAULT_TEST_OPTIONS['connections'], help='每个源的并行连接数')
+    parser.add_argument('-d', '--duration', type=float, default=DEFAULT_TEST_OPTIONS['max_duration'], help='每个源的最长测试时间（秒），0 表示不限制')
+    parser.add_argument('-b', '--max-bytes', type=int, default=DEFAULT_TEST_OPTIONS['max_bytes'], help='每个源的最大下载字节数，0 表示下载完整文件')
+    parser.add_argument('-e', '--estimator', choices=list(SPEED_ESTIMATORS), default=DEFAULT_TEST_OPTIONS['estimator'], help='平均速度的估计方法')
+    parser.add_argument('--engine', choices=list(ENGINES), default=DEFAULT_TEST_OPTIONS['engine'], help='验证和下载使用的引擎，源很多时 asyncio 更省资源')
+    parser.add_argument('--direction', choices=list(TEST_DIRECTIONS), default=DEFAULT_TEST_OPTIONS['direction'], help='测试方向，upload 向下载源配置的 upload_url 上传')
+    parser.add_argument('--address-family', choices=list(ADDRESS_FAMILIES), default=DEFAULT_TEST_OPTIONS['address_family'], help='只使用 IPv4 或 IPv6 地址连接')
+    parser.add_argument('--per-address', action='store_true', help='解析每个源主机的全部地址，每个地址分别测量')
+    parser.add_argument('-o', '--options', help='其他测试选项，JSON 格式，与 /api/test 相同')
+    parser.add_argument('-f', '--format', choices=('json', 'csv'), default='json', help='输出格式')
+    parser.add_argument('--min-speed', type=float, default=0, help='平均速度低于该值（Mbps）时退出码为 2')
+    parser.add_argument('--fail-on-error', action='store_true', help='有源测试失败时退出码为 3')
+    parser.add_argument('-q', '--quiet', action='store_true', help='不输出进度')
+    parser.add_argument('-v', '--verbose', action='store_true', help='在标准错误输出详细日志')
+    return parser.parse_args(argv)
+
+def write_cli_output(args, test_id, payload, stream):
+    """按格式输出测试结果"""
+    results = payload['results']
+    
+    if args.format == 'csv':
+        fields = ['source_id', 'name', 'url', 'status', 'speed_mbps', 'speed_mbs', 'time', 'downloaded_size', 'connections', 'stop_reason']
+        writer = csv.writer(stream)
+        writer.writerow(fields)
+        for source_id, result in results.items():
+            writer.writerow([source_id] + [result.get(field, '') for field in fields[1:]])
+        return
+    
+    json.dump({
+        'test_id': test_id,
+        'avg_speed_mbps': payload['avg_speed_mbps'],
+        'avg_speed_mbs': payload['avg_speed_mbs'],
+        'statistics': payload['statistics'],
+        'aggregate_throughput': payload['aggregate_throughput'],
+        'options': payload['options'],
+        'results': results
+    }, stream, ensure_ascii=False, indent=2)
+    stream.write("\n")
+
+def run_cli(argv):
+    """命令行模式入口，返回退出码
+
+    0 成功；1 无法开始测试；2 平均速度低于 --min-speed；3 有源失败且指定了 --fail-on-error。
+    """
+    args = parse_cli_args(argv)
+    
+    # 标准错误只保留警告，详细日志仍写入日志文件
+    if not args.verbose:
+        set_console_log_level(logging.WARNING)
+    
+    def progress(message):
+        if not args.quiet:
+            print(message, file=sys.stderr, flush=True)
+    
+    load_config()
     
+    if args.sources:
+        selected_sources = [source_id.strip() for source_id in args.sources.split(',') if source_id.strip()]
+        unknown = [source_id for source_id in selected_sources if source_id not in download_sources]
+        if unknown:
+            print(f"未知的下载源: {', '.join(unknown)}", file=sys.stderr)
+            return 1
+    else:
+        selected_sources = [source_id for source_id, source in download_sources.items() if source.get('enabled', True)]
+    
+    if args.validate:
+        progress(f"正在验证 {len(selected_sources)} 个下载源...")
+        validate_sources_thread(selected_sources, engine=args.engine)
+    
+    if not args.sources:
+        # 上传测试只需要配置了上传地址
+        usable_key = 'upload_url' if args.direction == 'upload' else 'valid'
+        selected_sources = [source_id for source_id in selected_sources if download_sources[source_id].get(usable_key)]
+    if not selected_sources:
+        print("没有可测试的下载源", file=sys.stderr)
+        return 1
+    
+    try:
+        options = build_test_options({
+            **json.loads(args.options or '{}'),
+            'schedule_mode': args.schedule_mode,
+            'max_workers': args.max_workers,
+            'connections': args.connections,
+            'max_duration': args.duration,
+            'max_bytes': args.max_bytes,
+            'estimator': args.estimator,
+            'engine': args.engine,
+            'direction': args.direction,
+            'address_family': args.address_family,
+            'per_address': args.per_address
+        })
+    except ValueError as e:
+        print(f"测试选项无效: {e}", file=sys.stderr)
+        return 1
+    
+    # 进度来自推送流的事件，与网页使用同一来源
+    subscriber = subscribe_events()
+    try:
+        test_id = begin_test(selected_sources, options, trigger='命令行')
+        if test_id is None:
+            print("排队等待的测试过多", file=sys.stderr)
+            return 1
+        session = get_session(test_id)
+        progress(f"开始测试 {test_id}，共 {len(selected_sources)} 个源")
+        
+        speeds = {}
+        last_line_time = 0
+        while session.running:
+            try:
+                events = subscriber.pop_all(0.5)
+            except KeyboardInterrupt:
+                progress("正在停止测试...")
+                session.stop()
+                continue
+            
+            for event, data in events:
+                if event == 'speed':
+                    speeds[data['source_id']] = data['speed_mbps']
+                elif event == 'result' and data['result']['status'] != '测试中...':
+                    result = data['result']
+                    speed_text = f" {result['speed_mbps']:.2f} Mbps" if result['status'] == '成功' else ''
+                    progress(f"[{data['stats']['completed_count']}/{len(selected_sources)}] {result['name']}: {result['status']}{speed_text}")
+                    speeds.pop(data['source_id'], None)
+            
+            if speeds and time.time() - last_line_time >= 1:
+                last_line_time = time.time()
+                results = session.snapshot()
+                names = ', '.join(f"{results.get(source_id, {}).get('name', source_id)} {speed:.2f} Mbps" for source_id, speed in speeds.items())
+                progress(f"  实时速度: {names}")
     finally:
-        # 停止所有下载进程
-        stop_all_downloads()
-        is_testing = False
-        current_speed_data = {}
+        unsubscribe_events(subscriber)
+    
+    payload = session.status_payload()
+    write_cli_output(args, test_id, payload, sys.stdout)
+    progress(f"平均速度: {payload['avg_speed_mbps']:.2f} Mbps / {payload['avg_speed_mbs']:.2f} MB/s")
+    
+    if args.min_speed and payload['avg_speed_mbps'] < args.min_speed:
+        progress(f"平均速度低于阈值 {args.min_speed:g} Mbps")
+        return 2
+    if args.fail_on_error and payload['stats']['failed_count']:
+        progress(f"有 {payload['stats']['failed_count']} 个源测试失败")
+        return 3
+    return 0
 
 def start_server():
     """启动服务器"""
@@ -1150,10 +5742,17 @@ def start_server():
     validation_thread.daemon = True
     validation_thread.start()
     
+    # 启动定时测试
+    start_scheduler()
+    
     # 注册退出清理
     atexit.register(stop_all_downloads)
     
     app.run(host='0.0.0.0', port=8400, debug=False)
 
 if __name__ == '__main__':
+    # 打包后基准测试的回环源子进程需要
+    multiprocessing.freeze_support()
+    if CLI_MODE:
+        sys.exit(run_bench(sys.argv[2:]) if sys.argv[1] == 'bench' else run_cli(sys.argv[2:]))
     start_server()